@@ -1,878 +1,400 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 
-import psycopg2
+import math
 import os
 
-database_name = os.environ.get("DATABASE_NAME")
+import changes
+import compression
+import db
+import idempotency
+import jobs
+import metrics
+import routes
+from bulk import BulkError, bulk_insert, category_spec, company_spec, product_spec, read_bulk_records, warranty_spec, xref_spec
+from cache import cache, record_key
+from conditional import conditional, conditional_on_body
+from db import get_db, run
+from migrate import apply_migrations
+from pagination import get_page_size, get_stream_format, stream_table
+from schema import categories, category_stats, companies, company_stats, products, warranties
+
 app_host = os.environ.get("APP_HOST")
 app_port = os.environ.get("APP_PORT")
-
-conn = psycopg2.connect(f"dbname={database_name}")
-cursor = conn.cursor()
+batch_max_operations = int(os.environ.get("BATCH_MAX_OPERATIONS", 100))
 
 def create_all():
-    print("Creating tables...")
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Companies (
-        company_id SERIAL PRIMARY KEY,
-        company_name VARCHAR NOT NULL UNIQUE,
-        active BOOLEAN DEFAULT true
-        );
-
-        CREATE TABLE IF NOT EXISTS Products (
-        product_id SERIAL PRIMARY KEY,
-        product_name VARCHAR NOT NULL UNIQUE,
-        company_id INTEGER,
-        description VARCHAR,
-        price DECIMAL,
-        active BOOLEAN DEFAULT true,
-        FOREIGN KEY (company_id) REFERENCES Companies(company_id)
-        );
-
-        CREATE TABLE IF NOT EXISTS Categories (
-        category_id SERIAL PRIMARY KEY,
-        category_name VARCHAR NOT NULL UNIQUE
-        );
-
-        CREATE TABLE IF NOT EXISTS ProductsCategoriesXref (
-        product_id INTEGER,
-        category_id INTEGER,
-        PRIMARY KEY (product_id, category_id),
-        FOREIGN KEY (product_id) REFERENCES Products(product_id),
-        FOREIGN KEY (category_id) REFERENCES Categories(category_id)
-        );
-
-        CREATE TABLE IF NOT EXISTS Warranties (
-        warranty_id SERIAL PRIMARY KEY,
-        warranty_months INTEGER NOT NULL,
-        product_id INTEGER,
-        FOREIGN KEY (product_id) REFERENCES Products(product_id)
-        );
-    """)
-    conn.commit()
-    print("Tables Created!")
+    print("Applying migrations...")
+    with db.connection() as conn:
+        apply_migrations(conn)
+    print("Database up to date!")
 
 app = Flask(__name__)
+db.init_app(app)
+metrics.init_app(app)
+compression.init_app(app)
+idempotency.init_app(app)
 
-# CREATE
+def respond(reply):
+    for table, record_ids in reply.invalidate:
+        cache.invalidate(table, *record_ids)
 
-@app.route('/company', methods=['POST'])
-def add_company():
-    post_data = request.form if request.form else request.get_json()
-    
-    company_name = post_data.get('company_name')
+    for table in reply.invalidate_tables:
+        cache.invalidate_table(table)
 
-    if not company_name:
-        return jsonify({"message": "company_name is a required field"}), 400
-    
-    result = cursor.execute("""
-        SELECT * FROM Companies
-            WHERE company_name=%s;
-        """,
-        (company_name,)
-    )
+    if reply.rows is not None:
+        return Response(reply.render_rows(), status=reply.status, mimetype="application/json")
 
-    result = cursor.fetchone()
+    return jsonify(reply.body), reply.status
 
-    if result:
-        return jsonify({"message": "Company already exists"}), 400
-    
-    try:
-        cursor.execute("""
-            INSERT INTO Companies
-            (company_name)
-            VALUES (%s);""",
-        (company_name,)
-        )
-        conn.commit()
-      
-    except Exception as e:
-        cursor.rollback()
-        return jsonify({"message": "Company could not be added", "Error": str(e)}), 400
-
-    return jsonify({"message": f"Company {company_name} added to DB"}), 201
+def get_post_data():
+    return request.form if request.form else request.get_json()
 
-@app.route('/category', methods=['POST'])
-def add_category():
-    post_data = request.form if request.form else request.get_json()
-    
-    category_name = post_data.get('category_name')
+# CREATE
 
-    if not category_name:
-        return jsonify({"message": "category_name is a required field"}), 400
-    
-    result = cursor.execute("""
-        SELECT * FROM Categories
-            WHERE category_name=%s;
-        """,
-        (category_name,)
-    )
+def upsert_requested():
+    return request.args.get('on_conflict') == 'update'
 
-    result = cursor.fetchone()
+def hard_delete_requested():
+    return request.args.get('mode') == 'hard'
 
-    if result:
-        return jsonify({"message": "Category already exists"}), 400
-    
-    try:
-        cursor.execute("""
-            INSERT INTO Categories
-            (category_name)
-            VALUES (%s);""",
-        (category_name,)
-        )
-        conn.commit()
-      
-    except Exception as e:
-        cursor.rollback()
-        return jsonify({"message": "Category could not be added", "Error": str(e)}), 400
+@app.route('/company', methods=['POST'])
+def add_company():
+    return respond(run(routes.add_company(get_post_data(), upsert_requested())))
 
-    return jsonify({"message": f"Category {category_name} added to DB"}), 201
+@app.route('/category', methods=['POST'])
+def add_category():
+    return respond(run(routes.add_category(get_post_data(), upsert_requested())))
 
 @app.route('/product', methods=['POST'])
 def add_product():
-    post_data = request.form if request.form else request.get_json()
+    return respond(run(routes.add_product(get_post_data(), upsert_requested())))
 
-    product_name = post_data.get('product_name')
-    company_id = post_data.get('company_id')
-    description = post_data.get('description')
-    price = post_data.get('price')
+@app.route('/warranty', methods=['POST'])
+def add_warranty():
+    return respond(run(routes.add_warranty(get_post_data())))
 
-    if not product_name:
-        return jsonify({"message": "product_name is a required field"}), 400
-    
-    if not company_id:
-        return jsonify({"message": "company_id is a required field"}), 400
-    
-    result = cursor.execute("""
-        SELECT * FROM Products
-            WHERE product_name=%s;
-        """,
-        (product_name,)
-    )
+@app.route('/product/category', methods=['POST'])
+def create_xref():
+    return respond(run(routes.create_xref(get_post_data())))
 
-    result = cursor.fetchone()
+@app.route('/batch', methods=['POST'])
+def run_batch():
+    # Ordered create/update/delete operations in one transaction on one
+    # connection; see routes.run_batch for the request format.
+    return respond(run(routes.run_batch(request.get_json(silent=True), batch_max_operations)))
+
+def bulk_create(spec, name):
+    conn = get_db()
+    cursor = conn.cursor()
 
-    if result:
-        return jsonify({"message": "Product already exists"}), 400
-    
     try:
-        cursor.execute("""
-            INSERT INTO Products
-            (product_name, company_id, description, price)
-            VALUES (%s, %s, %s, %s);
-            """,
-            (product_name, company_id, description, price,)
-        )
+        records = read_bulk_records()
+
+    except (BulkError, ValueError) as e:
+        return jsonify({"message": f"{name} could not be read", "Error": str(e)}), 400
+
+    try:
+        summary, results = bulk_insert(cursor, spec, records)
         conn.commit()
-      
+
     except Exception as e:
-        cursor.rollback()
-        return jsonify({"message": "Product could not be added", "Error": str(e)}), 400
+        conn.rollback()
+        return jsonify({"message": f"{name} could not be added", "Error": str(e)}), 400
 
-    return jsonify({"message": f"Product {product_name} added to DB"}), 201
+    if summary["created"] == 0:
+        return jsonify({"message": f"no {name} added to DB", **summary, "results": results}), 400
 
-@app.route('/warranty', methods=['POST'])
-def add_warranty():
-    post_data = request.form if request.form else request.get_json()
+    return jsonify({"message": f"{summary['created']} {name} added to DB", **summary, "results": results}), 201
 
-    warranty_months = post_data.get('warranty_months')
-    product_id = post_data.get('product_id')
+@app.route('/companies/bulk', methods=['POST'])
+def add_companies_bulk():
+    return bulk_create(company_spec, "companies")
 
-    if not warranty_months:
-        return jsonify({"message": "warranty_months is a required field"}), 400
-    
-    if not product_id:
-        return jsonify({"message": "product_id is a required field"}), 400
-    
-    result = cursor.execute("""
-        SELECT * FROM Warranties
-        WHERE warranty_months = %s
-        AND product_id = %s;
-        """, 
-        (warranty_months, product_id,)
-    )
-
-    if result:
-        return jsonify({"message": "Warranty already exists"}), 400
-    
+@app.route('/categories/bulk', methods=['POST'])
+def add_categories_bulk():
+    return bulk_create(category_spec, "categories")
+
+@app.route('/products/bulk', methods=['POST'])
+def add_products_bulk():
+    return bulk_create(product_spec, "products")
+
+@app.route('/warranties/bulk', methods=['POST'])
+def add_warranties_bulk():
+    return bulk_create(warranty_spec, "warranties")
+
+@app.route('/product/categories/bulk', methods=['POST'])
+def create_xrefs_bulk():
+    return bulk_create(xref_spec, "Product-Category associations")
+
+# READ
+#
+# Views marked db.read_only may be answered by a read replica (see
+# db.request_pool). The by-id reads stay on the primary: they fill the
+# read cache, and a fill from a lagging replica could put back a row a
+# write has just invalidated.
+
+def get_by_id(schema, record_id, name):
+    # By-id reads go through the cache; a connection is only checked out
+    # from the pool on a miss, or to load ?include= relations.
     try:
-        cursor.execute("""
-            INSERT INTO Warranties
-            (product_id, warranty_months)
-            VALUES (%s, %s);
-            """,
-            (product_id, warranty_months,)
-        )
-        conn.commit()
+        includes = routes.parse_includes(schema, request.args.get('include'))
+    except routes.ListingError as e:
+        return jsonify({"message": str(e)}), 400
 
-    except Exception as e:
-        cursor.rollback()
-        return jsonify({"message": "Warranty could not be added", "Error": str(e)}), 400
-    
-    return jsonify({"message": f"Warranty added to DB"}), 201
+    record = cache.get_or_load(record_key(schema.name, record_id), lambda: run(routes.load_by_id(schema, record_id)))
 
-@app.route('/product/category', methods=['POST'])
-def create_xref():
-    post_data = request.form if request.form else request.get_json()
+    if includes:
+        return respond(run(routes.embed_reply(record, name, includes)))
 
-    category_id = post_data.get('category_id')
-    product_id = post_data.get('product_id')
+    return respond(routes.by_id_reply(record, name))
 
-    if not category_id:
-        return jsonify({"message": "category_id is a required field"}), 400
-    
-    if not product_id:
-        return jsonify({"message": "product_id is a required field"}), 400
-    
-    result = cursor.execute("""
-        SELECT * FROM ProductsCategoriesXref
-        WHERE category_id = %s
-        AND product_id = %s;
-        """, 
-        (category_id, product_id,)
-    )
-
-    if result:
-        return jsonify({"message": "Product-Category association already exists"}), 400
-    
+def product_tables(args):
+    return routes.listing_tables(products, args)
+
+def list_table(schema, name, **defaults):
+    # Filters, sort and fields= projection come from the query string; see
+    # routes.parse_listing for what is allowed.
     try:
-        cursor.execute("""
-            INSERT INTO ProductsCategoriesXref
-            (product_id, category_id)
-            VALUES (%s, %s);
-            """,
-            (product_id, category_id,)
-        )
-        conn.commit()
+        listing = routes.parse_listing(schema, request.args, defaults)
+    except routes.ListingError as e:
+        return jsonify({"message": str(e)}), 400
 
-    except Exception as e:
-        cursor.rollback()
-        return jsonify({"message": "Product-Category association could not be added", "Error": str(e)}), 400
-    
-    return jsonify({"message": f"Product-Category association added to DB"}), 201
+    stream_format = get_stream_format()
 
-# READ
+    if stream_format:
+        # Streamed rows are written straight from the cursor, so there is
+        # nowhere to embed relations.
+        if listing.includes:
+            return jsonify({"message": "include cannot be combined with stream"}), 400
+
+        return stream_table(listing, stream_format, f"{name} found")
+
+    return respond(run(routes.list_page(listing, name, get_page_size())))
 
 @app.route('/companies', methods=['GET'])
+@db.read_only
+@conditional("companies")
 def get_companies():
-    result = cursor.execute("""
-        SELECT * FROM Companies;
-    """)
-    
-    result = cursor.fetchall()
-
-    record_list = []
-
-    for record in result:
-        record = {
-            'company_id': record[0],
-            'company_name': record[1],
-            'active': record[2]
-        }
-        
-        record_list.append(record)
-
-    if record_list == []:
-        return jsonify({"message": "companies not found"}), 404
-    else:
-        return jsonify({"message": "companies found", "results": record_list}), 200
+    return list_table(companies, "companies")
     
 @app.route('/company/<company_id>', methods=['GET'])
+@conditional_on_body
 def get_company_by_id(company_id):
-    result = cursor.execute("""
-        SELECT * FROM Companies
-        WHERE company_id = %s;
-    """, (company_id,))
-    
-    result = cursor.fetchone()
-        
-    if result == None:
-        return jsonify({"message": "company not found"}), 404
-    else:
-
-        record = {
-            'company_id': result[0],
-            'company_name': result[1],
-            'active': result[2]
-        }
-        return jsonify({"message": "company found", "result": record}), 200
+    return get_by_id(companies, company_id, "company")
     
 @app.route('/categories', methods=['GET'])
+@db.read_only
+@conditional("categories")
 def get_categories():
-    result = cursor.execute("""
-        SELECT * FROM Categories;
-    """)
-    
-    result = cursor.fetchall()
-
-    record_list = []
-
-    for record in result:
-        record = {
-            'category_id': record[0],
-            'category_name': record[1]
-        }
-        
-        record_list.append(record)
-
-    if record_list == []:
-        return jsonify({"message": "categories not found"}), 404
-    else:
-        return jsonify({"message": "categories found", "results": record_list}), 200
+    return list_table(categories, "categories")
     
 @app.route('/category/<category_id>', methods=['GET'])
+@conditional_on_body
 def get_category_by_id(category_id):
-    result = cursor.execute("""
-        SELECT * FROM Categories
-        WHERE category_id = %s;
-    """, (category_id,))
-    
-    result = cursor.fetchone()
-  
-    if result == None:
-        return jsonify({"message": "category not found"}), 404
-    else:
-        record = {
-            'category_id': result[0],
-            'category_name': result[1]
-        }
-
-        return jsonify({"message": "category found", "result": record}), 200
+    return get_by_id(categories, category_id, "category")
     
 @app.route('/products', methods=['GET'])
+@db.read_only
+@conditional("products", related=product_tables)
 def get_products():
-    result = cursor.execute("""
-        SELECT * FROM Products;
-    """)
-    
-    result = cursor.fetchall()
-
-    record_list = []
-
-    for record in result:
-        record = {
-            'product_id': record[0],
-            'product_name': record[1],
-            'company_id': record[2],
-            'description': record[3],
-            'price': record[4],
-            'active': record[5]
-        }
-        
-        record_list.append(record)
-
-    if record_list == []:
-        return jsonify({"message": "products not found"}), 404
-    else:
-        return jsonify({"message": "products found", "results": record_list}), 200
+    return list_table(products, "products")
     
 @app.route('/products/active', methods=['GET'])
+@db.read_only
+@conditional("products", related=product_tables)
 def get_products_by_active():
-    post_data = request.form if request.form else request.get_json()
-
-    active = post_data.get('active')
-
-    result = cursor.execute("""
-        SELECT * FROM Products
-        WHERE active = %s;
-    """, (bool(active),))
-    
-    result = cursor.fetchall()
-
-    record_list = []
-
-    for record in result:
-        record = {
-            'product_id': record[0],
-            'product_name': record[1],
-            'company_id': record[2],
-            'description': record[3],
-            'price': record[4],
-            'active': record[5]
-        }
-        
-        record_list.append(record)
-
-    if record_list == []:
-        return jsonify({"message": "products not found"}), 404
-    else:
-        return jsonify({"message": "products found", "results": record_list}), 200
+    return list_table(products, "products", active=True)
     
+@app.route('/products/search', methods=['GET'])
+@db.read_only
+@conditional("products")
+def search_products():
+    return respond(run(routes.search_products(request.args, get_page_size())))
+
 @app.route('/product/company/<company_id>', methods=['GET'])
+@db.read_only
+@conditional("products", related=product_tables)
 def get_products_by_company_id(company_id):
-
-    result = cursor.execute("""
-        SELECT * FROM Products
-        WHERE company_id = %s;
-    """, (company_id,))
-    
-    result = cursor.fetchall()
-
-    record_list = []
-
-    for record in result:
-        record = {
-            'product_id': record[0],
-            'product_name': record[1],
-            'company_id': record[2],
-            'description': record[3],
-            'price': record[4],
-            'active': record[5]
-        }
-        
-        record_list.append(record)
-
-    if record_list == []:
-        return jsonify({"message": "products not found"}), 404
-    else:
-        return jsonify({"message": "products found", "results": record_list}), 200
+    return list_table(products, "products", company_id=company_id)
     
 @app.route('/product/<product_id>', methods=['GET'])
+@conditional_on_body
 def get_product_by_id(product_id):
+    return get_by_id(products, product_id, "product")
 
-    result = cursor.execute("""
-        SELECT * FROM Products
-        WHERE product_id = %s;
-    """, (product_id,))
-    
-    result = cursor.fetchone()
-
-    if result == None:
-        return jsonify({"message": "product not found"}), 404
-    else:
-
-        record = {
-            "product_id": result[0],
-            "product_name": result[1],
-            "company_id": result[2],
-            "description": result[3],
-            "price": result[4],
-            "active": result[5]
-        }
-        return jsonify({"message": "product found", "result": record}), 200
+@app.route('/product/<product_id>/categories', methods=['GET'])
+@db.read_only
+@conditional("products", "categories", "productscategoriesxref")
+def get_product_categories(product_id):
+    return respond(run(routes.get_product_categories(product_id)))
     
 @app.route('/warranty/<warranty_id>', methods=['GET'])
+@conditional_on_body
 def get_warranty_by_id(warranty_id):
-
-    result = cursor.execute("""
-        SELECT * FROM Warranties
-        WHERE warranty_id = %s;
-    """, (warranty_id,))
-    
-    result = cursor.fetchone()
-
-    if result == None:
-        return jsonify({"message": "warranty not found"}), 404
-    else:
-
-        record = {
-            "warranty_id": result[0],
-            "warranty_months": result[1],
-            "product_id": result[2]
-        }
-        return jsonify({"message": "warranty found", "result": record}), 200
-    
-# UPDATE
-
-@app.route('/company/<company_id>', methods=['PUT'])
-def update_company_by_id(company_id):
-    post_data = request.form if request.form else request.get_json()
-
-    result = cursor.execute("""
-        SELECT * FROM Companies
-        WHERE company_id = %s;
-        """, (company_id,)
-    )
-
-    result = cursor.fetchone()
-
-    if result == None:
-        return jsonify({"message": "company not found"}), 404
-    
-    allowed_fields = ["company_name", "active"]
-
-    fields_to_update = {
-        "company_name": post_data.get('company_name'),
-        "active": post_data.get('active')
-    }
-
-    set_list = []
-    set_value_tuple = ()
-
-    for field in allowed_fields:
-        if fields_to_update[field] != None and fields_to_update[field] != '' and str(fields_to_update[field]).isspace() != True:
-            set_list.append(f"{field} = %s")
-            set_value_tuple += (fields_to_update[field],)
-
-    if set_list == []:
-        return jsonify({"message": "nothing to update"}), 400
-    else:
-        set_str = ', '.join(set_list)
-        set_value_tuple += (company_id,)
-        
+    return get_by_id(warranties, warranty_id, "warranty")
+
+# Catalog statistics come from materialized views refreshed in the
+# background (jobs.refresh_stats), so a dashboard poll is a single indexed
+# read, or a 304 until the next refresh.
+
+@app.route('/stats', methods=['GET'])
+@db.read_only
+@conditional("catalogstats")
+def get_stats():
+    return respond(run(routes.get_stats()))
+
+@app.route('/stats/companies', methods=['GET'])
+@db.read_only
+@conditional("catalogstats")
+def get_company_stats():
+    return list_table(company_stats, "company stats")
+
+@app.route('/stats/company/<company_id>', methods=['GET'])
+@db.read_only
+@conditional("catalogstats")
+def get_company_stats_by_id(company_id):
+    return respond(run(routes.get_by_id(company_stats, company_id, "company stats")))
+
+@app.route('/stats/categories', methods=['GET'])
+@db.read_only
+@conditional("catalogstats")
+def get_category_stats():
+    return list_table(category_stats, "category stats")
+
+@app.route('/stats/category/<category_id>', methods=['GET'])
+@db.read_only
+@conditional("catalogstats")
+def get_category_stats_by_id(category_id):
+    return respond(run(routes.get_by_id(category_stats, category_id, "category stats")))
+
+@app.route('/stats/refresh', methods=['POST'])
+def start_stats_refresh():
+    job = jobs.submit("refresh_stats", jobs.refresh_stats)
+
+    return jsonify({"message": "Stats refresh started", "job": job.to_dict()}), 202
+
+@app.route('/changes', methods=['GET'])
+def get_changes():
+    # Change feed: ?after=<next_after>&tables=products,warranties, as a
+    # long poll (?wait=<seconds>) or Server-Sent Events (?stream=sse).
     try:
-        cursor.execute(f"""        
-            UPDATE Companies
-            SET {set_str}
-            WHERE company_id = %s;
-            """, set_value_tuple
-        )
-        conn.commit()
+        after, table_names = routes.parse_changes(request.args, request.headers.get('Last-Event-ID'))
+    except routes.ListingError as e:
+        return jsonify({"message": str(e)}), 400
 
-    except Exception as e:
-        cursor.rollback()
-        return jsonify({"message": "Company could not be updated", "Error": str(e)}), 400
-    
-    result = cursor.execute("""
-        SELECT * FROM Companies
-        WHERE company_id = %s
-        """, (company_id,)
-    )
-    
-    result = cursor.fetchone()
+    if changes.sse_requested():
+        return changes.stream_changes(after, table_names)
 
-    record = {
-        "company_id": result[0],
-        "company_name": result[1],
-        "active": result[2]
-    }
+    wait = request.args.get('wait', 0, type=float)
 
-    return jsonify({"message": "company updated", "result": record}), 200
+    if not math.isfinite(wait):
+        return jsonify({"message": "wait must be a number of seconds"}), 400
 
+    wait = min(max(wait, 0), changes.changes_max_wait)
 
-@app.route('/category/<category_id>', methods=['PUT'])
-def update_category_by_id(category_id):
-    post_data = request.form if request.form else request.get_json()
+    return respond(changes.long_poll(after, table_names, wait))
 
-    result = cursor.execute("""
-        SELECT * FROM Categories
-        WHERE category_id = %s;
-        """, (category_id,)
-    )
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify({"message": "cache stats", "result": cache.stats()}), 200
 
-    result = cursor.fetchone()
-
-    if result == None:
-        return jsonify({"message": "category not found"}), 404
-    
-    allowed_fields = ["category_name"]
-
-    fields_to_update = {
-        "category_name": post_data.get('category_name'),
-    }
-
-    set_list = []
-    set_value_tuple = ()
-
-    for field in allowed_fields:
-        if fields_to_update[field] != None and fields_to_update[field] != '' and str(fields_to_update[field]).isspace() != True:
-            set_list.append(f"{field} = %s")
-            set_value_tuple += (fields_to_update[field],)
-
-    if set_list == []:
-        return jsonify({"message": "nothing to update"}), 400
-    else:
-        set_str = ', '.join(set_list)
-        set_value_tuple += (category_id,)
-        
-    try:
-        cursor.execute(f"""        
-            UPDATE Categories
-            SET {set_str}
-            WHERE category_id = %s;
-            """, set_value_tuple
-        )
-        conn.commit()
-
-    except Exception as e:
-        cursor.rollback()
-        return jsonify({"message": "Category could not be updated", "Error": str(e)}), 400
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return metrics.render()
     
-    result = cursor.execute("""
-        SELECT * FROM Categories
-        WHERE category_id = %s
-        """, (category_id,)
-    )
-    
-    result = cursor.fetchone()
+# UPDATE
 
-    record = {
-        "category_id": result[0],
-        "category_name": result[1],
-    }
+@app.route('/company/<company_id>', methods=['PUT', 'PATCH'])
+def update_company_by_id(company_id):
+    return respond(run(routes.update_by_id(companies, company_id, get_post_data(), "company")))
 
-    return jsonify({"message": "company updated", "result": record}), 200
+@app.route('/category/<category_id>', methods=['PUT', 'PATCH'])
+def update_category_by_id(category_id):
+    return respond(run(routes.update_by_id(categories, category_id, get_post_data(), "category")))
 
-@app.route('/product/<product_id>', methods=['PUT'])
+@app.route('/product/<product_id>', methods=['PUT', 'PATCH'])
 def update_product_by_id(product_id):
-    post_data = request.form if request.form else request.get_json()
-
-    result = cursor.execute("""
-        SELECT * FROM Products
-        WHERE product_id = %s;
-        """, (product_id,)
-    )
-
-    result = cursor.fetchone()
-
-    if result == None:
-        return jsonify({"message": "product not found"}), 404
-
-    allowed_fields = ["product_name", "company_id", "description", "price", "active"]
-
-    fields_to_update = {
-        "product_name": post_data.get('product_name'),
-        "company_id": post_data.get('company_id'),
-        "description": post_data.get('description'),
-        "price": post_data.get('price'),
-        "active": post_data.get('active')
-    }
-
-    set_list = []
-    set_value_tuple = ()
-
-    for field in allowed_fields:
-        if fields_to_update[field] != None and fields_to_update[field] != '' and str(fields_to_update[field]).isspace() != True:
-            set_list.append(f"{field} = %s")
-            set_value_tuple += (fields_to_update[field],)
-
-    if set_list == []:
-        return jsonify({"message": "nothing to update"}), 400
-    else:
-        set_str = ', '.join(set_list)
-        set_value_tuple += (product_id,)
-        
-    try:
-        cursor.execute(f"""        
-            UPDATE Products
-            SET {set_str}
-            WHERE product_id = %s;
-            """, set_value_tuple
-        )
-        conn.commit()
-
-    except Exception as e:
-        cursor.rollback()
-        return jsonify({"message": "Product could not be updated", "Error": str(e)}), 400
-    
-    result = cursor.execute("""
-        SELECT * FROM Products
-        WHERE product_id = %s
-        """, (product_id,)
-    )
-    
-    result = cursor.fetchone()
+    return respond(run(routes.update_by_id(products, product_id, get_post_data(), "product")))
 
-    record = {
-        "product_id": result[0],
-        "product_name": result[1],
-        "company_id": result[2],
-        "description": result[3],
-        "price": result[4],
-        "active": result[5]
-    }
-
-    return jsonify({"message": "product updated", "result": record}), 200
-
-
-
-
-
-
-@app.route('/warranty/<warranty_id>', methods=['PUT'])
+@app.route('/warranty/<warranty_id>', methods=['PUT', 'PATCH'])
 def update_warranty_by_id(warranty_id):
-    post_data = request.form if request.form else request.get_json()
-
-    result = cursor.execute("""
-        SELECT * FROM Warranties
-        WHERE warranty_id = %s;
-        """, (warranty_id,)
-    )
-
-    result = cursor.fetchone()
+    return respond(run(routes.update_by_id(warranties, warranty_id, get_post_data(), "warranty")))
 
-    if result == None:
-        return jsonify({"message": "warranty not found"}), 404
+@app.route('/companies', methods=['PATCH'])
+def update_companies():
+    return respond(run(routes.update_by_ids(companies, request.get_json(), "companies")))
 
-    allowed_fields = ["warranty_months", "product_id"]
+@app.route('/categories', methods=['PATCH'])
+def update_categories():
+    return respond(run(routes.update_by_ids(categories, request.get_json(), "categories")))
 
-    fields_to_update = {
-        "warranty_months": post_data.get('warranty_months'),
-        "product_id": post_data.get('product_id')
-    }
+@app.route('/products', methods=['PATCH'])
+def update_products():
+    return respond(run(routes.update_by_ids(products, request.get_json(), "products")))
 
-    set_list = []
-    set_value_tuple = ()
-
-    for field in allowed_fields:
-        if fields_to_update[field] != None and fields_to_update[field] != '' and str(fields_to_update[field]).isspace() != True:
-            set_list.append(f"{field} = %s")
-            set_value_tuple += (fields_to_update[field],)
-
-    if set_list == []:
-        return jsonify({"message": "nothing to update"}), 400
-    else:
-        set_str = ', '.join(set_list)
-        set_value_tuple += (warranty_id,)
-        
-    try:
-        cursor.execute(f"""        
-            UPDATE Warranties
-            SET {set_str}
-            WHERE warranty_id = %s;
-            """, set_value_tuple
-        )
-        conn.commit()
-
-    except Exception as e:
-        cursor.rollback()
-        return jsonify({"message": "Warranty could not be updated", "Error": str(e)}), 400
-    
-    result = cursor.execute("""
-        SELECT * FROM Warranties
-        WHERE warranty_id = %s;
-        """, (warranty_id,)
-    )
-    
-    result = cursor.fetchone()
-
-    record = {
-        "warranty_months": result[0],
-        "product_id": result[1]
-    }
-
-    return jsonify({"message": "warranty updated", "result": record}), 200
+@app.route('/warranties', methods=['PATCH'])
+def update_warranties():
+    return respond(run(routes.update_by_ids(warranties, request.get_json(), "warranties")))
 
 
 # DELETE
 
 @app.route('/company/delete/<company_id>', methods=['DELETE'])
 def delete_company_by_id(company_id):
-    result = cursor.execute("""
-        SELECT * FROM Companies
-        WHERE company_id = %s;
-    """, (company_id,)
-    )
+    # Companies and products are archived unless ?mode=hard. ?mode=background
+    # hard-deletes a large company's products in chunks on a job thread and
+    # answers 202 straight away; poll /jobs/<job_id>.
+    if request.args.get('mode') == 'background':
+        if run(routes.load_by_id(companies, company_id)) == None:
+            return jsonify({"message": "company does not exist"}), 404
 
-    result = cursor.fetchone()
+        job = jobs.submit("delete_company", jobs.delete_company_in_chunks, company_id, company_id=company_id)
 
-    if result == () or result == None:
-        return jsonify({"message": "company does not exist"}), 404
+        return jsonify({"message": "Company delete started", "job": job.to_dict()}), 202
 
-    try:
-        cursor.execute("""
-        DELETE FROM ProductsCategoriesXref
-        WHERE product_id IN (SELECT product_id FROM Products WHERE company_id = %s);
-        
-        DELETE FROM Warranties
-        WHERE product_id IN (SELECT product_id FROM Products WHERE company_id = %s);
-                    
-        DELETE FROM Products
-        WHERE company_id = %s;
-                        
-        DELETE FROM Companies
-        WHERE company_id = %s;
-        """, (company_id, company_id, company_id, company_id,)
-        )
-        conn.commit()
-
-    except Exception as e:
-        cursor.rollback()
-        return jsonify({"message": "Company could not be deleted", "Error": str(e)}), 400
-    
-    return jsonify({"message": "Company deleted successfully"}), 200
+    return respond(run(routes.delete_company_by_id(company_id, hard_delete_requested())))
 
 @app.route('/product/delete/<product_id>', methods=['DELETE'])
 def delete_product_by_id(product_id):
-    result = cursor.execute("""
-        SELECT * FROM Products
-        WHERE product_id = %s;
-    """, (product_id,)
-    )
-
-    result = cursor.fetchone()
-
-    if result == () or result == None:
-        return jsonify({"message": "product does not exist"}), 404
-    
-    try:
-        cursor.execute("""
-            DELETE FROM ProductsCategoriesXref
-            WHERE product_id = %s;
-            
-            DELETE FROM Warranties
-            WHERE product_id = %s;
-                       
-            DELETE FROM Products
-            WHERE product_id = %s;
-            """, (product_id, product_id, product_id,)
-        )
-        conn.commit()
-
-    except Exception as e:
-        cursor.rollback()
-        return jsonify({"message": "Category could not be deleted", "Error": str(e)}), 400
-    
-    return jsonify({"message": "Category deleted successfully"}), 200
+    return respond(run(routes.delete_product_by_id(product_id, hard_delete_requested())))
 
 @app.route('/category/delete/<category_id>', methods=['DELETE'])
 def delete_category_by_id(category_id):
-    result = cursor.execute("""
-        SELECT * FROM Categories
-        WHERE category_id = %s;
-    """, (category_id,)
-    )
+    return respond(run(routes.delete_category_by_id(category_id)))
 
-    result = cursor.fetchone()
+@app.route('/warranty/delete/<warranty_id>', methods=['DELETE'])
+def delete_warranty_by_id(warranty_id):
+    return respond(run(routes.delete_warranty_by_id(warranty_id)))
 
-    if result == () or result == None:
-        return jsonify({"message": "category does not exist"}), 404
-    
-    try:
-        cursor.execute("""
-            DELETE FROM ProductsCategoriesXref
-            WHERE category_id = %s;
-            
-            DELETE FROM Categories
-            WHERE category_id = %s;
-            """, (category_id, category_id,)
-        )
-        conn.commit()
+@app.route('/companies', methods=['DELETE'])
+def delete_companies():
+    return respond(run(routes.remove_by_ids(companies, request.get_json(), "companies", hard_delete_requested())))
 
-    except Exception as e:
-        cursor.rollback()
-        return jsonify({"message": "Category could not be deleted", "Error": str(e)}), 400
-    
-    return jsonify({"message": "Category deleted successfully"}), 200
+@app.route('/categories', methods=['DELETE'])
+def delete_categories():
+    return respond(run(routes.delete_by_ids(categories, request.get_json(), "categories")))
 
-@app.route('/warranty/delete/<warranty_id>', methods=['DELETE'])
-def delete_warranty_by_id(warranty_id):
-    result = cursor.execute("""
-        SELECT * FROM Warranties
-        WHERE warranty_id = %s;
-    """, (warranty_id,)
-    )
+@app.route('/products', methods=['DELETE'])
+def delete_products():
+    return respond(run(routes.remove_by_ids(products, request.get_json(), "products", hard_delete_requested())))
 
-    result = cursor.fetchone()
+@app.route('/warranties', methods=['DELETE'])
+def delete_warranties():
+    return respond(run(routes.delete_by_ids(warranties, request.get_json(), "warranties")))
 
-    if result == () or result == None:
-        return jsonify({"message": "warranty does not exist"}), 404
-    
-    try:
-        cursor.execute("""
-            DELETE FROM Warranties
-            WHERE warranty_id = %s;
-            """, (warranty_id,)
-        )
-        conn.commit()
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    return respond(run(routes.get_job(job_id)))
 
-    except Exception as e:
-        cursor.rollback()
-        return jsonify({"message": "Warranty could not be deleted", "Error": str(e)}), 400
-    
-    return jsonify({"message": "Warranty deleted successfully"}), 200
+@app.route('/jobs/purge', methods=['POST'])
+def start_purge():
+    job = jobs.submit("purge_archived", jobs.purge_archived)
+
+    return jsonify({"message": "Purge started", "job": job.to_dict()}), 202
 
 
 if __name__ == '__main__':
     create_all()
-    app.run(host=app_host, port=app_port)
\ No newline at end of file
+    jobs.start_purge_scheduler()
+    jobs.start_stats_refresher()
+    app.run(host=app_host, port=app_port)
@@ -0,0 +1,284 @@
+import json
+import os
+from contextlib import asynccontextmanager
+
+import psycopg
+from psycopg_pool import AsyncConnectionPool
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+import routes
+from routes import QueryError
+from schema import categories, category_stats, companies, company_stats, products, warranties
+
+# Async front end serving the same routes as app.py from the shared route
+# layer in routes.py. Run it with e.g.
+#
+#     uvicorn asgi_app:app --host $APP_HOST --port $APP_PORT --workers 4
+#
+# Sync-only extras (bulk upload, streaming, the read cache, conditional
+# GETs, background jobs, read replica routing, the /changes feed and
+# Idempotency-Key replays) are served by the Flask app.
+
+database_name = os.environ.get("DATABASE_NAME")
+database_dsn = os.environ.get("DATABASE_DSN") or f"dbname={database_name}"
+pool_min = int(os.environ.get("DB_POOL_MIN", 1))
+pool_max = int(os.environ.get("DB_POOL_MAX", 10))
+pool_timeout = float(os.environ.get("DB_POOL_TIMEOUT", 5))
+# psycopg 3 prepares repeated statements server-side by itself; behind
+# PgBouncer in transaction mode that has to be off (see prepared.py).
+pgbouncer_transaction_mode = os.environ.get("DB_PGBOUNCER_TRANSACTION_MODE", "false").lower() == "true"
+
+pool = AsyncConnectionPool(
+    database_dsn,
+    min_size=pool_min,
+    max_size=pool_max,
+    timeout=pool_timeout,
+    check=AsyncConnectionPool.check_connection,
+    kwargs={"prepare_threshold": None} if pgbouncer_transaction_mode else None,
+    open=False,
+)
+
+default_page_size = int(os.environ.get("PAGE_SIZE_DEFAULT", 100))
+max_page_size = int(os.environ.get("PAGE_SIZE_MAX", 1000))
+batch_max_operations = int(os.environ.get("BATCH_MAX_OPERATIONS", 100))
+# Same settings as the Flask app's compression.py; Starlette's middleware
+# only speaks gzip.
+compression_enabled = os.environ.get("COMPRESSION", "true").lower() == "true"
+compression_min_size = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+gzip_level = int(os.environ.get("COMPRESSION_GZIP_LEVEL", 6))
+
+
+async def fetch(cursor, fetch_mode):
+    if fetch_mode == "one":
+        return await cursor.fetchone()
+
+    if fetch_mode == "all":
+        return await cursor.fetchall()
+
+    return None
+
+
+async def run(operation):
+    # Async twin of db.run: one pooled connection and one transaction per
+    # operation.
+    async with pool.connection() as conn:
+        cursor = conn.cursor()
+
+        try:
+            query = next(operation)
+
+            while True:
+                try:
+                    await cursor.execute(query.sql, query.params)
+                    result = await fetch(cursor, query.fetch)
+
+                except psycopg.Error as e:
+                    await conn.rollback()
+                    query = operation.throw(QueryError(str(e)))
+
+                else:
+                    query = operation.send(result)
+
+        except StopIteration as stop:
+            if getattr(stop.value, "rollback", False):
+                await conn.rollback()
+            else:
+                await conn.commit()
+
+            return stop.value
+
+        except Exception:
+            await conn.rollback()
+            raise
+
+
+def respond(reply):
+    if reply.rows is not None:
+        return Response(reply.render_rows(), status_code=reply.status, media_type="application/json")
+
+    return JSONResponse(reply.body, status_code=reply.status)
+
+
+async def get_post_data(request):
+    if request.headers.get("content-type", "").startswith(("application/x-www-form-urlencoded", "multipart/form-data")):
+        return await request.form()
+
+    return await request.json()
+
+
+def get_page_size(request):
+    try:
+        limit = int(request.query_params.get("limit", default_page_size))
+    except ValueError:
+        limit = default_page_size
+
+    return max(1, min(limit, max_page_size))
+
+
+def upsert_requested(request):
+    return request.query_params.get("on_conflict") == "update"
+
+
+def hard_delete_requested(request):
+    return request.query_params.get("mode") == "hard"
+
+
+# CREATE
+
+async def add_company(request):
+    return respond(await run(routes.add_company(await get_post_data(request), upsert_requested(request))))
+
+async def add_category(request):
+    return respond(await run(routes.add_category(await get_post_data(request), upsert_requested(request))))
+
+async def add_product(request):
+    return respond(await run(routes.add_product(await get_post_data(request), upsert_requested(request))))
+
+async def add_warranty(request):
+    return respond(await run(routes.add_warranty(await get_post_data(request))))
+
+async def create_xref(request):
+    return respond(await run(routes.create_xref(await get_post_data(request))))
+
+
+async def run_batch(request):
+    return respond(await run(routes.run_batch(await request.json(), batch_max_operations)))
+
+
+# READ
+
+def list_table(schema, name, path_filters=(), **defaults):
+    # path_filters name path parameters that act as filter defaults, e.g.
+    # company_id for /product/company/{company_id}.
+    async def handler(request):
+        filters = dict(defaults, **{key: request.path_params[key] for key in path_filters})
+
+        try:
+            listing = routes.parse_listing(schema, request.query_params, filters)
+        except routes.ListingError as e:
+            return JSONResponse({"message": str(e)}, status_code=400)
+
+        return respond(await run(routes.list_page(listing, name, get_page_size(request))))
+
+    return handler
+
+def get_by_id(schema, key, name):
+    async def handler(request):
+        try:
+            includes = routes.parse_includes(schema, request.query_params.get("include"))
+        except routes.ListingError as e:
+            return JSONResponse({"message": str(e)}, status_code=400)
+
+        return respond(await run(routes.get_by_id(schema, request.path_params[key], name, includes)))
+
+    return handler
+
+async def search_products(request):
+    return respond(await run(routes.search_products(request.query_params, get_page_size(request))))
+
+async def get_product_categories(request):
+    return respond(await run(routes.get_product_categories(request.path_params['product_id'])))
+
+async def get_stats(request):
+    return respond(await run(routes.get_stats()))
+
+
+# UPDATE
+
+def update_by_id(schema, key, name):
+    async def handler(request):
+        return respond(await run(routes.update_by_id(schema, request.path_params[key], await get_post_data(request), name)))
+
+    return handler
+
+def update_by_ids(schema, name):
+    async def handler(request):
+        return respond(await run(routes.update_by_ids(schema, await request.json(), name)))
+
+    return handler
+
+
+# DELETE
+
+def delete_by_id(operation, key):
+    async def handler(request):
+        return respond(await run(operation(request.path_params[key])))
+
+    return handler
+
+def remove_by_id(operation, key):
+    async def handler(request):
+        return respond(await run(operation(request.path_params[key], hard_delete_requested(request))))
+
+    return handler
+
+def delete_by_ids(schema, name):
+    async def handler(request):
+        return respond(await run(routes.remove_by_ids(schema, await request.json(), name, hard_delete_requested(request))))
+
+    return handler
+
+
+async def handle_bad_json(request, exc):
+    return JSONResponse({"message": "request body is not valid JSON"}, status_code=400)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await pool.open(wait=True)
+
+    try:
+        yield
+    finally:
+        await pool.close()
+
+
+middleware = [Middleware(GZipMiddleware, minimum_size=compression_min_size, compresslevel=gzip_level)] if compression_enabled else []
+
+app = Starlette(lifespan=lifespan, middleware=middleware, exception_handlers={json.JSONDecodeError: handle_bad_json}, routes=[
+    Route('/company', add_company, methods=['POST']),
+    Route('/category', add_category, methods=['POST']),
+    Route('/product', add_product, methods=['POST']),
+    Route('/warranty', add_warranty, methods=['POST']),
+    Route('/product/category', create_xref, methods=['POST']),
+    Route('/batch', run_batch, methods=['POST']),
+
+    Route('/companies', list_table(companies, "companies"), methods=['GET']),
+    Route('/company/{company_id}', get_by_id(companies, 'company_id', "company"), methods=['GET']),
+    Route('/categories', list_table(categories, "categories"), methods=['GET']),
+    Route('/category/{category_id}', get_by_id(categories, 'category_id', "category"), methods=['GET']),
+    Route('/products', list_table(products, "products"), methods=['GET']),
+    Route('/products/active', list_table(products, "products", active=True), methods=['GET']),
+    Route('/products/search', search_products, methods=['GET']),
+    Route('/product/company/{company_id}', list_table(products, "products", path_filters=['company_id']), methods=['GET']),
+    Route('/product/{product_id}', get_by_id(products, 'product_id', "product"), methods=['GET']),
+    Route('/product/{product_id}/categories', get_product_categories, methods=['GET']),
+    Route('/warranty/{warranty_id}', get_by_id(warranties, 'warranty_id', "warranty"), methods=['GET']),
+    Route('/stats', get_stats, methods=['GET']),
+    Route('/stats/companies', list_table(company_stats, "company stats"), methods=['GET']),
+    Route('/stats/company/{company_id}', get_by_id(company_stats, 'company_id', "company stats"), methods=['GET']),
+    Route('/stats/categories', list_table(category_stats, "category stats"), methods=['GET']),
+    Route('/stats/category/{category_id}', get_by_id(category_stats, 'category_id', "category stats"), methods=['GET']),
+
+    Route('/company/{company_id}', update_by_id(companies, 'company_id', "company"), methods=['PUT', 'PATCH']),
+    Route('/category/{category_id}', update_by_id(categories, 'category_id', "category"), methods=['PUT', 'PATCH']),
+    Route('/product/{product_id}', update_by_id(products, 'product_id', "product"), methods=['PUT', 'PATCH']),
+    Route('/warranty/{warranty_id}', update_by_id(warranties, 'warranty_id', "warranty"), methods=['PUT', 'PATCH']),
+    Route('/companies', update_by_ids(companies, "companies"), methods=['PATCH']),
+    Route('/categories', update_by_ids(categories, "categories"), methods=['PATCH']),
+    Route('/products', update_by_ids(products, "products"), methods=['PATCH']),
+    Route('/warranties', update_by_ids(warranties, "warranties"), methods=['PATCH']),
+
+    Route('/company/delete/{company_id}', remove_by_id(routes.delete_company_by_id, 'company_id'), methods=['DELETE']),
+    Route('/product/delete/{product_id}', remove_by_id(routes.delete_product_by_id, 'product_id'), methods=['DELETE']),
+    Route('/category/delete/{category_id}', delete_by_id(routes.delete_category_by_id, 'category_id'), methods=['DELETE']),
+    Route('/warranty/delete/{warranty_id}', delete_by_id(routes.delete_warranty_by_id, 'warranty_id'), methods=['DELETE']),
+    Route('/companies', delete_by_ids(companies, "companies"), methods=['DELETE']),
+    Route('/categories', delete_by_ids(categories, "categories"), methods=['DELETE']),
+    Route('/products', delete_by_ids(products, "products"), methods=['DELETE']),
+    Route('/warranties', delete_by_ids(warranties, "warranties"), methods=['DELETE']),
+])
@@ -0,0 +1,539 @@
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+import db
+import routes
+from migrate import apply_migrations
+
+# Load test / latency benchmark for every route in app.py.
+#
+#     createdb psy_crud_bench
+#     export DATABASE_NAME=psy_crud_bench
+#     python bench.py seed --products 100000
+#     python app.py &                      # or: uvicorn asgi_app:app
+#     python bench.py run --mix balanced --duration 30 --output before.json
+#     ...change something...
+#     python bench.py run --mix balanced --duration 30 --output after.json
+#     python bench.py compare before.json after.json
+#
+# `run --in-process` drives the Flask app through its test client instead of
+# over HTTP, which needs no server but also measures no network.
+
+app_host = os.environ.get("APP_HOST", "127.0.0.1")
+app_port = os.environ.get("APP_PORT", "8086")
+
+
+# SEED
+
+def seed(conn, companies=100, products=10000, categories=50, categories_per_product=2, warranties_per_product=1, seed_value=0.42):
+    apply_migrations(conn, log=lambda message: None)
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT setseed(%s);", (seed_value,))
+
+    cursor.execute("""
+        TRUNCATE ProductsCategoriesXref, Warranties, Products, Categories, Companies
+        RESTART IDENTITY CASCADE;
+    """)
+
+    cursor.execute("""
+        INSERT INTO Companies (company_name, active)
+        SELECT 'company-' || g, g %% 20 <> 0
+        FROM generate_series(1, %s) g;
+    """, (companies,))
+
+    cursor.execute("""
+        INSERT INTO Categories (category_name)
+        SELECT 'category-' || g
+        FROM generate_series(1, %s) g;
+    """, (categories,))
+
+    cursor.execute("""
+        INSERT INTO Products (product_name, company_id, description, price, active)
+        SELECT
+            'product-' || g,
+            1 + g %% %s,
+            'description for product ' || g || ' ' || md5(g::text),
+            round((random() * 1000)::numeric, 2),
+            g %% 10 <> 0
+        FROM generate_series(1, %s) g;
+    """, (companies, products,))
+
+    cursor.execute("""
+        INSERT INTO ProductsCategoriesXref (product_id, category_id)
+        SELECT p, 1 + (p * 7 + k) %% %s
+        FROM generate_series(1, %s) p, generate_series(1, %s) k
+        ON CONFLICT DO NOTHING;
+    """, (categories, products, categories_per_product,))
+
+    cursor.execute("""
+        INSERT INTO Warranties (warranty_months, product_id)
+        SELECT 12 * k, p
+        FROM generate_series(1, %s) p, generate_series(1, %s) k;
+    """, (products, warranties_per_product,))
+
+    # The /changes feed starts after the seed, so a run tails only its own
+    # writes.
+    cursor.execute("TRUNCATE ChangeLog RESTART IDENTITY;")
+
+    conn.commit()
+
+    # Seeded numbers should show in /stats right away.
+    db.run(routes.refresh_stats(), conn)
+
+    cursor.execute("ANALYZE;")
+    conn.commit()
+
+
+# WORKLOAD
+
+class Workload:
+    def __init__(self, sizes, rng):
+        self.sizes = sizes
+        self.rng = rng
+        self.counter = 0
+        # Rows created during the run; deletes only ever target these so the
+        # seeded dataset stays the same size.
+        self.created = {"company": [], "category": [], "product": [], "warranty": []}
+        # Where the /changes consumer is up to.
+        self.changes_after = None
+        self.lock = threading.Lock()
+
+    def unique(self, prefix):
+        with self.lock:
+            self.counter += 1
+            return f"bench-{prefix}-{os.getpid()}-{time.monotonic_ns()}-{self.counter}"
+
+    def pick(self, table):
+        return self.rng.randint(1, self.sizes[table])
+
+    def remember(self, table, record_id):
+        if record_id is not None:
+            with self.lock:
+                self.created[table].append(record_id)
+
+    def take(self, table):
+        with self.lock:
+            if self.created[table]:
+                return self.created[table].pop()
+
+        return None
+
+
+def operations(w):
+    # name -> (kind, weight, request builder). A builder returns
+    # (method, path, json body) and optionally a callback for the response.
+    def company_created(body):
+        w.remember("company", body.get("company_id"))
+
+    def category_created(body):
+        w.remember("category", body.get("category_id"))
+
+    def product_created(body):
+        w.remember("product", body.get("product_id"))
+
+    def warranty_created(body):
+        w.remember("warranty", body.get("warranty_id"))
+
+    def batch_created(body):
+        product, warranty = [result["body"] for result in body.get("results", [])]
+        w.remember("product", product.get("product_id"))
+        w.remember("warranty", warranty.get("warranty_id"))
+
+    def batch():
+        # A product and its warranty in one transaction, the warranty
+        # pointing at the new product through a $ref.
+        return "POST", "/batch", {"operations": [
+            {"op": "add_product", "data": {"product_name": w.unique("product"), "company_id": w.pick("company"), "price": "5.00"}},
+            {"op": "add_warranty", "data": {"warranty_months": 12, "product_id": {"$ref": "0.product_id"}}},
+        ]}
+
+    def changes():
+        after = w.changes_after
+        return "GET", "/changes?tables=products,warranties" + (f"&after={after}" if after else ""), None
+
+    def changes_read(body):
+        w.changes_after = body.get("next_after") or w.changes_after
+
+    def delete(table, path):
+        def build():
+            record_id = w.take(table)
+            return "DELETE", path.format(record_id if record_id is not None else 0), None
+
+        return build
+
+    def page_after(table):
+        return w.rng.randint(0, max(0, w.sizes[table] - 100))
+
+    return {
+        "POST /company": ("write", 2, lambda: ("POST", "/company", {"company_name": w.unique("company")}), company_created),
+        "POST /category": ("write", 1, lambda: ("POST", "/category", {"category_name": w.unique("category")}), category_created),
+        "POST /product": ("write", 4, lambda: ("POST", "/product", {"product_name": w.unique("product"), "company_id": w.pick("company"), "description": "bench", "price": "9.99"}), product_created),
+        "POST /warranty": ("write", 2, lambda: ("POST", "/warranty", {"warranty_months": w.rng.randint(1, 600), "product_id": w.pick("product")}), warranty_created),
+        "POST /product/category": ("write", 2, lambda: ("POST", "/product/category", {"product_id": w.pick("product"), "category_id": w.pick("category")}), None),
+        "POST /companies/bulk": ("write", 1, lambda: ("POST", "/companies/bulk", [{"company_name": w.unique("company")} for _ in range(20)]), None),
+        "POST /categories/bulk": ("write", 1, lambda: ("POST", "/categories/bulk", [{"category_name": w.unique("category")} for _ in range(20)]), None),
+        "POST /products/bulk": ("write", 1, lambda: ("POST", "/products/bulk", [{"product_name": w.unique("product"), "company_id": w.pick("company"), "price": "1.00"} for _ in range(50)]), None),
+        "POST /warranties/bulk": ("write", 1, lambda: ("POST", "/warranties/bulk", [{"warranty_months": 12, "product_id": w.pick("product")} for _ in range(50)]), None),
+        "POST /product/categories/bulk": ("write", 1, lambda: ("POST", "/product/categories/bulk", [{"product_id": w.pick("product"), "category_id": w.pick("category")} for _ in range(50)]), None),
+        "POST /batch": ("write", 1, batch, batch_created),
+
+        "GET /companies": ("read", 3, lambda: ("GET", f"/companies?after={page_after('company')}", None), None),
+        "GET /company/<id>": ("read", 8, lambda: ("GET", f"/company/{w.pick('company')}", None), None),
+        "GET /categories": ("read", 3, lambda: ("GET", f"/categories?after={page_after('category')}", None), None),
+        "GET /category/<id>": ("read", 6, lambda: ("GET", f"/category/{w.pick('category')}", None), None),
+        "GET /products": ("read", 8, lambda: ("GET", f"/products?after={page_after('product')}", None), None),
+        "GET /products/active": ("read", 1, lambda: ("GET", f"/products/active?after={page_after('product')}", None), None),
+        "GET /products/search": ("read", 2, lambda: ("GET", f"/products/search?q=product+{w.pick('product')}", None), None),
+        "GET /products/search?match=name": ("read", 2, lambda: ("GET", f"/products/search?match=name&limit=10&q=product-{w.pick('product')}", None), None),
+        "GET /product/company/<id>": ("read", 6, lambda: ("GET", f"/product/company/{w.pick('company')}", None), None),
+        "GET /product/<id>": ("read", 30, lambda: ("GET", f"/product/{w.pick('product')}", None), None),
+        "GET /product/<id>/categories": ("read", 4, lambda: ("GET", f"/product/{w.pick('product')}/categories", None), None),
+        "GET /warranty/<id>": ("read", 6, lambda: ("GET", f"/warranty/{w.pick('warranty')}", None), None),
+        "GET /stats": ("read", 1, lambda: ("GET", "/stats", None), None),
+        "GET /stats/companies": ("read", 1, lambda: ("GET", "/stats/companies?sort=-product_count&limit=20", None), None),
+        "GET /stats/categories": ("read", 1, lambda: ("GET", "/stats/categories?sort=-product_count&limit=20", None), None),
+        "GET /changes": ("read", 1, changes, changes_read),
+        "GET /cache/stats": ("read", 1, lambda: ("GET", "/cache/stats", None), None),
+
+        "PUT /company/<id>": ("write", 1, lambda: ("PUT", f"/company/{w.pick('company')}", {"active": w.rng.random() < 0.95}), None),
+        "PUT /category/<id>": ("write", 1, lambda: ("PUT", f"/category/{w.pick('category')}", {"category_name": w.unique("category")}), None),
+        "PUT /product/<id>": ("write", 4, lambda: ("PUT", f"/product/{w.pick('product')}", {"price": f"{w.rng.uniform(1, 1000):.2f}"}), None),
+        "PUT /warranty/<id>": ("write", 1, lambda: ("PUT", f"/warranty/{w.pick('warranty')}", {"warranty_months": w.rng.randint(1, 600)}), None),
+        "PATCH /companies": ("write", 1, lambda: ("PATCH", "/companies", {"ids": [w.pick("company") for _ in range(5)], "active": True}), None),
+        "PATCH /categories": ("write", 1, lambda: ("PATCH", "/categories", {"ids": [w.pick("category")], "category_name": w.unique("category")}), None),
+        "PATCH /products": ("write", 1, lambda: ("PATCH", "/products", {"ids": [w.pick("product") for _ in range(10)], "description": "bench"}), None),
+        "PATCH /warranties": ("write", 1, lambda: ("PATCH", "/warranties", {"ids": [w.pick("warranty") for _ in range(10)], "warranty_months": 24}), None),
+
+        "DELETE /company/delete/<id>": ("write", 1, delete("company", "/company/delete/{}"), None),
+        "DELETE /category/delete/<id>": ("write", 1, delete("category", "/category/delete/{}"), None),
+        "DELETE /product/delete/<id>": ("write", 2, delete("product", "/product/delete/{}"), None),
+        "DELETE /warranty/delete/<id>": ("write", 1, delete("warranty", "/warranty/delete/{}"), None),
+    }
+
+
+mixes = {
+    "read-only": {"read": 1.0, "write": 0.0},
+    "read-heavy": {"read": 0.95, "write": 0.05},
+    "balanced": {"read": 0.7, "write": 0.3},
+    "write-heavy": {"read": 0.3, "write": 0.7},
+}
+
+
+def weighted_plan(ops, mix, only=None):
+    totals = {"read": 0, "write": 0}
+
+    for name, (kind, weight, build, callback) in ops.items():
+        if only is None or name in only:
+            totals[kind] += weight
+
+    names = []
+    weights = []
+
+    for name, (kind, weight, build, callback) in ops.items():
+        if (only is None or name in only) and totals[kind] and mixes[mix][kind]:
+            names.append(name)
+            weights.append(mixes[mix][kind] * weight / totals[kind])
+
+    return names, weights
+
+
+# CLIENTS
+
+class HttpClient:
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.conn = None
+
+    def request(self, method, path, body):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+
+        headers = {}
+        data = None
+
+        if body is not None:
+            data = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+
+        try:
+            self.conn.request(method, path, body=data, headers=headers)
+            response = self.conn.getresponse()
+            payload = response.read()
+        except (http.client.HTTPException, OSError):
+            self.conn.close()
+            self.conn = None
+            raise
+
+        return response.status, payload
+
+
+class InProcessClient:
+    def __init__(self):
+        from app import app
+
+        self.client = app.test_client()
+
+    def request(self, method, path, body):
+        response = self.client.open(path, method=method, json=body)
+        return response.status_code, response.get_data()
+
+
+# RUN
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.statuses = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, status):
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+            statuses = self.statuses.setdefault(name, {})
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+            if status is None or status >= 500:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+
+    # Nearest-rank percentile.
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    total = 0
+    errors = 0
+
+    for name, samples in sorted(recorder.samples.items()):
+        samples = sorted(samples)
+        total += len(samples)
+        errors += recorder.errors.get(name, 0)
+
+        endpoints[name] = {
+            "count": len(samples),
+            "errors": recorder.errors.get(name, 0),
+            "statuses": recorder.statuses.get(name, {}),
+            "throughput": len(samples) / elapsed if elapsed else 0.0,
+            "mean_ms": 1000 * sum(samples) / len(samples),
+            "p50_ms": 1000 * percentile(samples, 0.50),
+            "p95_ms": 1000 * percentile(samples, 0.95),
+            "p99_ms": 1000 * percentile(samples, 0.99),
+            "max_ms": 1000 * samples[-1],
+        }
+
+    return {
+        "requests": total,
+        "errors": errors,
+        "elapsed_s": elapsed,
+        "throughput": total / elapsed if elapsed else 0.0,
+        "endpoints": endpoints,
+    }
+
+
+def run(make_client, sizes, mix="balanced", concurrency=8, duration=30.0, warmup=5.0, requests=None, only=None, seed_value=42):
+    workload = Workload(sizes, random.Random(seed_value))
+    ops = operations(workload)
+    names, weights = weighted_plan(ops, mix, only)
+
+    if not names:
+        raise SystemExit("no routes selected for this mix")
+
+    recorder = Recorder()
+    started = time.monotonic()
+    measure_from = started + warmup
+    deadline = measure_from + duration
+    remaining = [requests]
+    remaining_lock = threading.Lock()
+
+    def take_ticket():
+        if requests is None:
+            return time.monotonic() < deadline
+
+        with remaining_lock:
+            if remaining[0] <= 0:
+                return False
+
+            remaining[0] -= 1
+            return True
+
+    def worker(worker_id):
+        client = make_client()
+        rng = random.Random(seed_value + worker_id)
+
+        while take_ticket():
+            name = rng.choices(names, weights)[0]
+            kind, weight, build, callback = ops[name]
+            method, path, body = build()
+
+            start = time.perf_counter()
+
+            try:
+                status, payload = client.request(method, path, body)
+            except Exception:
+                status, payload = None, b""
+
+            seconds = time.perf_counter() - start
+
+            if callback is not None and status is not None and status < 300:
+                try:
+                    callback(json.loads(payload))
+                except ValueError:
+                    pass
+
+            if requests is not None or time.monotonic() >= measure_from:
+                recorder.record(name, seconds, status)
+
+    threads = [threading.Thread(target=worker, args=(index,), daemon=True) for index in range(concurrency)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.monotonic() - (started if requests is not None else measure_from)
+
+    return summarize(recorder, elapsed)
+
+
+def dataset_sizes(conn):
+    cursor = conn.cursor()
+    sizes = {}
+
+    for table, name, key in [
+        ("company", "Companies", "company_id"),
+        ("category", "Categories", "category_id"),
+        ("product", "Products", "product_id"),
+        ("warranty", "Warranties", "warranty_id"),
+    ]:
+        cursor.execute(f"SELECT coalesce(max({key}), 1) FROM {name};")
+        sizes[table] = cursor.fetchone()[0]
+
+    conn.rollback()
+
+    return sizes
+
+
+# COMPARE
+
+def compare(baseline, candidate, metric="p95_ms", threshold=0.10):
+    rows = []
+    regressed = False
+
+    for name, before in sorted(baseline["endpoints"].items()):
+        after = candidate["endpoints"].get(name)
+
+        if after is None or not before[metric]:
+            continue
+
+        change = (after[metric] - before[metric]) / before[metric]
+        regressed = regressed or change > threshold
+        rows.append((name, before[metric], after[metric], change))
+
+    return rows, regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Seed a benchmark dataset and load test every route")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="reset the database and seed a dataset")
+    seed_parser.add_argument("--companies", type=int, default=100)
+    seed_parser.add_argument("--products", type=int, default=10000)
+    seed_parser.add_argument("--categories", type=int, default=50)
+    seed_parser.add_argument("--categories-per-product", type=int, default=2)
+    seed_parser.add_argument("--warranties-per-product", type=int, default=1)
+    seed_parser.add_argument("--seed", type=float, default=0.42, help="setseed() value, between -1 and 1")
+
+    run_parser = commands.add_parser("run", help="drive a mixed workload and report latency per endpoint")
+    run_parser.add_argument("--url", default=f"http://{app_host}:{app_port}")
+    run_parser.add_argument("--in-process", action="store_true", help="use the Flask test client instead of HTTP")
+    run_parser.add_argument("--mix", choices=sorted(mixes), default="balanced")
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--duration", type=float, default=30.0, help="measured seconds")
+    run_parser.add_argument("--warmup", type=float, default=5.0, help="unmeasured seconds before the run")
+    run_parser.add_argument("--requests", type=int, help="stop after this many requests instead of a duration")
+    run_parser.add_argument("--route", action="append", dest="routes", help="only run this route (repeatable), e.g. 'GET /product/<id>'")
+    run_parser.add_argument("--seed", type=int, default=42)
+    run_parser.add_argument("--output", help="write the JSON report here instead of stdout")
+
+    compare_parser = commands.add_parser("compare", help="compare two JSON reports")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--metric", default="p95_ms", choices=["mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"])
+    compare_parser.add_argument("--threshold", type=float, default=0.10, help="fail if any endpoint is this much slower")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "seed":
+        with db.connection() as conn:
+            seed(conn, args.companies, args.products, args.categories, args.categories_per_product, args.warranties_per_product, args.seed)
+        print("Dataset seeded!")
+
+    elif args.command == "run":
+        with db.connection() as conn:
+            sizes = dataset_sizes(conn)
+
+        if args.in_process:
+            make_client = InProcessClient
+        else:
+            make_client = lambda: HttpClient(args.url)
+
+        report = run(make_client, sizes, args.mix, args.concurrency, args.duration, args.warmup, args.requests, args.routes, args.seed)
+        report["config"] = {
+            "target": "in-process" if args.in_process else args.url,
+            "mix": args.mix,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "requests": args.requests,
+            "routes": args.routes,
+            "seed": args.seed,
+            "dataset": sizes,
+        }
+        report["started_at"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(output + "\n")
+        else:
+            print(output)
+
+    elif args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        with open(args.candidate) as f:
+            candidate = json.load(f)
+
+        rows, regressed = compare(baseline, candidate, args.metric, args.threshold)
+
+        for name, before, after, change in rows:
+            flag = "  REGRESSION" if change > args.threshold else ""
+            print(f"{name:<32} {before:9.2f} -> {after:9.2f} {args.metric} ({change:+.1%}){flag}")
+
+        sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import csv
+import io
+import json
+import os
+
+from flask import request
+from psycopg2.extras import execute_values
+
+bulk_max_rows = int(os.environ.get("BULK_MAX_ROWS", 50000))
+bulk_copy_threshold = int(os.environ.get("BULK_COPY_THRESHOLD", 1000))
+bulk_page_size = int(os.environ.get("BULK_PAGE_SIZE", 1000))
+
+
+class BulkError(Exception):
+    pass
+
+
+class BulkSpec:
+    def __init__(self, table, columns, types, required, conflict=(), id_column=None, defaults=None):
+        self.table = table
+        self.columns = columns
+        # SQL type of each column, for casting VALUES input the way an
+        # INSERT would.
+        self.types = types
+        self.required = required
+        self.conflict = conflict
+        self.id_column = id_column
+        self.defaults = defaults or {}
+
+
+company_spec = BulkSpec("Companies", ["company_name", "active"], ["VARCHAR", "BOOLEAN"], ["company_name"], ("company_name",), "company_id", {"active": True})
+category_spec = BulkSpec("Categories", ["category_name"], ["VARCHAR"], ["category_name"], ("category_name",), "category_id")
+product_spec = BulkSpec("Products", ["product_name", "company_id", "description", "price", "active"], ["VARCHAR", "INTEGER", "VARCHAR", "DECIMAL", "BOOLEAN"], ["product_name", "company_id"], ("product_name",), "product_id", {"active": True})
+warranty_spec = BulkSpec("Warranties", ["warranty_months", "product_id"], ["INTEGER", "INTEGER"], ["warranty_months", "product_id"], ("product_id", "warranty_months"), "warranty_id")
+xref_spec = BulkSpec("ProductsCategoriesXref", ["product_id", "category_id"], ["INTEGER", "INTEGER"], ["product_id", "category_id"], ("product_id", "category_id"))
+
+
+def _parse_ndjson(text):
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def _parse_csv(text):
+    return [dict(row) for row in csv.DictReader(io.StringIO(text))]
+
+
+def read_bulk_records():
+    # Accepts a JSON array, an NDJSON or CSV body, or either of those as a
+    # multipart file upload.
+    upload = next(iter(request.files.values()), None)
+
+    if upload is not None:
+        text = upload.read().decode("utf-8-sig")
+
+        if upload.filename.lower().endswith(".csv") or upload.mimetype == "text/csv":
+            records = _parse_csv(text)
+        else:
+            records = _parse_ndjson(text)
+
+    elif request.mimetype == "text/csv":
+        records = _parse_csv(request.get_data(as_text=True))
+
+    elif request.mimetype in ("application/x-ndjson", "application/jsonl"):
+        records = _parse_ndjson(request.get_data(as_text=True))
+
+    else:
+        records = request.get_json()
+
+    if not isinstance(records, list):
+        raise BulkError("expected a list of records")
+
+    if len(records) > bulk_max_rows:
+        raise BulkError(f"at most {bulk_max_rows} records per request")
+
+    return records
+
+
+def _clean(value):
+    if isinstance(value, str) and (value == '' or value.isspace()):
+        return None
+
+    return value
+
+
+def _validate(spec, records):
+    rows = []
+    results = [None] * len(records)
+
+    for index, record in enumerate(records):
+        if not isinstance(record, dict):
+            results[index] = {"index": index, "status": "invalid", "message": "record must be an object"}
+            continue
+
+        values = {}
+
+        for column in spec.columns:
+            value = _clean(record.get(column))
+            values[column] = spec.defaults.get(column) if value is None else value
+
+        missing = [column for column in spec.required if values[column] is None]
+
+        if missing:
+            results[index] = {"index": index, "status": "invalid", "message": f"{', '.join(missing)} is a required field"}
+            continue
+
+        rows.append((index, tuple(values[column] for column in spec.columns)))
+
+    return rows, results
+
+
+def _insert_sql(spec, source):
+    # Inserts source (the input rows with their bulk_index) in input order
+    # and returns (bulk_index, id) for every row that was inserted. Skipped
+    # conflicts return nothing, so inserted rows are joined back to their
+    # input row by the unique key, compared by Postgres (so "05", 5.0 and
+    # " 5" are the same id, as in the unique index). Of duplicates within
+    # the batch, the first one is the row inserted.
+    column_str = ", ".join(spec.columns)
+    id_str = f"inserted.{spec.id_column}" if spec.id_column else "NULL"
+    group_str = ", ".join(list(spec.conflict) + ([id_str] if spec.id_column else []))
+    key_str = ", ".join(spec.conflict)
+    returning = ", ".join(([spec.id_column] if spec.id_column else []) + list(spec.conflict))
+
+    return f"""
+        inserted AS (
+            INSERT INTO {spec.table}
+            ({column_str})
+            SELECT {column_str} FROM {source}
+            ORDER BY bulk_index
+            ON CONFLICT ({key_str}) DO NOTHING
+            RETURNING {returning}
+        )
+        SELECT min(source.bulk_index), {id_str}
+        FROM inserted
+        JOIN {source} AS source USING ({key_str})
+        GROUP BY {group_str};
+    """
+
+
+def _insert_values(cursor, spec, rows):
+    column_str = ", ".join(spec.columns)
+    template = "(" + ", ".join(f"%s::{column_type}" for column_type in spec.types) + ", %s)"
+
+    return execute_values(cursor, f"""
+        WITH input ({column_str}, bulk_index) AS (VALUES %s),
+        {_insert_sql(spec, "input")}
+        """,
+        [values + (index,) for index, values in rows],
+        template=template,
+        page_size=bulk_page_size,
+        fetch=True
+    )
+
+
+def _insert_copy(cursor, spec, rows):
+    # Large batches are COPY'd into a temporary staging table and moved
+    # across with a single INSERT ... SELECT, which still lets conflicts be
+    # skipped per row.
+    column_str = ", ".join(spec.columns)
+    stage = f"bulk_stage_{spec.table.lower()}"
+
+    cursor.execute(f"""
+        DROP TABLE IF EXISTS {stage};
+        CREATE TEMP TABLE {stage} ON COMMIT DROP AS
+            SELECT {column_str} FROM {spec.table} WITH NO DATA;
+        ALTER TABLE {stage} ADD COLUMN bulk_index INTEGER;
+    """)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    for index, values in rows:
+        writer.writerow(["" if value is None else value for value in values] + [index])
+
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {stage} ({column_str}, bulk_index) FROM STDIN WITH (FORMAT csv)", buffer)
+
+    cursor.execute(f"WITH {_insert_sql(spec, stage)}")
+
+    return cursor.fetchall()
+
+
+def bulk_insert(cursor, spec, records):
+    rows, results = _validate(spec, records)
+
+    if rows:
+        if len(rows) >= bulk_copy_threshold:
+            inserted = _insert_copy(cursor, spec, rows)
+        else:
+            inserted = _insert_values(cursor, spec, rows)
+
+        created = dict(inserted)
+
+        for index, values in rows:
+            if index not in created:
+                results[index] = {"index": index, "status": "conflict"}
+            else:
+                results[index] = {"index": index, "status": "created"}
+
+                if spec.id_column:
+                    results[index][spec.id_column] = created[index]
+
+    summary = {"created": 0, "conflict": 0, "invalid": 0}
+
+    for result in results:
+        summary[result["status"]] += 1
+
+    return summary, results
@@ -0,0 +1,299 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+cache_backend = os.environ.get("CACHE_BACKEND", "memory")
+cache_url = os.environ.get("CACHE_URL")
+cache_ttl = float(os.environ.get("CACHE_TTL", 60))
+cache_maxsize = int(os.environ.get("CACHE_MAXSIZE", 10000))
+cache_stampede_guard = os.environ.get("CACHE_STAMPEDE_GUARD", "true").lower() == "true"
+
+
+class LRUBackend:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None:
+                return None
+
+            expires, value = entry
+
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return value
+
+    def _set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def generation(self, table):
+        with self._lock:
+            return self._generations.get(table, 0)
+
+    def bump(self, table):
+        with self._lock:
+            self._generations[table] = self._generations.get(table, 0) + 1
+
+    def set_if_generation(self, key, value, table, generation):
+        with self._lock:
+            if self._generations.get(table, 0) == generation:
+                self._set(key, value)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._data if key.startswith(prefix)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisBackend:
+    # Shared across worker processes. Anything with the same get/setex/
+    # delete/scan_iter/incr/pipeline surface (e.g. fakeredis) can stand in
+    # for tests.
+    def __init__(self, client, ttl, namespace="psy_crud:"):
+        self.client = client
+        self.ttl = ttl
+        self.namespace = namespace
+
+    @classmethod
+    def from_url(cls, url, ttl):
+        if redis is None:
+            raise RuntimeError("CACHE_BACKEND=redis requires the redis package")
+
+        return cls(redis.Redis.from_url(url), ttl)
+
+    def get(self, key):
+        value = self.client.get(self.namespace + key)
+
+        if value is None:
+            return None
+
+        return json.loads(value)
+
+    def set(self, key, value):
+        self.client.setex(self.namespace + key, max(1, int(self.ttl)), json.dumps(value, default=str))
+
+    def _generation_key(self, table):
+        return f"{self.namespace}generations:{table}"
+
+    def generation(self, table):
+        return int(self.client.get(self._generation_key(table)) or 0)
+
+    def bump(self, table):
+        self.client.incr(self._generation_key(table))
+
+    def set_if_generation(self, key, value, table, generation):
+        # WATCH makes the check and the write one step: a bump in between
+        # aborts the write.
+        generation_key = self._generation_key(table)
+
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(generation_key)
+
+                if int(pipe.get(generation_key) or 0) != generation:
+                    return
+
+                pipe.multi()
+                pipe.setex(self.namespace + key, max(1, int(self.ttl)), json.dumps(value, default=str))
+                pipe.execute()
+
+            except redis.WatchError:
+                pass
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.namespace + key for key in keys])
+
+    def delete_prefix(self, prefix):
+        keys = list(self.client.scan_iter(match=self.namespace + prefix + "*"))
+
+        if keys:
+            self.client.delete(*keys)
+
+    def clear(self):
+        self.delete_prefix("")
+
+
+class ReadThroughCache:
+    def __init__(self, backend, stampede_guard=True):
+        self.backend = backend
+        self.stampede_guard = stampede_guard
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.invalidations = 0
+        self._stats_lock = threading.Lock()
+        self._load_locks = {}
+        self._load_locks_lock = threading.Lock()
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+        metrics.cache_events[name].inc()
+
+    def _load_lock(self, key):
+        with self._load_locks_lock:
+            return self._load_locks.setdefault(key, threading.Lock())
+
+    def get_or_load(self, key, loader):
+        value = self.backend.get(key)
+
+        if value is not None:
+            self._count("hits")
+            return value
+
+        self._count("misses")
+
+        if not self.stampede_guard:
+            return self._load(key, loader)
+
+        # Single flight: concurrent misses on one key wait for the first
+        # loader instead of all hitting the database.
+        lock = self._load_lock(key)
+
+        with lock:
+            value = self.backend.get(key)
+
+            if value is not None:
+                return value
+
+            try:
+                return self._load(key, loader)
+            finally:
+                with self._load_locks_lock:
+                    self._load_locks.pop(key, None)
+
+    def _load(self, key, loader):
+        # A write can commit and invalidate while the loader is still
+        # returning the row it read before; the table's generation moves on
+        # with every invalidation, so that stale row is not stored.
+        table = key.partition(":")[0]
+        generation = self.backend.generation(table)
+        value = loader()
+        self._count("loads")
+
+        # Misses (None) are not cached so a later insert is visible at once.
+        if value is not None:
+            self.backend.set_if_generation(key, value, table, generation)
+
+        return value
+
+    def prime(self, table, loader):
+        # Stores the (key, value) pairs loader returns ahead of any request,
+        # e.g. at warmup, on the same terms as a load.
+        generation = self.backend.generation(table)
+        items = loader()
+
+        for key, value in items:
+            self.backend.set_if_generation(key, value, table, generation)
+
+        return len(items)
+
+    def invalidate(self, table, *record_ids):
+        self._count("invalidations")
+        self.backend.bump(table)
+        self.backend.delete(*[record_key(table, record_id) for record_id in record_ids])
+
+    def invalidate_table(self, table):
+        self._count("invalidations")
+        self.backend.bump(table)
+        self.backend.delete_prefix(f"{table}:")
+
+    def stats(self):
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+
+            return {
+                "backend": type(self.backend).__name__,
+                "hits": self.hits,
+                "misses": self.misses,
+                "loads": self.loads,
+                "invalidations": self.invalidations,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class NullBackend:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def generation(self, table):
+        return 0
+
+    def bump(self, table):
+        pass
+
+    def set_if_generation(self, key, value, table, generation):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def delete_prefix(self, prefix):
+        pass
+
+    def clear(self):
+        pass
+
+
+def record_key(table, record_id):
+    record_id = str(record_id).strip()
+
+    if record_id.isdigit():
+        record_id = str(int(record_id))
+
+    return f"{table}:{record_id}"
+
+
+def create_cache():
+    if cache_backend == "redis":
+        backend = RedisBackend.from_url(cache_url, cache_ttl)
+    elif cache_backend == "none":
+        backend = NullBackend()
+    else:
+        backend = LRUBackend(cache_maxsize, cache_ttl)
+
+    return ReadThroughCache(backend, stampede_guard=cache_stampede_guard)
+
+
+cache = create_cache()
@@ -0,0 +1,163 @@
+import json
+import os
+import select
+import threading
+import time
+
+import psycopg2
+from flask import Response, request, stream_with_context
+
+import db
+import routes
+from schema import change_log
+
+# Delivery for the /changes feed (see migration 0010 for the outbox). One
+# LISTEN connection per process, outside the pool, wakes every waiting
+# long-poll and SSE request when a change commits; the waiting requests
+# hold no pooled connection. Waiters also re-read every poll_interval
+# seconds, for changes that were held back by a then still-running
+# transaction, or notifications missed while the listener reconnected.
+
+changes_page_size = int(os.environ.get("CHANGES_PAGE_SIZE", 500))
+changes_max_wait = float(os.environ.get("CHANGES_MAX_WAIT", 30))
+poll_interval = 5
+sse_heartbeat = 15
+channel = "catalog_changes"
+
+
+class ChangeListener:
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.version = 0
+        self._condition = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self._listen_loop, name="change-listener", daemon=True).start()
+
+    def _wake(self):
+        with self._condition:
+            self.version += 1
+            self._condition.notify_all()
+
+    def _listen_loop(self):
+        while True:
+            try:
+                self._listen()
+            except psycopg2.Error:
+                pass
+
+            # Whatever was missed while disconnected is picked up by the
+            # waiters' next read.
+            self._wake()
+            time.sleep(1)
+
+    def _listen(self):
+        conn = psycopg2.connect(self.dsn)
+
+        try:
+            conn.autocommit = True
+            conn.cursor().execute(f"LISTEN {channel};")
+
+            while True:
+                if select.select([conn], [], [], poll_interval) == ([], [], []):
+                    continue
+
+                conn.poll()
+
+                if conn.notifies:
+                    conn.notifies.clear()
+                    self._wake()
+
+        finally:
+            conn.close()
+
+    def wait(self, seen_version, timeout):
+        # Returns as soon as anything was notified after seen_version was
+        # read, so a change committed between a read and the wait is not
+        # slept through.
+        with self._condition:
+            return self._condition.wait_for(lambda: self.version != seen_version, timeout)
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def get_listener():
+    global _listener
+
+    if _listener is None:
+        with _listener_lock:
+            if _listener is None:
+                listener = ChangeListener(db.database_dsn)
+                listener.start()
+                _listener = listener
+
+    return _listener
+
+
+def read_changes(after, table_names):
+    with db.connection() as conn:
+        return db.run(routes.list_changes(after, table_names, changes_page_size), conn)
+
+
+def long_poll(after, table_names, wait):
+    # Answers as soon as there are changes after the cursor, or with an
+    # empty page once wait seconds have passed.
+    listener = get_listener()
+    deadline = time.monotonic() + wait
+
+    while True:
+        version = listener.version
+        reply = read_changes(after, table_names)
+        remaining = deadline - time.monotonic()
+
+        if reply.status != 200 or reply.rows or remaining <= 0:
+            return reply
+
+        listener.wait(version, min(poll_interval, remaining))
+
+
+def stream_changes(after, table_names):
+    # Server-Sent Events: one "change" event per change, its id the cursor
+    # to resume from (browsers send it back as Last-Event-ID on reconnect).
+    listener = get_listener()
+
+    def generate():
+        cursor = after
+        last_sent = time.monotonic()
+
+        while True:
+            version = listener.version
+            reply = read_changes(cursor, table_names)
+
+            if reply.status != 200:
+                yield f"event: error\ndata: {json.dumps(reply.body)}\n\n"
+                return
+
+            for row in reply.rows:
+                yield f"id: {routes.change_cursor(row)}\nevent: change\ndata: {change_log.to_json(row)}\n\n"
+
+            if reply.rows:
+                cursor = routes.decode_cursor(reply.body["next_after"])
+                last_sent = time.monotonic()
+
+                if len(reply.rows) == changes_page_size:
+                    continue
+
+            elif time.monotonic() - last_sent >= sse_heartbeat:
+                # A comment line, so proxies do not time the stream out.
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+
+            listener.wait(version, poll_interval)
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+
+    return response
+
+
+def sse_requested():
+    return request.args.get("stream") == "sse" or request.accept_mimetypes.best == "text/event-stream"
@@ -0,0 +1,150 @@
+import os
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Response compression for the Flask app, negotiated through
+# Accept-Encoding. Brotli is offered when the brotli package is installed,
+# gzip always. Bodies under COMPRESSION_MIN_SIZE bytes go out as they are,
+# since compressing them saves little and costs a round of CPU.
+#
+# Streamed listings (?stream=) are compressed chunk by chunk as they are
+# written, without buffering the whole body; the compressor is flushed
+# every stream_flush_size bytes of input, so a reading client still sees
+# rows arrive while the stream is running.
+
+compression_enabled = os.environ.get("COMPRESSION", "true").lower() == "true"
+compression_min_size = int(os.environ.get("COMPRESSION_MIN_SIZE", 1024))
+gzip_level = int(os.environ.get("COMPRESSION_GZIP_LEVEL", 6))
+brotli_quality = int(os.environ.get("COMPRESSION_BROTLI_QUALITY", 4))
+stream_flush_size = 64 * 1024
+
+compressible_types = {
+    "application/json",
+    "application/x-ndjson",
+    "text/plain",
+}
+
+
+class GzipStream:
+    def __init__(self):
+        # wbits 31: a gzip header and trailer around the deflate stream.
+        self._compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliStream:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=brotli_quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+def gzip_compress(data):
+    compressor = GzipStream()
+
+    return compressor.compress(data) + compressor.finish()
+
+
+def brotli_compress(data):
+    return brotli.compress(data, quality=brotli_quality)
+
+
+# In order of preference when the client accepts several equally.
+encodings = {}
+
+if brotli is not None:
+    encodings["br"] = (brotli_compress, BrotliStream)
+
+encodings["gzip"] = (gzip_compress, GzipStream)
+
+
+def choose_encoding():
+    return request.accept_encodings.best_match(list(encodings))
+
+
+def compress_stream(chunks, stream):
+    def generate():
+        pending = 0
+
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+
+                data = stream.compress(chunk)
+                pending += len(chunk)
+
+                if pending >= stream_flush_size:
+                    data += stream.flush()
+                    pending = 0
+
+                if data:
+                    yield data
+
+            yield stream.finish()
+
+        finally:
+            # Lets the wrapped generator release what it holds (e.g. the
+            # stream's pooled connection) when the client goes away early.
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    return generate()
+
+
+def after_request(response):
+    if not compression_enabled or response.mimetype not in compressible_types:
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    if response.status_code < 200 or response.status_code in (204, 304) or "Content-Encoding" in response.headers:
+        return response
+
+    encoding = choose_encoding()
+
+    if encoding is None:
+        return response
+
+    compress, stream = encodings[encoding]
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, stream())
+        response.headers.pop("Content-Length", None)
+
+    else:
+        data = response.get_data()
+
+        if len(data) < compression_min_size:
+            return response
+
+        response.set_data(compress(data))
+
+    response.headers["Content-Encoding"] = encoding
+
+    return response
+
+
+def init_app(app):
+    app.after_request(after_request)
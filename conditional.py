@@ -0,0 +1,98 @@
+import hashlib
+from functools import wraps
+
+from flask import Response, make_response, request
+
+import prepared
+import queries
+from db import get_db
+
+
+def get_table_versions(tables):
+    # A table's version changes whenever a transaction that wrote to it
+    # commits (see queries.table_versions), without writers ever waiting
+    # on each other to record it.
+    cursor = get_db().cursor()
+
+    prepared.execute(cursor, queries.table_versions(tables))
+
+    return cursor.fetchall()
+
+
+def make_validators(tables):
+    versions = get_table_versions(tables)
+
+    version_str = ",".join(f"{table_name}:{version}" for table_name, version, modified_at in versions)
+    etag = hashlib.blake2b(f"{request.full_path}|{version_str}".encode(), digest_size=12).hexdigest()
+
+    modified = [modified_at for table_name, version, modified_at in versions if modified_at is not None]
+    last_modified = max(modified).replace(microsecond=0) if modified else None
+
+    return etag, last_modified
+
+
+def is_not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    if request.if_modified_since and last_modified is not None:
+        return last_modified <= request.if_modified_since
+
+    return False
+
+
+def set_validators(response, etag, last_modified):
+    response.set_etag(etag, weak=True)
+
+    if last_modified is not None:
+        response.last_modified = last_modified
+
+    return response
+
+
+def conditional(*tables, related=None):
+    # Answers If-None-Match / If-Modified-Since with a 304 before the
+    # handler runs, so unchanged listings cost one version lookup and no
+    # serialization. related maps the query string to the extra tables the
+    # response depends on (embedded relations, filters on other tables).
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(*args, **kwargs):
+            depends_on = list(tables)
+
+            if related is not None:
+                depends_on += related(request.args)
+
+            etag, last_modified = make_validators(depends_on)
+
+            if is_not_modified(etag, last_modified):
+                return set_validators(Response(status=304), etag, last_modified)
+
+            response = make_response(handler(*args, **kwargs))
+
+            if response.status_code == 200:
+                set_validators(response, etag, last_modified)
+
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def conditional_on_body(handler):
+    # For the by-id reads, which come from the read cache: the ETag is a
+    # hash of the body being served, so a cache hit is answered (or turned
+    # into a 304) without touching the database, and a 304 always means
+    # the client has exactly what it would get now.
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        response = make_response(handler(*args, **kwargs))
+
+        if response.status_code == 200:
+            response.add_etag(weak=True)
+            response.make_conditional(request)
+
+        return response
+
+    return wrapper
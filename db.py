@@ -0,0 +1,488 @@
+import itertools
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from flask import current_app, g, jsonify, request
+
+import metrics
+import prepared
+from routes import QueryError
+
+database_name = os.environ.get("DATABASE_NAME")
+database_dsn = os.environ.get("DATABASE_DSN") or f"dbname={database_name}"
+# Read replicas, as libpq connection strings separated by ";". Empty means
+# everything goes to the primary.
+replica_dsns = [dsn.strip() for dsn in os.environ.get("DATABASE_REPLICA_DSNS", "").split(";") if dsn.strip()]
+replica_max_lag = float(os.environ.get("DB_REPLICA_MAX_LAG", 5))
+replica_check_interval = float(os.environ.get("DB_REPLICA_CHECK_INTERVAL", 5))
+# How long a replica check may take to connect, and then to run its query.
+replica_check_timeout = float(os.environ.get("DB_REPLICA_CHECK_TIMEOUT", 2))
+# How long after a write the same client keeps reading from the primary.
+# A replica is used only if its lag was under DB_REPLICA_MAX_LAG at the
+# last check, so this covers the lag plus the time between checks.
+read_your_writes_window = float(os.environ.get("DB_READ_YOUR_WRITES_WINDOW", replica_max_lag + replica_check_interval))
+read_your_writes_cookie = "db_read_primary_until"
+pool_min = int(os.environ.get("DB_POOL_MIN", 1))
+pool_max = int(os.environ.get("DB_POOL_MAX", 10))
+pool_timeout = float(os.environ.get("DB_POOL_TIMEOUT", 5))
+pool_healthcheck_age = float(os.environ.get("DB_POOL_HEALTHCHECK_AGE", 30))
+# Longest wait for a new connection to be established (libpq rounds
+# anything under 2 up to 2).
+connect_timeout = float(os.environ.get("DB_CONNECT_TIMEOUT", 5))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    # Up to maxconn connections. Returned connections stay open for reuse
+    # (with their prepared statements) however many there are; minconn of
+    # them are opened up front.
+    def __init__(self, dsn, minconn, maxconn, timeout=5, healthcheck_age=30, connect_timeout=5):
+        self.dsn = dsn
+        self.timeout = timeout
+        self.healthcheck_age = healthcheck_age
+        self.connect_timeout = connect_timeout
+        # Every checked-out connection holds a slot, so the semaphore caps
+        # the pool at maxconn and makes callers wait (up to timeout) for
+        # one. Idle connections are reused newest first.
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self._closed = False
+
+        for _ in range(minconn):
+            self._idle.append(self._connect(self.connect_timeout))
+
+    def _connect(self, timeout):
+        conn = psycopg2.connect(
+            self.dsn,
+            connect_timeout=math.ceil(timeout),
+            connection_factory=prepared.PreparingConnection,
+            cursor_factory=metrics.InstrumentedCursor,
+        )
+        self._last_used[id(conn)] = time.monotonic()
+
+        return conn
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+
+        if conn.get_transaction_status() == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+
+        # Only ping connections that have sat idle long enough for the
+        # server or a firewall to have dropped them.
+        if time.monotonic() - self._last_used.get(id(conn), 0) < self.healthcheck_age:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+
+        return True
+
+    def getconn(self):
+        start = time.perf_counter()
+
+        if not self._slots.acquire(timeout=self.timeout):
+            metrics.record_pool_wait(time.perf_counter() - start)
+            raise PoolTimeout(f"no database connection available after {self.timeout}s")
+
+        try:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+
+            if conn is not None and not self._is_healthy(conn):
+                self._discard(conn)
+                conn = None
+
+            if conn is None:
+                # Connecting counts against the caller's timeout too, so an
+                # unreachable server fails the checkout (an OperationalError)
+                # about when a full pool would have.
+                remaining = self.timeout - (time.perf_counter() - start)
+                conn = self._connect(min(self.connect_timeout, max(remaining, 1)))
+
+        except Exception:
+            self._slots.release()
+            raise
+
+        metrics.record_pool_wait(time.perf_counter() - start)
+
+        return conn
+
+    def putconn(self, conn):
+        try:
+            if not conn.closed and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+
+            with self._lock:
+                if conn.closed or self._closed:
+                    self._discard(conn)
+                else:
+                    self._last_used[id(conn)] = time.monotonic()
+                    self._idle.append(conn)
+
+        except psycopg2.Error:
+            self._discard(conn)
+
+        finally:
+            self._slots.release()
+
+    def _discard(self, conn):
+        self._last_used.pop(id(conn), None)
+
+        if not conn.closed:
+            conn.close()
+
+    def closeall(self):
+        # Connections still checked out are closed when they come back.
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+
+        for conn in idle:
+            self._discard(conn)
+
+
+# Receive and replay positions are equal once a replica has applied all
+# the WAL it has; only then is the last replay time not a measure of lag
+# (on an idle primary it just keeps growing). A server that is not in
+# recovery (e.g. a promoted replica) has no lag.
+replica_lag_sql = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END;
+"""
+
+
+class Replica:
+    def __init__(self, dsn, check_timeout):
+        self.dsn = dsn
+        self.check_timeout = check_timeout
+        self.pool = None
+        self.healthy = False
+        self.lag = None
+        self.error = None
+        self.checked_at = None
+        # Checks run on a connection of their own, so a replica whose pool
+        # is busy serving reads is not mistaken for an unreachable one.
+        self._check_conn = None
+
+    def _measure_lag(self):
+        if self._check_conn is None or self._check_conn.closed:
+            self._check_conn = psycopg2.connect(
+                self.dsn,
+                connect_timeout=math.ceil(self.check_timeout),
+                options=f"-c statement_timeout={int(self.check_timeout * 1000)}",
+            )
+            self._check_conn.autocommit = True
+
+        with self._check_conn.cursor() as cursor:
+            cursor.execute(replica_lag_sql)
+            return float(cursor.fetchone()[0])
+
+    def check(self):
+        try:
+            try:
+                self.lag = self._measure_lag()
+            except psycopg2.OperationalError:
+                # The check connection may have been dropped while idle;
+                # one retry on a new connection tells that from an outage.
+                self.close_check_conn()
+                self.lag = self._measure_lag()
+
+            # The pool connects pool_min connections up front, so it is only
+            # built once the replica is reachable.
+            if self.pool is None:
+                self.pool = ConnectionPool(
+                    self.dsn,
+                    pool_min,
+                    pool_max,
+                    timeout=pool_timeout,
+                    healthcheck_age=pool_healthcheck_age,
+                    connect_timeout=connect_timeout,
+                )
+
+            self.error = None
+            self.healthy = self.lag <= replica_max_lag
+            self.checked_at = time.monotonic()
+
+        except psycopg2.Error as e:
+            self.close_check_conn()
+            self.error = str(e)
+            self.healthy = False
+
+    def close_check_conn(self):
+        if self._check_conn is not None:
+            self._check_conn.close()
+            self._check_conn = None
+
+    def is_usable(self, max_age):
+        # A check that hangs (say, on a blackholed replica) never gets to
+        # mark the replica unhealthy, so a result older than max_age no
+        # longer counts.
+        return self.healthy and self.checked_at is not None and time.monotonic() - self.checked_at <= max_age
+
+    def to_dict(self):
+        return {"healthy": self.healthy, "lag": self.lag, "error": self.error}
+
+
+class ReplicaSet:
+    # Read replicas behind the read_only routes. Each replica's reachability
+    # and replication lag is checked by a background thread of its own, so
+    # a slow replica does not hold up the checks of the others; reads are
+    # spread round robin over the ones that are healthy and caught up.
+    def __init__(self, dsns, check_interval, check_timeout):
+        self.replicas = [Replica(dsn, check_timeout) for dsn in dsns]
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        # Successful checks finish about check_interval apart, plus however
+        # long each took.
+        self.max_check_age = check_interval + check_timeout
+        self._next = itertools.count()
+        self._closed = threading.Event()
+
+    def start(self):
+        first_checks = []
+
+        for index, replica in enumerate(self.replicas):
+            checked = threading.Event()
+            first_checks.append(checked)
+            threading.Thread(target=self._check_loop, args=(replica, checked), name=f"replica-check-{index}", daemon=True).start()
+
+        # Reads go to the primary until a replica has passed a check, so
+        # give the first round (a connect and a query) time to finish.
+        deadline = time.monotonic() + 2 * self.check_timeout
+
+        for checked in first_checks:
+            checked.wait(max(0, deadline - time.monotonic()))
+
+    def _check_loop(self, replica, checked):
+        replica.check()
+        checked.set()
+
+        while not self._closed.wait(self.check_interval):
+            replica.check()
+
+    def choose(self):
+        healthy = [replica for replica in self.replicas if replica.is_usable(self.max_check_age)]
+
+        if not healthy:
+            return None
+
+        return healthy[next(self._next) % len(healthy)]
+
+    def closeall(self):
+        self._closed.set()
+
+        for replica in self.replicas:
+            replica.close_check_conn()
+
+            if replica.pool is not None:
+                replica.pool.closeall()
+
+
+_pool = None
+_replicas = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    database_dsn,
+                    pool_min,
+                    pool_max,
+                    timeout=pool_timeout,
+                    healthcheck_age=pool_healthcheck_age,
+                    connect_timeout=connect_timeout,
+                )
+
+    return _pool
+
+
+def get_replicas():
+    global _replicas
+
+    if _replicas is None and replica_dsns:
+        with _pool_lock:
+            if _replicas is None:
+                replicas = ReplicaSet(replica_dsns, replica_check_interval, replica_check_timeout)
+                replicas.start()
+                _replicas = replicas
+
+    return _replicas
+
+
+def close_pool():
+    # Closes this process's pool; the next get_pool() opens a new one. The
+    # gunicorn arbiter calls it before forking (see serve.on_starting), so
+    # no worker inherits a connection (and its socket) from the parent.
+    global _pool, _replicas
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+        if _replicas is not None:
+            _replicas.closeall()
+            _replicas = None
+
+
+@contextmanager
+def connection(db_pool=None):
+    db_pool = db_pool or get_pool()
+    conn = db_pool.getconn()
+
+    try:
+        yield conn
+    finally:
+        db_pool.putconn(conn)
+
+
+def read_only(handler):
+    # Marks a view whose queries may be answered by a read replica.
+    handler.read_only = True
+
+    return handler
+
+
+def reading_own_writes():
+    try:
+        return float(request.cookies.get(read_your_writes_cookie, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def request_pool():
+    # The pool this request reads from: a healthy replica for read_only
+    # views, unless the client wrote something within the read-your-writes
+    # window; the primary otherwise.
+    replicas = get_replicas()
+
+    if replicas is None or reading_own_writes():
+        return get_pool()
+
+    view = current_app.view_functions.get(request.endpoint)
+
+    if not getattr(view, "read_only", False):
+        return get_pool()
+
+    replica = replicas.choose()
+
+    return replica.pool if replica is not None else get_pool()
+
+
+def get_db():
+    if "db_conn" not in g:
+        db_pool = request_pool()
+
+        try:
+            conn = db_pool.getconn()
+
+        except psycopg2.OperationalError:
+            # A replica went away since the last check; read from the
+            # primary rather than fail the request.
+            if db_pool is get_pool():
+                raise
+
+            db_pool = get_pool()
+            conn = db_pool.getconn()
+
+        g.db_pool = db_pool
+        g.db_conn = conn
+
+    return g.db_conn
+
+
+def fetch(cursor, fetch_mode):
+    if fetch_mode == "one":
+        return cursor.fetchone()
+
+    if fetch_mode == "all":
+        return cursor.fetchall()
+
+    return None
+
+
+def run(operation, conn=None):
+    # Drives a routes.* operation on one connection: every yielded query
+    # runs in the same transaction, which is committed once the operation
+    # returns its Reply (or rolled back, if the Reply asks for that).
+    conn = conn if conn is not None else get_db()
+    cursor = conn.cursor()
+
+    try:
+        query = next(operation)
+
+        while True:
+            try:
+                prepared.execute(cursor, query)
+                result = fetch(cursor, query.fetch)
+
+            except psycopg2.Error as e:
+                conn.rollback()
+                query = operation.throw(QueryError(str(e)))
+
+            else:
+                query = operation.send(result)
+
+    except StopIteration as stop:
+        if getattr(stop.value, "rollback", False):
+            conn.rollback()
+        else:
+            conn.commit()
+
+        return stop.value
+
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def close_db(exception=None):
+    conn = g.pop("db_conn", None)
+    db_pool = g.pop("db_pool", None)
+
+    if conn is not None:
+        db_pool.putconn(conn)
+
+
+def remember_write(response):
+    # After a successful write, the client's reads go to the primary until
+    # the replicas have caught up with it.
+    if replica_dsns and request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400:
+        until = time.time() + read_your_writes_window
+        response.set_cookie(read_your_writes_cookie, f"{until:.3f}", max_age=int(read_your_writes_window) + 1, httponly=True)
+
+    return response
+
+
+def handle_pool_timeout(e):
+    return jsonify({"message": "database is busy, try again", "Error": str(e)}), 503
+
+
+def init_app(app):
+    app.teardown_appcontext(close_db)
+    app.after_request(remember_write)
+    app.register_error_handler(PoolTimeout, handle_pool_timeout)
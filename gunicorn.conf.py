@@ -0,0 +1,22 @@
+import os
+
+import serve
+from cache import cache_backend
+
+# gunicorn -c gunicorn.conf.py; see serve.py for what the hooks do.
+
+wsgi_app = "app:app"
+bind = f"{os.environ.get('APP_HOST', '127.0.0.1')}:{os.environ.get('APP_PORT', 8086)}"
+# The memory cache is per process, so with it the default is one worker
+# (serve.on_starting refuses more).
+workers = int(os.environ.get("WEB_WORKERS", 1 if cache_backend == "memory" else os.cpu_count() or 1))
+# Requests block on the database, so each worker serves them from a pool
+# of threads; keep DB_POOL_MAX at least this large.
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 8))
+graceful_timeout = int(os.environ.get("WEB_DRAIN_TIMEOUT", 30))
+preload_app = True
+
+on_starting = serve.on_starting
+post_fork = serve.post_fork
+worker_exit = serve.worker_exit
@@ -0,0 +1,108 @@
+import hashlib
+import os
+
+from flask import Response, g, jsonify, request
+
+import db
+import routes
+
+# Idempotency-Key support for POST, PUT and PATCH. The first request with
+# a key claims it and its response (anything but a 5xx) is stored; a retry
+# with the same key and the same request gets the stored response back
+# without running the handler again. A retry that arrives while the first
+# request is still running gets a 409, and reusing a key for a different
+# request a 422. A 5xx, or a request that dies, frees the key for the
+# next retry.
+#
+# Entries live in the IdempotencyKeys table (migration 0011), so a retry
+# landing on another worker or after a restart still finds them.
+
+idempotency_ttl = int(os.environ.get("IDEMPOTENCY_TTL", 86400))
+# A claimed key with no stored response after this many seconds is taken
+# to belong to a request that died, and can be claimed again.
+idempotency_pending_timeout = int(os.environ.get("IDEMPOTENCY_PENDING_TIMEOUT", 60))
+max_key_length = 255
+header = "Idempotency-Key"
+methods = ("POST", "PUT", "PATCH")
+
+
+def request_hash():
+    digest = hashlib.blake2b(digest_size=16)
+
+    for part in (request.method.encode(), request.full_path.encode(), request.get_data(cache=True)):
+        digest.update(part)
+        digest.update(b"\0")
+
+    return digest.hexdigest()
+
+
+def before_request():
+    key = request.headers.get(header)
+
+    if request.method not in methods or not key:
+        return None
+
+    if len(key) > max_key_length:
+        return jsonify({"message": f"{header} can be at most {max_key_length} characters"}), 400
+
+    fingerprint = request_hash()
+    existing = db.run(routes.claim_idempotency_key(key, fingerprint, idempotency_ttl, idempotency_pending_timeout))
+
+    if existing is None:
+        g.idempotency_key = key
+        return None
+
+    stored_hash, status, content_type, body = existing
+
+    if stored_hash != fingerprint:
+        return jsonify({"message": f"{header} was already used for a different request"}), 422
+
+    if status is None:
+        return jsonify({"message": f"a request with this {header} is still in progress"}), 409
+
+    response = Response(bytes(body), status=status, content_type=content_type)
+    response.headers["Idempotent-Replayed"] = "true"
+
+    return response
+
+
+def after_request(response):
+    key = g.get("idempotency_key")
+
+    if key is None or response.status_code >= 500 or response.is_streamed:
+        return response
+
+    try:
+        db.run(routes.store_idempotent_response(key, response.status_code, response.content_type, response.get_data()))
+        g.idempotency_stored = True
+
+    except routes.QueryError:
+        # The write itself went through; without a stored response the key
+        # is released below and a retry runs the request again.
+        pass
+
+    return response
+
+
+def teardown_request(exception=None):
+    key = g.pop("idempotency_key", None)
+
+    if key is None or g.pop("idempotency_stored", False):
+        return
+
+    # Teardown runs before db.close_db returns the request's connection, so
+    # the key is released on that connection rather than on a second one
+    # waited for while holding the first. If the connection is gone, the
+    # claim lapses after idempotency_pending_timeout instead.
+    conn = db.get_db()
+
+    if not conn.closed:
+        db.run(routes.release_idempotency_key(key), conn)
+
+
+def init_app(app):
+    # Register after compression so the stored body is the uncompressed
+    # one (after_request hooks run last-registered first).
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
@@ -0,0 +1,304 @@
+import argparse
+import datetime
+import os
+import threading
+import time
+import uuid
+
+from flask import has_request_context
+
+import db
+import idempotency
+import routes
+from cache import cache
+from schema import companies, products, warranties
+
+# Long-running maintenance work that should not hold a request (or one
+# transaction) open. Each job runs in a daemon thread and checks its own
+# connections out of the pool. Its status and progress are saved to the
+# Jobs table (migration 0015) as it goes, so /jobs/<job_id> answers from
+# any worker.
+
+delete_chunk_size = int(os.environ.get("DELETE_CHUNK_SIZE", 1000))
+purge_batch_size = int(os.environ.get("PURGE_BATCH_SIZE", 1000))
+purge_batch_pause = float(os.environ.get("PURGE_BATCH_PAUSE", 0.1))
+# Local time window for the scheduled purge, e.g. "02:00-05:00". Empty
+# disables the scheduler; the purge can still be run by hand or from cron.
+purge_window = os.environ.get("PURGE_WINDOW", "")
+# Days of /changes history kept; older changes are pruned with the daily
+# purge.
+changes_retention_days = int(os.environ.get("CHANGES_RETENTION_DAYS", 7))
+# Seconds between refreshes of the /stats materialized views; 0 disables
+# the refresher (POST /stats/refresh still works).
+stats_refresh_interval = float(os.environ.get("STATS_REFRESH_INTERVAL", 300))
+max_finished_jobs = 100
+
+
+class Job:
+    def __init__(self, name, params):
+        self.job_id = uuid.uuid4().hex
+        self.name = name
+        self.params = params
+        self.status = "pending"
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "name": self.name,
+            "params": self.params,
+            "status": self.status,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+    def save(self):
+        operation = routes.save_job(self.to_dict(), max_finished_jobs)
+
+        # A request submitting a job saves it on its own connection, rather
+        # than wait for a second one while holding the first.
+        if has_request_context():
+            db.run(operation)
+            return
+
+        with db.connection() as conn:
+            db.run(operation, conn)
+
+
+def _run(job, target, args):
+    job.status = "running"
+    job.started_at = time.time()
+    job.save()
+
+    try:
+        job.result = target(job, *args)
+        job.status = "done"
+
+    except Exception as e:
+        job.error = str(e)
+        job.status = "failed"
+
+    finally:
+        job.finished_at = time.time()
+        job.save()
+
+
+def submit(name, target, *args, **params):
+    # The job is saved before its id is handed out, so the first poll of
+    # /jobs/<job_id> finds it.
+    job = Job(name, params)
+    job.save()
+
+    threading.Thread(target=_run, args=(job, target, args), name=f"job-{name}", daemon=True).start()
+
+    return job
+
+
+def delete_company_in_chunks(job, company_id, chunk_size=None):
+    # Products (and, by cascade, their warranties and category links) go in
+    # chunk_size slices, each its own short transaction, before the now
+    # empty company row is deleted.
+    chunk_size = chunk_size or delete_chunk_size
+    job.progress["products_deleted"] = 0
+
+    while True:
+        with db.connection() as conn:
+            deleted = db.run(routes.delete_company_products_chunk(company_id, chunk_size), conn)
+
+        job.progress["products_deleted"] += deleted
+        job.save()
+
+        if deleted:
+            cache.invalidate_table(products.name)
+            cache.invalidate_table(warranties.name)
+
+        if deleted < chunk_size:
+            break
+
+    with db.connection() as conn:
+        reply = db.run(routes.delete_company_by_id(company_id, hard=True), conn)
+
+    cache.invalidate(companies.name, company_id)
+
+    return reply.body
+
+
+def purge_archived(job, batch_size=None):
+    # Archived products go first, in small batches, so that by the time an
+    # archived company is deleted its cascade has little left to remove.
+    batch_size = batch_size or purge_batch_size
+
+    for schema in (products, companies):
+        job.progress[schema.name] = 0
+
+        while True:
+            with db.connection() as conn:
+                deleted = db.run(routes.purge_archived_chunk(schema, batch_size), conn)
+
+            job.progress[schema.name] += deleted
+            job.save()
+
+            if deleted:
+                for table in [schema.name] + routes.cascades.get(schema.name, []):
+                    cache.invalidate_table(table)
+
+            if deleted < batch_size:
+                break
+
+            time.sleep(purge_batch_pause)
+
+    return dict(job.progress)
+
+
+def prune_changes(job, retention_days=None, batch_size=None):
+    retention_days = retention_days if retention_days is not None else changes_retention_days
+    batch_size = batch_size or purge_batch_size
+    job.progress["changes"] = 0
+
+    while True:
+        with db.connection() as conn:
+            deleted = db.run(routes.prune_changes_chunk(retention_days, batch_size), conn)
+
+        job.progress["changes"] += deleted
+        job.save()
+
+        if deleted < batch_size:
+            break
+
+        time.sleep(purge_batch_pause)
+
+    with db.connection() as conn:
+        job.progress["table_writes"] = db.run(routes.prune_table_writes(retention_days), conn)
+
+    return dict(job.progress)
+
+
+def prune_idempotency_keys(job, ttl=None):
+    ttl = ttl if ttl is not None else idempotency.idempotency_ttl
+
+    with db.connection() as conn:
+        job.progress["idempotency_keys"] = db.run(routes.prune_idempotency_keys(ttl), conn)
+
+    return dict(job.progress)
+
+
+def refresh_stats(job):
+    with db.connection() as conn:
+        refreshed = db.run(routes.refresh_stats(), conn)
+
+    job.progress["refreshed"] = refreshed
+
+    return {"refreshed": refreshed}
+
+
+def parse_window(window):
+    start, end = (datetime.time.fromisoformat(part.strip()) for part in window.split("-"))
+
+    return start, end
+
+
+def in_window(window, now):
+    start, end = parse_window(window)
+
+    if start <= end:
+        return start <= now < end
+
+    # The window wraps past midnight, e.g. "22:00-04:00".
+    return now >= start or now < end
+
+
+def _purge_scheduler(window, check_interval):
+    last_run = None
+
+    while True:
+        now = datetime.datetime.now()
+
+        if in_window(window, now.time()) and last_run != now.date():
+            last_run = now.date()
+            submit("purge_archived", purge_archived)
+            submit("prune_changes", prune_changes)
+            submit("prune_idempotency_keys", prune_idempotency_keys)
+
+        time.sleep(check_interval)
+
+
+def start_purge_scheduler(window=None, check_interval=60):
+    # Submits one purge job per day, the first time the clock is inside the
+    # window. Each serving process that calls this runs its own scheduler,
+    # so call it from one process only.
+    window = window if window is not None else purge_window
+
+    if not window:
+        return None
+
+    parse_window(window)
+
+    thread = threading.Thread(target=_purge_scheduler, args=(window, check_interval), name="purge-scheduler", daemon=True)
+    thread.start()
+
+    return thread
+
+
+def _stats_refresher(interval):
+    while True:
+        time.sleep(interval)
+        submit("refresh_stats", refresh_stats)
+
+
+def start_stats_refresher(interval=None):
+    # Refreshes are serialized by an advisory lock (see
+    # routes.refresh_stats), so several processes running this only cost
+    # the skipped attempts.
+    interval = interval if interval is not None else stats_refresh_interval
+
+    if interval <= 0:
+        return None
+
+    thread = threading.Thread(target=_stats_refresher, args=(interval,), name="stats-refresher", daemon=True)
+    thread.start()
+
+    return thread
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintenance jobs")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    purge = commands.add_parser("purge", help="physically delete archived products and companies")
+    purge.add_argument("--batch-size", type=int, default=purge_batch_size)
+
+    prune = commands.add_parser("prune-changes", help="delete /changes history older than the retention")
+    prune.add_argument("--retention-days", type=int, default=changes_retention_days)
+
+    commands.add_parser("refresh-stats", help="refresh the /stats materialized views")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "purge":
+        job = Job("purge_archived", {"batch_size": args.batch_size})
+        _run(job, purge_archived, (args.batch_size,))
+
+    elif args.command == "prune-changes":
+        job = Job("prune_changes", {"retention_days": args.retention_days})
+        _run(job, prune_changes, (args.retention_days,))
+
+    elif args.command == "refresh-stats":
+        job = Job("refresh_stats", {})
+        _run(job, refresh_stats, ())
+
+    # Run in the foreground, but saved like any other job.
+    if job.status == "failed":
+        raise SystemExit(job.error)
+
+    print(job.result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from flask import Response, g, has_request_context, request
+from psycopg2.extensions import cursor as base_cursor
+
+slow_query_ms = float(os.environ.get("SLOW_QUERY_MS", 200))
+server_timing = os.environ.get("SERVER_TIMING", "false").lower() == "true"
+# Seconds between the snapshots each worker writes when metrics are shared
+# across processes (see share_across_processes).
+snapshot_interval = float(os.environ.get("METRICS_SNAPSHOT_INTERVAL", 5))
+
+slow_query_log = logging.getLogger("psy_crud.slow_query")
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=None):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def state(self):
+        with self._lock:
+            return dict(self._values)
+
+    def dump(self):
+        return [[list(labels), value] for labels, value in self.state().items()]
+
+    def merge(self, state, dumped):
+        for labels, value in dumped:
+            labels = tuple(labels)
+            state[labels] = state.get(labels, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self, state=None):
+        state = self.state() if state is None else state
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+
+        # An unlabelled counter has one series, shown from zero.
+        if not state and not self.label_names:
+            state = {(): 0}
+
+        for labels, value in sorted(state.items()):
+            lines.append(f"{self.name}{format_labels(self.label_names, labels)} {value}")
+
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=default_buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+
+            series[1] += value
+            series[2] += 1
+
+    def state(self):
+        with self._lock:
+            return {labels: [list(bucket_counts), total, count] for labels, (bucket_counts, total, count) in self._series.items()}
+
+    def dump(self):
+        return [[list(labels), series] for labels, series in self.state().items()]
+
+    def merge(self, state, dumped):
+        for labels, (bucket_counts, total, count) in dumped:
+            series = state.setdefault(tuple(labels), [[0] * len(self.buckets), 0.0, 0])
+            series[0] = [mine + theirs for mine, theirs in zip(series[0], bucket_counts)]
+            series[1] += total
+            series[2] += count
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self, state=None):
+        state = self.state() if state is None else state
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+
+        for labels, (bucket_counts, total, count) in sorted(state.items()):
+            cumulative = 0
+
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                le = format_labels(self.label_names, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+
+            le = format_labels(self.label_names, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {count}")
+
+        return lines
+
+
+http_requests = Counter("psy_crud_http_requests_total", "HTTP requests handled.", ("route", "method", "status"))
+http_duration = Histogram("psy_crud_http_request_duration_seconds", "HTTP request latency.", ("route", "method"))
+db_queries = Counter("psy_crud_db_queries_total", "SQL statements executed.", ("route", "statement"))
+db_duration = Histogram("psy_crud_db_query_duration_seconds", "SQL statement latency.", ("route", "statement"))
+db_rows = Counter("psy_crud_db_rows_total", "Rows returned or affected by SQL statements.", ("route", "statement"))
+db_errors = Counter("psy_crud_db_errors_total", "SQL statements that raised.", ("route", "statement"))
+db_slow_queries = Counter("psy_crud_db_slow_queries_total", "SQL statements slower than SLOW_QUERY_MS.", ("route", "statement"))
+pool_wait = Histogram("psy_crud_db_pool_wait_seconds", "Time spent waiting to check a connection out of the pool.")
+# Counted by cache.ReadThroughCache alongside its own /cache/stats counters.
+cache_events = {name: Counter(f"psy_crud_cache_{name}_total", f"Read cache {name}.") for name in ("hits", "misses", "loads", "invalidations")}
+
+registry = [http_requests, http_duration, db_queries, db_duration, db_rows, db_errors, db_slow_queries, pool_wait] + list(cache_events.values())
+
+
+table_pattern = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+(\w+)", re.IGNORECASE)
+
+# Labels for prepared statements by name, filled in by prepared.Statement,
+# so "EXECUTE stmt_..." is counted under the statement it runs.
+statement_labels = {}
+
+
+def statement_label(sql):
+    # "<verb> <table>" keeps the label set small no matter how the SQL is
+    # parameterised, e.g. "SELECT products" or "UPDATE warranties".
+    if isinstance(sql, bytes):
+        sql = sql.decode("utf-8", "replace")
+
+    sql = "\n".join(line for line in sql.splitlines() if not line.strip().startswith("--"))
+    words = sql.split()
+
+    if not words:
+        return "UNKNOWN"
+
+    if words[0].upper() == "EXECUTE" and len(words) > 1:
+        return statement_labels.get(words[1], "EXECUTE")
+
+    match = table_pattern.search(sql)
+
+    if match is None:
+        return words[0].upper()
+
+    return f"{words[0].upper()} {match.group(1).lower()}"
+
+
+def current_route():
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+
+    return "-"
+
+
+def record_query(sql, seconds, rowcount, failed=False):
+    route = current_route()
+    statement = statement_label(sql)
+
+    db_queries.inc(route, statement)
+    db_duration.observe(seconds, route, statement)
+
+    if rowcount is not None and rowcount >= 0:
+        db_rows.inc(route, statement, amount=rowcount)
+
+    if failed:
+        db_errors.inc(route, statement)
+
+    if seconds * 1000 >= slow_query_ms:
+        db_slow_queries.inc(route, statement)
+        slow_query_log.warning("slow query %.1fms route=%s statement=%s sql=%s", seconds * 1000, route, statement, " ".join(str(sql).split())[:500])
+
+    if has_request_context():
+        g.db_time = g.get("db_time", 0.0) + seconds
+        g.db_count = g.get("db_count", 0) + 1
+
+
+def record_pool_wait(seconds):
+    pool_wait.observe(seconds)
+
+    if has_request_context():
+        g.pool_wait = g.get("pool_wait", 0.0) + seconds
+
+
+class InstrumentedCursor(base_cursor):
+    # Passed as cursor_factory to the pool, so every statement on a pooled
+    # connection (route queries, bulk loads, streams) is timed.
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+
+        try:
+            result = super().execute(query, vars)
+        except Exception:
+            record_query(query, time.perf_counter() - start, None, failed=True)
+            raise
+
+        record_query(query, time.perf_counter() - start, self.rowcount)
+
+        return result
+
+
+def before_request():
+    g.request_start = time.perf_counter()
+
+
+def after_request(response):
+    start = g.get("request_start")
+
+    if start is None:
+        return response
+
+    seconds = time.perf_counter() - start
+    route = current_route()
+
+    http_requests.inc(route, request.method, str(response.status_code))
+    http_duration.observe(seconds, route, request.method)
+
+    if server_timing:
+        response.headers["Server-Timing"] = ", ".join([
+            f'db;dur={g.get("db_time", 0.0) * 1000:.2f};desc="{g.get("db_count", 0)} queries"',
+            f'pool;dur={g.get("pool_wait", 0.0) * 1000:.2f}',
+            f'app;dur={seconds * 1000:.2f}',
+        ])
+
+    return response
+
+
+def sample(name, kind, help_text, value):
+    # One unlabelled sample for values owned elsewhere.
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+
+
+# Under gunicorn each worker counts for itself, and a scrape reaches one of
+# them. With metrics shared, every worker writes a snapshot of its metrics
+# to shared_dir every snapshot_interval seconds (and when it exits), and
+# /metrics adds the other workers' latest snapshots to its own counts. So
+# the other workers' share is up to snapshot_interval old, and a worker that
+# is killed outright loses what it counted since its last snapshot. The
+# snapshots of workers that have exited are kept, so totals never go down.
+shared_dir = None
+
+
+def share_across_processes(path):
+    # Called before the workers are forked, with a directory only this
+    # server uses; snapshots left by a previous run are removed.
+    global shared_dir
+
+    os.makedirs(path, exist_ok=True)
+
+    for name in os.listdir(path):
+        if name.endswith(".json"):
+            os.remove(os.path.join(path, name))
+
+    shared_dir = path
+
+
+def reset():
+    # For a forked worker, which would otherwise also report what the
+    # parent counted before the fork.
+    for metric in registry:
+        metric.reset()
+
+
+def write_snapshot():
+    if shared_dir is None:
+        return
+
+    path = os.path.join(shared_dir, f"{os.getpid()}.json")
+
+    with open(path + ".tmp", "w") as snapshot:
+        json.dump({metric.name: metric.dump() for metric in registry}, snapshot)
+
+    os.replace(path + ".tmp", path)
+
+
+def _snapshot_loop(interval):
+    while True:
+        time.sleep(interval)
+        write_snapshot()
+
+
+def start_snapshots(interval=None):
+    interval = interval if interval is not None else snapshot_interval
+
+    if shared_dir is None or interval <= 0:
+        return None
+
+    thread = threading.Thread(target=_snapshot_loop, args=(interval,), name="metrics-snapshot", daemon=True)
+    thread.start()
+
+    return thread
+
+
+def collect():
+    states = {metric.name: metric.state() for metric in registry}
+
+    if shared_dir is None:
+        return states
+
+    own = f"{os.getpid()}.json"
+
+    for name in os.listdir(shared_dir):
+        if not name.endswith(".json") or name == own:
+            continue
+
+        try:
+            with open(os.path.join(shared_dir, name)) as snapshot:
+                dumped = json.load(snapshot)
+        except (OSError, ValueError):
+            continue
+
+        for metric in registry:
+            metric.merge(states[metric.name], dumped.get(metric.name, []))
+
+    return states
+
+
+def render():
+    states = collect()
+    lines = []
+
+    for metric in registry:
+        lines += metric.render(states[metric.name])
+
+    hits = sum(states[cache_events["hits"].name].values())
+    lookups = hits + sum(states[cache_events["misses"].name].values())
+    lines += sample("psy_crud_cache_hit_ratio", "gauge", "Read cache hit ratio.", hits / lookups if lookups else 0.0)
+
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app):
+    app.before_request(before_request)
+    app.after_request(after_request)
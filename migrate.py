@@ -0,0 +1,228 @@
+import argparse
+import os
+import re
+
+import db
+import queries
+import routes
+from schema import catalog_stats, categories, category_stats, change_log, companies, company_stats, products, warranties
+
+migrations_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Arbitrary key for pg_advisory_lock so two processes never migrate at once.
+migration_lock_id = 4815162342
+
+migration_file = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+
+class Migration:
+    def __init__(self, version, name, sql):
+        self.version = version
+        self.name = name
+        self.sql = sql
+        self.transactional = "-- migrate: no-transaction" not in sql
+
+    def statements(self):
+        # Only used for no-transaction migrations (CREATE INDEX CONCURRENTLY
+        # and friends), which have to be sent one statement at a time.
+        lines = [line for line in self.sql.splitlines() if not line.strip().startswith("--")]
+
+        return [statement.strip() for statement in "\n".join(lines).split(";") if statement.strip()]
+
+
+def load_migrations():
+    migrations = []
+
+    for filename in sorted(os.listdir(migrations_dir)):
+        match = migration_file.match(filename)
+
+        if not match:
+            continue
+
+        with open(os.path.join(migrations_dir, filename)) as f:
+            migrations.append(Migration(int(match.group(1)), match.group(2), f.read()))
+
+    return migrations
+
+
+def applied_versions(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS SchemaMigrations (
+        version INTEGER PRIMARY KEY,
+        name VARCHAR NOT NULL,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+
+    cursor.execute("SELECT version FROM SchemaMigrations;")
+
+    return {row[0] for row in cursor.fetchall()}
+
+
+def apply_migrations(conn, target=None, log=print):
+    conn.commit()
+    conn.autocommit = True
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT pg_advisory_lock(%s);", (migration_lock_id,))
+
+    try:
+        applied = applied_versions(cursor)
+        pending = [
+            migration for migration in load_migrations()
+            if migration.version not in applied and (target is None or migration.version <= target)
+        ]
+
+        for migration in pending:
+            log(f"Applying {migration.version:04d}_{migration.name}...")
+
+            if migration.transactional:
+                conn.autocommit = False
+
+                try:
+                    cursor.execute(migration.sql)
+                    cursor.execute("""
+                        INSERT INTO SchemaMigrations (version, name)
+                        VALUES (%s, %s);
+                    """, (migration.version, migration.name,))
+                    conn.commit()
+
+                except Exception:
+                    conn.rollback()
+                    raise
+
+                finally:
+                    conn.autocommit = True
+
+            else:
+                for statement in migration.statements():
+                    cursor.execute(statement)
+
+                cursor.execute("""
+                    INSERT INTO SchemaMigrations (version, name)
+                    VALUES (%s, %s);
+                """, (migration.version, migration.name,))
+
+        return pending
+
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%s);", (migration_lock_id,))
+        conn.autocommit = False
+
+
+def migration_status(conn):
+    cursor = conn.cursor()
+    applied = applied_versions(cursor)
+    conn.commit()
+
+    return [(migration, migration.version in applied) for migration in load_migrations()]
+
+
+def route_queries():
+    # One representative statement (with sample parameters) per route, built
+    # from the same queries module the routes use.
+    route_list = [
+        ("get_companies", queries.page(routes.parse_listing(companies, {}), 100)),
+        ("get_categories", queries.page(routes.parse_listing(categories, {}), 100)),
+        ("get_products", queries.page(routes.parse_listing(products, {}), 100)),
+        ("get_products?sort=-price", queries.page(routes.parse_listing(products, {"sort": "-price", "after": routes.encode_cursor("100", 1)}), 100)),
+        ("get_products?company_id&price_min&fields", queries.page(routes.parse_listing(products, {"company_id": "1,2", "price_min": "10", "fields": "product_name,price"}), 100)),
+        ("get_products?category_id", queries.page(routes.parse_listing(products, {"category_id": "1"}), 100)),
+        ("get_company_by_id", queries.by_id(companies, 1)),
+        ("get_category_by_id", queries.by_id(categories, 1)),
+        ("get_product_by_id", queries.by_id(products, 1)),
+        ("get_warranty_by_id", queries.by_id(warranties, 1)),
+        ("get_products_by_active", queries.page(routes.parse_listing(products, {}, {"active": True}), 100)),
+        ("get_products?active=false", queries.page(routes.parse_listing(products, {"active": "false"}), 100)),
+        ("get_products_by_company_id", queries.page(routes.parse_listing(products, {}, {"company_id": 1}), 100)),
+        ("search_products", queries.search_products(products, "red chair", 100)),
+        ("search_products [next page]", queries.search_products(products, "red chair", 100, (0.1, 1000))),
+        ("search_products?match=name", queries.typeahead_products(products, "cha", 10)),
+        ("get_product?include=company", queries.companies_by_ids([1, 2])),
+        ("get_product?include=categories", queries.categories_by_products([1, 2])),
+        ("get_product?include=warranties", queries.warranties_by_products([1, 2])),
+        ("get_stats", queries.by_id(catalog_stats, 1)),
+        ("get_company_stats?sort=-product_count", queries.page(routes.parse_listing(company_stats, {"sort": "-product_count"}), 100)),
+        ("get_category_stats_by_id", queries.by_id(category_stats, 1)),
+        ("get_changes", queries.changes_after(change_log, None, [], 500)),
+        ("get_changes?after&tables", queries.changes_after(change_log, (1000, 1000), ["products"], 500)),
+        ("add_company", queries.insert_company("explain")),
+        ("add_category", queries.insert_category("explain")),
+        ("add_product", queries.insert_product("explain", 1, None, None)),
+        ("add_warranty", queries.insert_warranty(1, 12)),
+        ("create_xref", queries.insert_xref(1, 1)),
+        ("update_product_by_id", queries.update_by_id(products, "price = %s", (1,), 1)),
+        ("update_products", queries.update_by_ids(products, "active = %s", (False,), [1, 2])),
+        ("delete_company_by_id", queries.archive_by_id(companies, 1)),
+        ("delete_product_by_id", queries.archive_by_id(products, 1)),
+        ("delete_company_by_id?mode=hard", queries.delete_by_id(companies, 1)),
+        ("delete_product_by_id?mode=hard", queries.delete_by_id(products, 1)),
+        ("delete_category_by_id", queries.delete_by_id(categories, 1)),
+        ("delete_warranty_by_id", queries.delete_by_id(warranties, 1)),
+        ("delete_products", queries.delete_by_ids(products, [1, 2])),
+        ("delete_company_by_id [chunked]", queries.delete_company_products_chunk(1, 1000)),
+        ("purge_archived [products]", queries.purge_archived_chunk(products, 1000)),
+        ("purge_archived [companies]", queries.purge_archived_chunk(companies, 1000)),
+        ("prune_changes", queries.prune_changes_chunk(7, 1000)),
+        ("prune_table_writes", queries.prune_table_writes(7)),
+        ("idempotency [claim]", queries.claim_idempotency_key("explain", "hash", 86400, 60)),
+        ("idempotency [replay]", queries.idempotency_key("explain")),
+        ("prune_idempotency_keys", queries.prune_idempotency_keys(86400)),
+        ("get_job", queries.job_by_id("explain")),
+        ("jobs [forget finished]", queries.forget_finished_jobs(100)),
+    ]
+
+    return [(route, " ".join(query.sql.split()), query.params) for route, query in route_list]
+
+
+def explain_routes(conn, analyze=False):
+    cursor = conn.cursor()
+    options = "ANALYZE, BUFFERS" if analyze else "COSTS"
+    plans = []
+
+    # Everything runs in one transaction that is always rolled back, so
+    # EXPLAIN ANALYZE on the write statements leaves no trace.
+    try:
+        for route, sql, params in route_queries():
+            cursor.execute(f"EXPLAIN ({options}) {sql}", params)
+            plans.append((route, sql, [row[0] for row in cursor.fetchall()]))
+
+    finally:
+        conn.rollback()
+
+    return plans
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Schema migrations and query plans")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    upgrade = commands.add_parser("upgrade", help="apply pending migrations")
+    upgrade.add_argument("--target", type=int, help="stop after this migration version")
+
+    commands.add_parser("status", help="list migrations and whether they are applied")
+
+    explain = commands.add_parser("explain", help="show the query plan for every route query")
+    explain.add_argument("--analyze", action="store_true", help="run EXPLAIN ANALYZE (inside a rolled back transaction)")
+
+    args = parser.parse_args(argv)
+
+    with db.connection() as conn:
+        if args.command == "upgrade":
+            applied = apply_migrations(conn, args.target)
+            print(f"{len(applied)} migration(s) applied")
+
+        elif args.command == "status":
+            for migration, applied in migration_status(conn):
+                print(f"[{'x' if applied else ' '}] {migration.version:04d}_{migration.name}")
+
+        elif args.command == "explain":
+            for route, sql, plan in explain_routes(conn, args.analyze):
+                print(f"== {route}")
+                print(sql)
+                print("\n".join(plan))
+                print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+-- Per-table version counters behind the ETag / Last-Modified validators.
+CREATE TABLE IF NOT EXISTS TableVersions (
+table_name VARCHAR PRIMARY KEY,
+version BIGINT NOT NULL DEFAULT 0,
+modified_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE TableVersions
+    SET version = version + 1, modified_at = now()
+    WHERE table_name = TG_TABLE_NAME;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+INSERT INTO TableVersions (table_name)
+VALUES ('companies'), ('products'), ('categories'), ('productscategoriesxref'), ('warranties')
+ON CONFLICT (table_name) DO NOTHING;
+
+DROP TRIGGER IF EXISTS companies_version ON Companies;
+CREATE TRIGGER companies_version
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON Companies
+FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+DROP TRIGGER IF EXISTS products_version ON Products;
+CREATE TRIGGER products_version
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON Products
+FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+DROP TRIGGER IF EXISTS categories_version ON Categories;
+CREATE TRIGGER categories_version
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON Categories
+FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+DROP TRIGGER IF EXISTS productscategoriesxref_version ON ProductsCategoriesXref;
+CREATE TRIGGER productscategoriesxref_version
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON ProductsCategoriesXref
+FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
+
+DROP TRIGGER IF EXISTS warranties_version ON Warranties;
+CREATE TRIGGER warranties_version
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON Warranties
+FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version();
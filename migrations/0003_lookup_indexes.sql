@@ -0,0 +1,12 @@
+-- migrate: no-transaction
+-- Indexes for the foreign-key lookups and cascading deletes, built
+-- CONCURRENTLY so applying them does not block writes on a live catalog.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS products_company_id_idx ON Products (company_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS warranties_product_id_idx ON Warranties (product_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS productscategoriesxref_category_id_idx ON ProductsCategoriesXref (category_id);
+
+-- Inactive products are the minority, so a partial index keeps
+-- active = false lookups off a full scan.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS products_inactive_idx ON Products (product_id) WHERE active = false;
@@ -0,0 +1,32 @@
+-- migrate: no-transaction
+-- Let the foreign keys do the dependent deletes, so deleting a company or
+-- product is one statement instead of a chain of IN (SELECT ...) deletes.
+-- Every cascade follows an index (see 0003), so it never scans a table.
+-- The constraints are re-added NOT VALID and validated in their own
+-- statements, so the validation scan runs under a SHARE UPDATE EXCLUSIVE
+-- lock instead of blocking writes. Every statement is safe to re-run.
+
+ALTER TABLE Products
+DROP CONSTRAINT IF EXISTS products_company_id_fkey,
+ADD CONSTRAINT products_company_id_fkey
+FOREIGN KEY (company_id) REFERENCES Companies(company_id) ON DELETE CASCADE NOT VALID;
+
+ALTER TABLE ProductsCategoriesXref
+DROP CONSTRAINT IF EXISTS productscategoriesxref_product_id_fkey,
+ADD CONSTRAINT productscategoriesxref_product_id_fkey
+FOREIGN KEY (product_id) REFERENCES Products(product_id) ON DELETE CASCADE NOT VALID;
+
+ALTER TABLE ProductsCategoriesXref
+DROP CONSTRAINT IF EXISTS productscategoriesxref_category_id_fkey,
+ADD CONSTRAINT productscategoriesxref_category_id_fkey
+FOREIGN KEY (category_id) REFERENCES Categories(category_id) ON DELETE CASCADE NOT VALID;
+
+ALTER TABLE Warranties
+DROP CONSTRAINT IF EXISTS warranties_product_id_fkey,
+ADD CONSTRAINT warranties_product_id_fkey
+FOREIGN KEY (product_id) REFERENCES Products(product_id) ON DELETE CASCADE NOT VALID;
+
+ALTER TABLE Products VALIDATE CONSTRAINT products_company_id_fkey;
+ALTER TABLE ProductsCategoriesXref VALIDATE CONSTRAINT productscategoriesxref_product_id_fkey;
+ALTER TABLE ProductsCategoriesXref VALIDATE CONSTRAINT productscategoriesxref_category_id_fkey;
+ALTER TABLE Warranties VALIDATE CONSTRAINT warranties_product_id_fkey;
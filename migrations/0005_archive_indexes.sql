@@ -0,0 +1,9 @@
+-- migrate: no-transaction
+-- Partial key indexes for the ?active= list filters and the purge job.
+-- Keyset pages over active rows walk only the active slice of the key,
+-- and the purge finds archived rows without scanning live ones (archived
+-- products already have products_inactive_idx from 0003).
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS companies_active_idx ON Companies (company_id) WHERE active;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS companies_inactive_idx ON Companies (company_id) WHERE active = false;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS products_active_idx ON Products (product_id) WHERE active;
@@ -0,0 +1,8 @@
+-- migrate: no-transaction
+-- Backs ?sort=price / ?sort=-price on product listings: the (price,
+-- product_id) pair is exactly the keyset order, so a sorted page is an
+-- index range scan for either direction. Name sorts use the UNIQUE
+-- indexes from 0001, and the company and category filters use the
+-- lookup indexes from 0003.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS products_price_idx ON Products (price, product_id);
@@ -0,0 +1,17 @@
+-- migrate: no-transaction
+-- Full-text search over product names (weight A) and descriptions
+-- (weight B) for /products/search. Postgres keeps the generated column in
+-- step with every write path (routes, bulk COPY, seeding), and the GIN
+-- index answers @@ queries without reading non-matching rows.
+--
+-- Adding a STORED generated column rewrites Products under an ACCESS
+-- EXCLUSIVE lock; on a large live table apply this in a quiet window.
+
+ALTER TABLE Products
+ADD COLUMN IF NOT EXISTS search_vector tsvector
+GENERATED ALWAYS AS (
+    setweight(to_tsvector('english', coalesce(product_name, '')), 'A') ||
+    setweight(to_tsvector('english', coalesce(description, '')), 'B')
+) STORED;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS products_search_idx ON Products USING GIN (search_vector);
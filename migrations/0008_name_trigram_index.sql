@@ -0,0 +1,20 @@
+-- Trigram index for name typeahead (/products/search?match=name), which
+-- filters with product_name ILIKE '%...%'. pg_trgm ships with contrib but
+-- is not installed everywhere, so this is skipped where it is missing and
+-- typeahead falls back to a scan. It runs inside the migration's
+-- transaction, so the index is not built CONCURRENTLY; on a large table
+-- create it by hand first:
+--
+--     CREATE INDEX CONCURRENTLY products_name_trgm_idx
+--     ON Products USING GIN (product_name gin_trgm_ops);
+
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS products_name_trgm_idx ON Products USING GIN (product_name gin_trgm_ops);
+    ELSE
+        RAISE NOTICE 'pg_trgm is not available, skipping products_name_trgm_idx';
+    END IF;
+END
+$$;
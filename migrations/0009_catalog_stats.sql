@@ -0,0 +1,83 @@
+-- Precomputed catalog statistics for /stats. The aggregates are read from
+-- materialized views instead of scanning Products on every poll; the
+-- stats refresher (jobs.refresh_stats) rebuilds them with REFRESH
+-- MATERIALIZED VIEW CONCURRENTLY, which needs the unique indexes below
+-- and never blocks readers. Figures are as of refreshed_at.
+--
+-- A product counts as warranted when it has at least one warranty.
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS CompanyStats AS
+SELECT
+    Companies.company_id,
+    Companies.company_name,
+    count(Products.product_id) AS product_count,
+    count(Products.product_id) FILTER (WHERE Products.active) AS active_product_count,
+    round(avg(Products.price), 2) AS avg_price,
+    min(Products.price) AS min_price,
+    max(Products.price) AS max_price,
+    count(Products.product_id) FILTER (WHERE warranted.product_id IS NOT NULL) AS warranted_product_count,
+    coalesce(round(
+        count(Products.product_id) FILTER (WHERE warranted.product_id IS NOT NULL)::numeric
+        / nullif(count(Products.product_id), 0), 4
+    ), 0)::float8 AS warranty_coverage,
+    now() AS refreshed_at
+FROM Companies
+LEFT JOIN Products ON Products.company_id = Companies.company_id
+LEFT JOIN (SELECT DISTINCT product_id FROM Warranties) AS warranted ON warranted.product_id = Products.product_id
+GROUP BY Companies.company_id, Companies.company_name;
+
+CREATE UNIQUE INDEX IF NOT EXISTS companystats_company_id_idx ON CompanyStats (company_id);
+CREATE INDEX IF NOT EXISTS companystats_product_count_idx ON CompanyStats (product_count, company_id);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS CategoryStats AS
+SELECT
+    Categories.category_id,
+    Categories.category_name,
+    count(Products.product_id) AS product_count,
+    count(Products.product_id) FILTER (WHERE Products.active) AS active_product_count,
+    round(avg(Products.price), 2) AS avg_price,
+    min(Products.price) AS min_price,
+    max(Products.price) AS max_price,
+    count(Products.product_id) FILTER (WHERE warranted.product_id IS NOT NULL) AS warranted_product_count,
+    coalesce(round(
+        count(Products.product_id) FILTER (WHERE warranted.product_id IS NOT NULL)::numeric
+        / nullif(count(Products.product_id), 0), 4
+    ), 0)::float8 AS warranty_coverage,
+    now() AS refreshed_at
+FROM Categories
+LEFT JOIN ProductsCategoriesXref ON ProductsCategoriesXref.category_id = Categories.category_id
+LEFT JOIN Products ON Products.product_id = ProductsCategoriesXref.product_id
+LEFT JOIN (SELECT DISTINCT product_id FROM Warranties) AS warranted ON warranted.product_id = Products.product_id
+GROUP BY Categories.category_id, Categories.category_name;
+
+CREATE UNIQUE INDEX IF NOT EXISTS categorystats_category_id_idx ON CategoryStats (category_id);
+CREATE INDEX IF NOT EXISTS categorystats_product_count_idx ON CategoryStats (product_count, category_id);
+
+-- One row for the whole catalog; stats_id is there for the unique index.
+CREATE MATERIALIZED VIEW IF NOT EXISTS CatalogStats AS
+SELECT
+    1 AS stats_id,
+    (SELECT count(*) FROM Companies) AS company_count,
+    (SELECT count(*) FROM Categories) AS category_count,
+    (SELECT count(*) FROM Warranties) AS warranty_count,
+    count(Products.product_id) AS product_count,
+    count(Products.product_id) FILTER (WHERE Products.active) AS active_product_count,
+    round(avg(Products.price), 2) AS avg_price,
+    min(Products.price) AS min_price,
+    max(Products.price) AS max_price,
+    count(Products.product_id) FILTER (WHERE warranted.product_id IS NOT NULL) AS warranted_product_count,
+    coalesce(round(
+        count(Products.product_id) FILTER (WHERE warranted.product_id IS NOT NULL)::numeric
+        / nullif(count(Products.product_id), 0), 4
+    ), 0)::float8 AS warranty_coverage,
+    now() AS refreshed_at
+FROM Products
+LEFT JOIN (SELECT DISTINCT product_id FROM Warranties) AS warranted ON warranted.product_id = Products.product_id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS catalogstats_stats_id_idx ON CatalogStats (stats_id);
+
+-- The views share one version row, bumped by each refresh, so /stats
+-- answers conditional GETs like the table routes do.
+INSERT INTO TableVersions (table_name)
+VALUES ('catalogstats')
+ON CONFLICT (table_name) DO NOTHING;
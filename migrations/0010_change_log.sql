@@ -0,0 +1,77 @@
+-- Outbox for the /changes feed. A row trigger on every catalog table logs
+-- each insert, update and delete (whatever the write path: routes, bulk
+-- COPY, batch, jobs) in the same transaction as the change itself, and
+-- notifies catalog_changes listeners when it commits.
+--
+-- change_id comes from a sequence, so ids are not in commit order: a
+-- transaction can commit after a later id is already visible. The feed
+-- reads in (txid, change_id) order instead and only returns changes from
+-- transactions older than every transaction still running (the snapshot
+-- xmin); no new change can ever sort before those. A long-running writer
+-- therefore holds the feed back until it ends.
+
+CREATE TABLE IF NOT EXISTS ChangeLog (
+change_id BIGSERIAL PRIMARY KEY,
+txid BIGINT NOT NULL DEFAULT pg_current_xact_id()::text::bigint,
+table_name VARCHAR NOT NULL,
+operation VARCHAR NOT NULL,
+record_key JSONB NOT NULL,
+data JSONB NOT NULL,
+changed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS changelog_txid_idx ON ChangeLog (txid, change_id);
+CREATE INDEX IF NOT EXISTS changelog_changed_at_idx ON ChangeLog (changed_at);
+
+-- The trigger arguments name the table's key columns. data is the new
+-- row (the old one for deletes), without the generated search_vector.
+CREATE OR REPLACE FUNCTION record_change() RETURNS trigger AS $$
+DECLARE
+    row_data JSONB;
+    key_data JSONB := '{}'::jsonb;
+    key_column TEXT;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_data := to_jsonb(OLD) - 'search_vector';
+    ELSE
+        row_data := to_jsonb(NEW) - 'search_vector';
+    END IF;
+
+    FOREACH key_column IN ARRAY TG_ARGV LOOP
+        key_data := key_data || jsonb_build_object(key_column, row_data -> key_column);
+    END LOOP;
+
+    INSERT INTO ChangeLog (table_name, operation, record_key, data)
+    VALUES (TG_TABLE_NAME, TG_OP, key_data, row_data);
+
+    -- Identical notifications within a transaction are sent once.
+    PERFORM pg_notify('catalog_changes', TG_TABLE_NAME);
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS companies_change ON Companies;
+CREATE TRIGGER companies_change
+AFTER INSERT OR UPDATE OR DELETE ON Companies
+FOR EACH ROW EXECUTE FUNCTION record_change('company_id');
+
+DROP TRIGGER IF EXISTS products_change ON Products;
+CREATE TRIGGER products_change
+AFTER INSERT OR UPDATE OR DELETE ON Products
+FOR EACH ROW EXECUTE FUNCTION record_change('product_id');
+
+DROP TRIGGER IF EXISTS categories_change ON Categories;
+CREATE TRIGGER categories_change
+AFTER INSERT OR UPDATE OR DELETE ON Categories
+FOR EACH ROW EXECUTE FUNCTION record_change('category_id');
+
+DROP TRIGGER IF EXISTS productscategoriesxref_change ON ProductsCategoriesXref;
+CREATE TRIGGER productscategoriesxref_change
+AFTER INSERT OR UPDATE OR DELETE ON ProductsCategoriesXref
+FOR EACH ROW EXECUTE FUNCTION record_change('product_id', 'category_id');
+
+DROP TRIGGER IF EXISTS warranties_change ON Warranties;
+CREATE TRIGGER warranties_change
+AFTER INSERT OR UPDATE OR DELETE ON Warranties
+FOR EACH ROW EXECUTE FUNCTION record_change('warranty_id');
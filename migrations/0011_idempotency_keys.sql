@@ -0,0 +1,14 @@
+-- Stored responses for requests sent with an Idempotency-Key header (see
+-- idempotency.py). status is NULL while the first request with the key is
+-- still running. Rows are replayed until IDEMPOTENCY_TTL has passed and
+-- pruned with the daily purge.
+CREATE TABLE IF NOT EXISTS IdempotencyKeys (
+idempotency_key VARCHAR PRIMARY KEY,
+request_hash VARCHAR NOT NULL,
+status INTEGER,
+content_type VARCHAR,
+body BYTEA,
+created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idempotencykeys_created_at_idx ON IdempotencyKeys (created_at);
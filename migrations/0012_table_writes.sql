@@ -0,0 +1,107 @@
+-- Replaces the TableVersions counters of migration 0002 as the version
+-- source for the catalog tables. Bumping one counter row per table in
+-- every writing statement held that row's lock until commit, so writers
+-- to a table ran one at a time and could deadlock across tables (a batch
+-- writing products then warranties against a product delete cascading
+-- into warranties); statements that changed no rows bumped it too.
+--
+-- Instead, the first row a transaction changes in a table records
+-- (table, txid) in TableWrites. Each transaction inserts its own key, so
+-- writers never wait on each other. A table's version, as seen by a
+-- snapshot, is the newest txid below the snapshot's xmin (everything
+-- older has ended) plus every visible txid from xmin on; it changes
+-- whenever a transaction that touched the table commits (see
+-- queries.table_versions).
+
+CREATE TABLE IF NOT EXISTS TableWrites (
+table_name VARCHAR NOT NULL,
+txid BIGINT NOT NULL DEFAULT pg_current_xact_id()::text::bigint,
+written_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+PRIMARY KEY (table_name, txid)
+);
+
+CREATE INDEX IF NOT EXISTS tablewrites_written_at_idx ON TableWrites (written_at);
+
+-- A transaction-local setting remembers that the transaction has already
+-- recorded the table, so later rows skip the insert (and a rolled back
+-- savepoint forgets both).
+CREATE OR REPLACE FUNCTION record_table_write(written_table TEXT) RETURNS void AS $$
+DECLARE
+    setting TEXT := 'psy_crud.written_' || written_table;
+    current_txid TEXT := pg_current_xact_id()::text;
+BEGIN
+    IF current_setting(setting, true) IS DISTINCT FROM current_txid THEN
+        INSERT INTO TableWrites (table_name) VALUES (written_table)
+        ON CONFLICT (table_name, txid) DO NOTHING;
+
+        PERFORM set_config(setting, current_txid, true);
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION record_change() RETURNS trigger AS $$
+DECLARE
+    row_data JSONB;
+    key_data JSONB := '{}'::jsonb;
+    key_column TEXT;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_data := to_jsonb(OLD) - 'search_vector';
+    ELSE
+        row_data := to_jsonb(NEW) - 'search_vector';
+    END IF;
+
+    FOREACH key_column IN ARRAY TG_ARGV LOOP
+        key_data := key_data || jsonb_build_object(key_column, row_data -> key_column);
+    END LOOP;
+
+    INSERT INTO ChangeLog (table_name, operation, record_key, data)
+    VALUES (TG_TABLE_NAME, TG_OP, key_data, row_data);
+
+    PERFORM record_table_write(TG_TABLE_NAME);
+
+    -- Identical notifications within a transaction are sent once.
+    PERFORM pg_notify('catalog_changes', TG_TABLE_NAME);
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- TRUNCATE has no row triggers; it still changes the table's version.
+CREATE OR REPLACE FUNCTION record_truncate() RETURNS trigger AS $$
+BEGIN
+    PERFORM record_table_write(TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS companies_version ON Companies;
+CREATE TRIGGER companies_version
+AFTER TRUNCATE ON Companies
+FOR EACH STATEMENT EXECUTE FUNCTION record_truncate();
+
+DROP TRIGGER IF EXISTS products_version ON Products;
+CREATE TRIGGER products_version
+AFTER TRUNCATE ON Products
+FOR EACH STATEMENT EXECUTE FUNCTION record_truncate();
+
+DROP TRIGGER IF EXISTS categories_version ON Categories;
+CREATE TRIGGER categories_version
+AFTER TRUNCATE ON Categories
+FOR EACH STATEMENT EXECUTE FUNCTION record_truncate();
+
+DROP TRIGGER IF EXISTS productscategoriesxref_version ON ProductsCategoriesXref;
+CREATE TRIGGER productscategoriesxref_version
+AFTER TRUNCATE ON ProductsCategoriesXref
+FOR EACH STATEMENT EXECUTE FUNCTION record_truncate();
+
+DROP TRIGGER IF EXISTS warranties_version ON Warranties;
+CREATE TRIGGER warranties_version
+AFTER TRUNCATE ON Warranties
+FOR EACH STATEMENT EXECUTE FUNCTION record_truncate();
+
+DROP FUNCTION IF EXISTS bump_table_version();
+
+-- TableVersions now only versions the stats views (see migration 0009).
+DELETE FROM TableVersions
+WHERE table_name IN ('companies', 'products', 'categories', 'productscategoriesxref', 'warranties');
@@ -0,0 +1,52 @@
+-- record_change (migration 0010) called pg_notify for every changed row.
+-- Identical notifications in a transaction are only queued once, but each
+-- call still paid for the duplicate check. The notification is now sent
+-- from record_table_write (migration 0012), which runs for the first row a
+-- transaction changes in each table, so a transaction sends at most one per
+-- table and statements that change nothing send none.
+--
+-- A transaction that notified still takes the server-wide notification
+-- queue lock at commit, which serializes committing writers for that
+-- moment. That is the cost of the feed's instant wakeups; the listeners
+-- also poll (changes.poll_interval), so dropping the notification would
+-- only delay them.
+
+CREATE OR REPLACE FUNCTION record_table_write(written_table TEXT) RETURNS void AS $$
+DECLARE
+    setting TEXT := 'psy_crud.written_' || written_table;
+    current_txid TEXT := pg_current_xact_id()::text;
+BEGIN
+    IF current_setting(setting, true) IS DISTINCT FROM current_txid THEN
+        INSERT INTO TableWrites (table_name) VALUES (written_table)
+        ON CONFLICT (table_name, txid) DO NOTHING;
+
+        PERFORM pg_notify('catalog_changes', written_table);
+        PERFORM set_config(setting, current_txid, true);
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION record_change() RETURNS trigger AS $$
+DECLARE
+    row_data JSONB;
+    key_data JSONB := '{}'::jsonb;
+    key_column TEXT;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_data := to_jsonb(OLD) - 'search_vector';
+    ELSE
+        row_data := to_jsonb(NEW) - 'search_vector';
+    END IF;
+
+    FOREACH key_column IN ARRAY TG_ARGV LOOP
+        key_data := key_data || jsonb_build_object(key_column, row_data -> key_column);
+    END LOOP;
+
+    INSERT INTO ChangeLog (table_name, operation, record_key, data)
+    VALUES (TG_TABLE_NAME, TG_OP, key_data, row_data);
+
+    PERFORM record_table_write(TG_TABLE_NAME);
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,18 @@
+-- A product's warranty of a given length is unique. POST /warranty checked
+-- for an existing one with NOT EXISTS, which two concurrent inserts could
+-- both pass, and bulk loads did not check at all. Existing duplicates are
+-- removed, keeping the oldest, before the unique index is built; the lock
+-- keeps new ones from being inserted in between.
+LOCK TABLE Warranties IN SHARE ROW EXCLUSIVE MODE;
+
+DELETE FROM Warranties duplicate
+USING Warranties original
+WHERE duplicate.product_id = original.product_id
+AND duplicate.warranty_months = original.warranty_months
+AND duplicate.warranty_id > original.warranty_id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS warranties_product_id_warranty_months_key ON Warranties (product_id, warranty_months);
+
+-- The unique index leads with product_id, so it serves the lookups and
+-- cascading deletes the 0003 index was for.
+DROP INDEX IF EXISTS warranties_product_id_idx;
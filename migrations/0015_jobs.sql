@@ -0,0 +1,17 @@
+-- Background jobs (see jobs.py), so /jobs/<job_id> answers from whichever
+-- worker the poll lands on, and across restarts. started_at and
+-- finished_at are seconds since the epoch, as /jobs has always returned
+-- them. A job whose process died while it ran stays "running".
+CREATE TABLE IF NOT EXISTS Jobs (
+job_id VARCHAR PRIMARY KEY,
+name VARCHAR NOT NULL,
+params JSONB NOT NULL DEFAULT '{}',
+status VARCHAR NOT NULL,
+progress JSONB NOT NULL DEFAULT '{}',
+result JSONB,
+error TEXT,
+started_at DOUBLE PRECISION,
+finished_at DOUBLE PRECISION
+);
+
+CREATE INDEX IF NOT EXISTS jobs_finished_at_idx ON Jobs (finished_at);
@@ -0,0 +1,71 @@
+import os
+
+from flask import Response, current_app, request, stream_with_context
+
+import db
+import queries
+
+default_page_size = int(os.environ.get("PAGE_SIZE_DEFAULT", 100))
+max_page_size = int(os.environ.get("PAGE_SIZE_MAX", 1000))
+stream_batch_size = int(os.environ.get("STREAM_BATCH_SIZE", 2000))
+
+stream_formats = {
+    "ndjson": "application/x-ndjson",
+    "json": "application/json",
+}
+
+
+def get_page_size():
+    # The after cursor is parsed with the rest of the listing, see
+    # routes.parse_listing.
+    limit = request.args.get("limit", default_page_size, type=int)
+
+    return max(1, min(limit, max_page_size))
+
+
+def get_stream_format():
+    stream = request.args.get("stream")
+
+    if stream in stream_formats:
+        return stream
+
+    return None
+
+
+def stream_table(listing, stream_format, message="records found"):
+    # The stream reads on the request's own connection (the one
+    # @conditional already used), checked out here so a busy pool is a 503
+    # before any of the body is sent. It stays checked out for as long as
+    # the client is reading, and a named (server-side) cursor keeps only
+    # itersize rows in memory at a time. Read-only listings stream from a
+    # replica.
+    conn = db.get_db()
+
+    def generate():
+        dumps = current_app.json.dumps
+        to_json = listing.schema.to_json
+
+        cursor = conn.cursor(name=f"stream_{listing.table.name.lower()}")
+        cursor.itersize = stream_batch_size
+
+        query = queries.page(listing, None)
+        cursor.execute(query.sql, query.params)
+
+        if stream_format == "ndjson":
+            for record in cursor:
+                yield to_json(record) + "\n"
+
+        else:
+            yield f'{{"message":{dumps(message)},"results":['
+            separator = ""
+
+            for record in cursor:
+                yield separator + to_json(record)
+                separator = ","
+
+            yield "]}"
+
+        cursor.close()
+        conn.rollback()
+
+    return Response(stream_with_context(generate()), mimetype=stream_formats[stream_format])
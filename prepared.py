@@ -0,0 +1,104 @@
+import hashlib
+import os
+import re
+
+from psycopg2 import errors, extensions
+
+import metrics
+
+# Server-side prepared statements for the fixed SQL the routes run most
+# (queries built with prepare=True). psycopg2 always interpolates on the
+# client, so without this Postgres parses and plans e.g. the by-id lookup on
+# every request. Each statement is PREPAREd the first time a pooled
+# connection runs it and EXECUTEd from then on; a reconnect is a new
+# connection object with an empty registry, so statements are re-prepared
+# on their own.
+#
+# PREPARE is session state, which PgBouncer in transaction pooling mode
+# does not keep; set DB_PGBOUNCER_TRANSACTION_MODE=true there to send plain
+# statements instead.
+
+pgbouncer_transaction_mode = os.environ.get("DB_PGBOUNCER_TRANSACTION_MODE", "false").lower() == "true"
+
+placeholder = re.compile(r"%(%|s)(::[\w\[\]]+)?")
+
+
+class PreparingConnection(extensions.connection):
+    # Passed as connection_factory to the pool; tracks which statements
+    # this session has prepared.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class Statement:
+    def __init__(self, sql):
+        self.name = "stmt_" + hashlib.blake2b(sql.encode(), digest_size=8).hexdigest()
+
+        # %s placeholders become $1..$n for PREPARE. A cast on a
+        # placeholder (%s::INTEGER[]) is repeated on the EXECUTE argument,
+        # since EXECUTE will not coerce e.g. a text[] argument to integer[]
+        # on its own.
+        casts = []
+
+        def positional(match):
+            if match.group(1) == "%":
+                return "%"
+
+            casts.append(match.group(2) or "")
+            return f"${len(casts)}{match.group(2) or ''}"
+
+        self.prepare_sql = f"PREPARE {self.name} AS {placeholder.sub(positional, sql)}"
+
+        if casts:
+            self.execute_sql = f"EXECUTE {self.name} ({', '.join('%s' + cast for cast in casts)})"
+        else:
+            self.execute_sql = f"EXECUTE {self.name}"
+
+        metrics.statement_labels[self.name] = metrics.statement_label(sql)
+
+
+_statements = {}
+
+
+def get_statement(sql):
+    statement = _statements.get(sql)
+
+    if statement is None:
+        statement = _statements[sql] = Statement(sql)
+
+    return statement
+
+
+def execute(cursor, query):
+    conn = cursor.connection
+
+    if pgbouncer_transaction_mode or not query.prepare or not isinstance(conn, PreparingConnection):
+        cursor.execute(query.sql, query.params)
+        return
+
+    statement = get_statement(query.sql)
+    first_in_transaction = conn.get_transaction_status() == extensions.TRANSACTION_STATUS_IDLE
+
+    if statement.name not in conn.prepared:
+        # PREPARE is not transactional, so the statement stays prepared
+        # even if this transaction rolls back.
+        cursor.execute(statement.prepare_sql)
+        conn.prepared.add(statement.name)
+
+    try:
+        cursor.execute(statement.execute_sql, query.params)
+
+    except errors.InvalidSqlStatementName:
+        # Something dropped the session's statements (DISCARD ALL,
+        # DEALLOCATE). Start the registry over; if nothing else ran in
+        # this transaction yet, prepare again and retry in place.
+        conn.prepared.clear()
+
+        if not first_in_transaction:
+            raise
+
+        conn.rollback()
+        cursor.execute(statement.prepare_sql)
+        conn.prepared.add(statement.name)
+        cursor.execute(statement.execute_sql, query.params)
@@ -0,0 +1,586 @@
+from schema import categories, category_stats, companies, company_stats, products, warranties
+
+# Everything here uses %s placeholders, which both psycopg2 (Flask app) and
+# psycopg 3 (ASGI app) accept, so the two front ends send identical SQL.
+
+
+class Query:
+    def __init__(self, sql, params=(), fetch=None, prepare=False):
+        self.sql = sql
+        self.params = params
+        self.fetch = fetch
+        # Fixed SQL that is worth a server-side prepared statement on each
+        # pooled connection; see prepared.py.
+        self.prepare = prepare
+
+
+updatable_fields = {
+    companies.name: ["company_name", "active"],
+    categories.name: ["category_name"],
+    products.name: ["product_name", "company_id", "description", "price", "active"],
+    warranties.name: ["warranty_months", "product_id"],
+}
+
+
+def table_versions(table_names):
+    # A catalog table's version is the newest writing transaction that
+    # ended before every running one (the snapshot xmin), plus the writing
+    # transactions from xmin on that this snapshot sees; see migration
+    # 0012. Views are versioned in TableVersions instead.
+    return Query("""
+        WITH snapshot AS (
+            SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint AS xmin
+        )
+        SELECT t.table_name,
+            concat(v.version, '|', settled.txid, '|', recent.txids),
+            greatest(v.modified_at, settled.written_at, recent.written_at)
+        FROM unnest(%s::VARCHAR[]) AS t (table_name)
+        CROSS JOIN snapshot
+        LEFT JOIN TableVersions v ON v.table_name = t.table_name
+        LEFT JOIN LATERAL (
+            SELECT txid, written_at FROM TableWrites w
+            WHERE w.table_name = t.table_name AND w.txid < snapshot.xmin
+            ORDER BY w.txid DESC
+            LIMIT 1
+        ) settled ON true
+        LEFT JOIN LATERAL (
+            SELECT string_agg(txid::text, ',' ORDER BY txid) AS txids, max(written_at) AS written_at
+            FROM TableWrites w
+            WHERE w.table_name = t.table_name AND w.txid >= snapshot.xmin
+        ) recent ON true
+        ORDER BY t.table_name;
+    """, (list(table_names),), "all", prepare=True)
+
+
+def archivable(schema):
+    return "active" in schema.column_names
+
+
+# List filters a client may use, as (condition, value kind). Only these
+# fixed SQL fragments ever reach the query; values are always parameters.
+filterable_fields = {
+    companies.name: {
+        "active": ("active = %s", "bool"),
+    },
+    products.name: {
+        "company_id": ("company_id = ANY(%s::INTEGER[])", "int_list"),
+        "category_id": ("""EXISTS (
+            SELECT 1 FROM ProductsCategoriesXref
+            WHERE ProductsCategoriesXref.product_id = Products.product_id
+            AND ProductsCategoriesXref.category_id = ANY(%s::INTEGER[])
+        )""", "int_list"),
+        "price_min": ("price >= %s", "decimal"),
+        "price_max": ("price <= %s", "decimal"),
+        "active": ("active = %s", "bool"),
+    },
+}
+
+# Sortable columns, each backed by an index that leads with it, mapped to
+# whether the column is nullable.
+sortable_fields = {
+    companies.name: {"company_id": False, "company_name": False},
+    categories.name: {"category_id": False, "category_name": False},
+    products.name: {"product_id": False, "product_name": False, "price": True},
+    warranties.name: {"warranty_id": False},
+    company_stats.name: {"company_id": False, "product_count": False},
+    category_stats.name: {"category_id": False, "product_count": False},
+}
+
+
+class Listing:
+    def __init__(self, schema, table=None, filters=(), sort=None, descending=False, after=None, includes=()):
+        # schema is what gets selected (possibly a ?fields= projection),
+        # table the full schema it was projected from.
+        self.schema = schema
+        self.table = table or schema
+        self.filters = filters
+        self.sort = sort or schema.key
+        self.descending = descending
+        self.after = after
+        # Related resources to embed, see routes.relations.
+        self.includes = includes
+        self.nullable = sortable_fields.get(self.table.name, {}).get(self.sort, False)
+
+
+def keyset_str(listing):
+    # Rows strictly after the cursor in ORDER BY order. Keys are never
+    # null; a nullable sort column sorts its NULLs last ascending and
+    # first descending, same as the index.
+    key = listing.table.key
+    sort = listing.sort
+    op = "<" if listing.descending else ">"
+
+    if sort == key:
+        return f"{key} {op} %s", (listing.after,)
+
+    value, key_value = listing.after
+
+    if not listing.nullable:
+        return f"({sort}, {key}) {op} (%s, %s)", (value, key_value,)
+
+    if value is None and listing.descending:
+        return f"(({sort} IS NULL AND {key} < %s) OR {sort} IS NOT NULL)", (key_value,)
+
+    if value is None:
+        return f"({sort} IS NULL AND {key} > %s)", (key_value,)
+
+    if listing.descending:
+        return f"({sort} <= %s AND ({sort} < %s OR {key} < %s))", (value, value, key_value,)
+
+    return f"({sort} > %s OR ({sort} = %s AND {key} > %s) OR {sort} IS NULL)", (value, value, key_value,)
+
+
+def page(listing, limit):
+    # Keyset page over a listing; limit None reads to the end (streaming).
+    # Filters on active walk the partial key indexes from migration 0005.
+    where_list = [condition for condition, value in listing.filters]
+    params = tuple(value for condition, value in listing.filters)
+
+    if listing.after is not None:
+        condition, keyset_params = keyset_str(listing)
+        where_list.append(condition)
+        params += keyset_params
+
+    # Qualified, because a bare ORDER BY name would bind to the select
+    # list alias (price is selected as price::text) and sort as text.
+    key = f"{listing.table.name}.{listing.table.key}"
+    sort = f"{listing.table.name}.{listing.sort}"
+    direction = " DESC" if listing.descending else ""
+    order_str = f"{key}{direction}" if listing.sort == listing.table.key else f"{sort}{direction}, {key}{direction}"
+
+    where_str = "WHERE " + " AND ".join(where_list) if where_list else ""
+    limit_str = "LIMIT %s" if limit is not None else ""
+    params += (limit,) if limit is not None else ()
+
+    return Query(f"""
+        SELECT {listing.schema.select_list} FROM {listing.table.name}
+        {where_str}
+        ORDER BY {order_str}
+        {limit_str};
+    """, params, "all")
+
+
+def by_id(schema, record_id):
+    return Query(f"""
+        SELECT {schema.select_list} FROM {schema.name}
+        WHERE {schema.key} = %s;
+    """, (record_id,), "one", prepare=True)
+
+
+def search_products(schema, terms, limit, after=None, active=None):
+    # Ranked full-text search through products_search_idx (migration
+    # 0007). websearch_to_tsquery takes what users type ("red -blue",
+    # quoted phrases) without raising on syntax. The rank is selected after
+    # the schema's columns, so the compiled row encoder ignores it, and
+    # pages continue from the last (rank, product_id) pair.
+    where_list = ["search_vector @@ query"]
+    params = (terms,)
+
+    if active is not None:
+        where_list.append("active = %s")
+        params += (active,)
+
+    if after is not None:
+        where_list.append("(ts_rank_cd(search_vector, query), product_id) < (%s::REAL, %s)")
+        params += after
+
+    return Query(f"""
+        SELECT {schema.select_list}, ts_rank_cd(search_vector, query) AS rank
+        FROM Products, websearch_to_tsquery('english', %s) AS query
+        WHERE {" AND ".join(where_list)}
+        ORDER BY rank DESC, product_id DESC
+        LIMIT %s;
+    """, params + (limit,), "all")
+
+
+def typeahead_products(schema, prefix, limit, active=None):
+    # Substring match on names, served by the trigram index when pg_trgm
+    # is installed (migration 0008). Names starting with the text come
+    # first, then shorter (closer) names.
+    pattern = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    active_str = "AND active = %s" if active is not None else ""
+    params = (f"%{pattern}%",)
+    params += (active,) if active is not None else ()
+
+    return Query(f"""
+        SELECT {schema.select_list} FROM Products
+        WHERE product_name ILIKE %s
+        {active_str}
+        ORDER BY product_name ILIKE %s DESC, length(product_name), product_id
+        LIMIT %s;
+    """, params + (f"{pattern}%", limit,), "all")
+
+
+# Arbitrary key for the advisory lock that keeps two stats refreshes (from
+# different processes) from running at once.
+stats_refresh_lock = 7_041_901
+
+
+def try_stats_refresh_lock():
+    return Query("SELECT pg_try_advisory_xact_lock(%s);", (stats_refresh_lock,), "one")
+
+
+def refresh_view(schema):
+    return Query(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {schema.name};")
+
+
+def bump_table_version(table_name):
+    # For views, which have no trigger to do it; see migration 0009.
+    return Query("""
+        UPDATE TableVersions
+        SET version = version + 1, modified_at = now()
+        WHERE table_name = %s;
+    """, (table_name,))
+
+
+def companies_by_ids(company_ids):
+    return Query(f"""
+        SELECT {companies.select_list} FROM Companies
+        WHERE company_id = ANY(%s::INTEGER[]);
+    """, (company_ids,), "all", prepare=True)
+
+
+def categories_by_products(product_ids):
+    # (product_id, category columns...) for every category of every given
+    # product, through the xref primary key and the Categories key.
+    return Query(f"""
+        SELECT ProductsCategoriesXref.product_id, {categories.select_list}
+        FROM ProductsCategoriesXref
+        JOIN Categories USING (category_id)
+        WHERE ProductsCategoriesXref.product_id = ANY(%s::INTEGER[])
+        ORDER BY ProductsCategoriesXref.product_id, category_id;
+    """, (product_ids,), "all", prepare=True)
+
+
+def warranties_by_products(product_ids):
+    return Query(f"""
+        SELECT {warranties.select_list} FROM Warranties
+        WHERE product_id = ANY(%s::INTEGER[])
+        ORDER BY warranty_id;
+    """, (product_ids,), "all", prepare=True)
+
+
+def changes_after(schema, after, table_names, limit):
+    # Changes from transactions that have all finished, in the (txid,
+    # change_id) order explained in migration 0010, after the (txid,
+    # change_id) cursor.
+    where_list = ["txid < pg_snapshot_xmin(pg_current_snapshot())::text::bigint"]
+    params = ()
+
+    if after is not None:
+        where_list.append("(txid, change_id) > (%s, %s)")
+        params += tuple(after)
+
+    if table_names:
+        where_list.append("table_name = ANY(%s::VARCHAR[])")
+        params += (list(table_names),)
+
+    return Query(f"""
+        SELECT {schema.select_list} FROM ChangeLog
+        WHERE {" AND ".join(where_list)}
+        ORDER BY txid, change_id
+        LIMIT %s;
+    """, params + (limit,), "all")
+
+
+def change_exists(change_id):
+    return Query("""
+        SELECT EXISTS (SELECT 1 FROM ChangeLog WHERE change_id = %s);
+    """, (change_id,), "one", prepare=True)
+
+
+def prune_changes_chunk(retention_days, chunk_size):
+    return Query("""
+        WITH deleted AS (
+            DELETE FROM ChangeLog
+            WHERE change_id IN (
+                SELECT change_id FROM ChangeLog
+                WHERE changed_at < now() - make_interval(days => %s)
+                ORDER BY change_id
+                LIMIT %s
+            )
+            RETURNING change_id
+        )
+        SELECT count(*) FROM deleted;
+    """, (retention_days, chunk_size,), "one")
+
+
+def prune_table_writes(retention_days):
+    # Keeps each table's newest write, which its version still depends on.
+    return Query("""
+        WITH deleted AS (
+            DELETE FROM TableWrites w
+            WHERE written_at < now() - make_interval(days => %s)
+            AND txid < (SELECT max(txid) FROM TableWrites newest WHERE newest.table_name = w.table_name)
+            RETURNING txid
+        )
+        SELECT count(*) FROM deleted;
+    """, (retention_days,), "one")
+
+
+def claim_idempotency_key(key, request_hash, ttl, pending_timeout):
+    # Takes the key, unless a live entry holds it: one that is answered and
+    # younger than ttl, or still running and younger than pending_timeout.
+    return Query("""
+        INSERT INTO IdempotencyKeys (idempotency_key, request_hash)
+        VALUES (%s, %s)
+        ON CONFLICT (idempotency_key) DO UPDATE SET
+            request_hash = EXCLUDED.request_hash,
+            status = NULL,
+            content_type = NULL,
+            body = NULL,
+            created_at = now()
+        WHERE IdempotencyKeys.created_at < now() - make_interval(secs => %s)
+        OR (IdempotencyKeys.status IS NULL AND IdempotencyKeys.created_at < now() - make_interval(secs => %s))
+        RETURNING idempotency_key;
+    """, (key, request_hash, ttl, pending_timeout,), "one", prepare=True)
+
+
+def idempotency_key(key):
+    return Query("""
+        SELECT request_hash, status, content_type, body FROM IdempotencyKeys
+        WHERE idempotency_key = %s;
+    """, (key,), "one", prepare=True)
+
+
+def store_idempotent_response(key, status, content_type, body):
+    return Query("""
+        UPDATE IdempotencyKeys
+        SET status = %s, content_type = %s, body = %s
+        WHERE idempotency_key = %s;
+    """, (status, content_type, body, key,), prepare=True)
+
+
+def release_idempotency_key(key):
+    return Query("""
+        DELETE FROM IdempotencyKeys
+        WHERE idempotency_key = %s
+        AND status IS NULL;
+    """, (key,), prepare=True)
+
+
+def prune_idempotency_keys(ttl):
+    return Query("""
+        WITH deleted AS (
+            DELETE FROM IdempotencyKeys
+            WHERE created_at < now() - make_interval(secs => %s)
+            RETURNING idempotency_key
+        )
+        SELECT count(*) FROM deleted;
+    """, (ttl,), "one")
+
+
+def save_job(job_id, name, params, status, progress, result, error, started_at, finished_at):
+    return Query("""
+        INSERT INTO Jobs (job_id, name, params, status, progress, result, error, started_at, finished_at)
+        VALUES (%s, %s, %s::JSONB, %s, %s::JSONB, %s::JSONB, %s, %s, %s)
+        ON CONFLICT (job_id) DO UPDATE SET
+            status = EXCLUDED.status,
+            progress = EXCLUDED.progress,
+            result = EXCLUDED.result,
+            error = EXCLUDED.error,
+            started_at = EXCLUDED.started_at,
+            finished_at = EXCLUDED.finished_at;
+    """, (job_id, name, params, status, progress, result, error, started_at, finished_at,), prepare=True)
+
+
+def job_by_id(job_id):
+    return Query("""
+        SELECT job_id, name, params, status, progress, result, error, started_at, finished_at
+        FROM Jobs
+        WHERE job_id = %s;
+    """, (job_id,), "one", prepare=True)
+
+
+def forget_finished_jobs(keep):
+    # All but the keep most recently finished jobs.
+    return Query("""
+        DELETE FROM Jobs
+        WHERE job_id IN (
+            SELECT job_id FROM Jobs
+            WHERE finished_at IS NOT NULL
+            ORDER BY finished_at DESC
+            OFFSET %s
+        );
+    """, (keep,))
+
+
+def insert_company(company_name, upsert=False):
+    conflict_str = "DO UPDATE SET company_name = EXCLUDED.company_name" if upsert else "DO NOTHING"
+
+    return Query(f"""
+        INSERT INTO Companies
+        (company_name)
+        VALUES (%s)
+        ON CONFLICT (company_name) {conflict_str}
+        RETURNING company_id, (xmax = 0) AS inserted;
+    """, (company_name,), "one", prepare=True)
+
+
+def insert_category(category_name, upsert=False):
+    conflict_str = "DO UPDATE SET category_name = EXCLUDED.category_name" if upsert else "DO NOTHING"
+
+    return Query(f"""
+        INSERT INTO Categories
+        (category_name)
+        VALUES (%s)
+        ON CONFLICT (category_name) {conflict_str}
+        RETURNING category_id, (xmax = 0) AS inserted;
+    """, (category_name,), "one", prepare=True)
+
+
+def insert_product(product_name, company_id, description, price, upsert=False):
+    if upsert:
+        conflict_str = """DO UPDATE SET
+            company_id = EXCLUDED.company_id,
+            description = EXCLUDED.description,
+            price = EXCLUDED.price"""
+    else:
+        conflict_str = "DO NOTHING"
+
+    return Query(f"""
+        INSERT INTO Products
+        (product_name, company_id, description, price)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (product_name) {conflict_str}
+        RETURNING product_id, (xmax = 0) AS inserted;
+    """, (product_name, company_id, description, price,), "one", prepare=True)
+
+
+def insert_warranty(product_id, warranty_months):
+    return Query("""
+        INSERT INTO Warranties
+        (product_id, warranty_months)
+        VALUES (%s, %s)
+        ON CONFLICT (product_id, warranty_months) DO NOTHING
+        RETURNING warranty_id;
+    """, (product_id, warranty_months,), "one", prepare=True)
+
+
+def insert_xref(product_id, category_id):
+    return Query("""
+        INSERT INTO ProductsCategoriesXref
+        (product_id, category_id)
+        VALUES (%s, %s)
+        ON CONFLICT (product_id, category_id) DO NOTHING
+        RETURNING product_id, category_id;
+    """, (product_id, category_id,), "one", prepare=True)
+
+
+def set_clause(post_data, allowed_fields):
+    set_list = []
+    set_value_tuple = ()
+
+    for field in allowed_fields:
+        value = post_data.get(field)
+
+        if value != None and value != '' and str(value).isspace() != True:
+            set_list.append(f"{field} = %s")
+            set_value_tuple += (value,)
+
+    return ', '.join(set_list), set_value_tuple
+
+
+def update_by_id(schema, set_str, set_value_tuple, record_id):
+    return Query(f"""
+        UPDATE {schema.name}
+        SET {set_str}
+        WHERE {schema.key} = %s
+        RETURNING {schema.select_list};
+    """, set_value_tuple + (record_id,), "one")
+
+
+def update_by_ids(schema, set_str, set_value_tuple, ids):
+    return Query(f"""
+        UPDATE {schema.name}
+        SET {set_str}
+        WHERE {schema.key} = ANY(%s::INTEGER[])
+        RETURNING {schema.select_list};
+    """, set_value_tuple + (ids,), "all")
+
+
+def delete_by_id(schema, record_id):
+    # Dependent rows go through ON DELETE CASCADE (migration 0004), and
+    # RETURNING doubles as the existence check.
+    return Query(f"""
+        DELETE FROM {schema.name}
+        WHERE {schema.key} = %s
+        RETURNING {schema.key};
+    """, (record_id,), "one", prepare=True)
+
+
+def delete_by_ids(schema, ids):
+    return Query(f"""
+        DELETE FROM {schema.name}
+        WHERE {schema.key} = ANY(%s::INTEGER[])
+        RETURNING {schema.key};
+    """, (ids,), "all", prepare=True)
+
+
+def archive_str(schema, where_str):
+    # Archiving a company archives its products in the same statement.
+    cascade_str = ""
+
+    if schema.name == companies.name:
+        cascade_str = """,
+        archived_products AS (
+            UPDATE Products
+            SET active = false
+            WHERE company_id IN (SELECT company_id FROM archived)
+            AND active
+        )"""
+
+    return f"""
+        WITH archived AS (
+            UPDATE {schema.name}
+            SET active = false
+            WHERE {where_str}
+            RETURNING {schema.key}
+        ){cascade_str}
+        SELECT {schema.key} FROM archived;
+    """
+
+
+def archive_by_id(schema, record_id):
+    return Query(archive_str(schema, f"{schema.key} = %s"), (record_id,), "one", prepare=True)
+
+
+def archive_by_ids(schema, ids):
+    return Query(archive_str(schema, f"{schema.key} = ANY(%s::INTEGER[])"), (ids,), "all", prepare=True)
+
+
+def purge_archived_chunk(schema, chunk_size):
+    # SKIP LOCKED keeps the purge from queueing behind request traffic;
+    # rows it skips are picked up by a later chunk or run.
+    return Query(f"""
+        WITH deleted AS (
+            DELETE FROM {schema.name}
+            WHERE {schema.key} IN (
+                SELECT {schema.key} FROM {schema.name}
+                WHERE active = false
+                ORDER BY {schema.key}
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING {schema.key}
+        )
+        SELECT count(*) FROM deleted;
+    """, (chunk_size,), "one")
+
+
+def delete_company_products_chunk(company_id, chunk_size):
+    # One bounded slice of a large company's products per transaction, so
+    # row locks are held only briefly.
+    return Query("""
+        WITH deleted AS (
+            DELETE FROM Products
+            WHERE product_id IN (
+                SELECT product_id FROM Products
+                WHERE company_id = %s
+                ORDER BY product_id
+                LIMIT %s
+            )
+            RETURNING product_id
+        )
+        SELECT count(*) FROM deleted;
+    """, (company_id, chunk_size,), "one")
@@ -0,0 +1,980 @@
+import base64
+import binascii
+import json
+from collections.abc import Mapping
+from decimal import Decimal, InvalidOperation
+
+import queries
+from schema import catalog_stats, categories, category_stats, change_log, companies, company_stats, products, warranties
+
+# Route logic shared by the Flask app (app.py) and the ASGI app
+# (asgi_app.py). Each operation is a generator that yields queries.Query
+# objects and gets the fetched rows sent back; the front end's runner owns
+# the connection, commit and rollback. A failed statement is thrown back in
+# as QueryError. The generator's return value is the Reply to send.
+
+
+class QueryError(Exception):
+    pass
+
+
+class ListingError(ValueError):
+    pass
+
+
+class Reply:
+    def __init__(self, body, status=200, schema=None, rows=None, invalidate=(), invalidate_tables=(), rollback=False):
+        self.body = body
+        self.status = status
+        self.schema = schema
+        self.rows = rows
+        # Cache entries to drop once the transaction has committed.
+        self.invalidate = invalidate
+        self.invalidate_tables = invalidate_tables
+        # Roll the transaction back instead of committing it, e.g. for a
+        # batch that failed part way.
+        self.rollback = rollback
+
+    def render_rows(self):
+        # List bodies are written straight from the row tuples by the
+        # schema's compiled encoder; see schema.TableSchema.to_json.
+        dumps = json.dumps
+
+        body = ['{"message":', dumps(self.body["message"]), ',"results":[', ",".join(map(self.schema.to_json, self.rows)), "]"]
+
+        for name, value in self.body.items():
+            if name != "message":
+                body.append(f",{dumps(name)}:{dumps(value)}")
+
+        body.append("}\n")
+
+        return "".join(body)
+
+
+def encode_cursor(value, key_value):
+    return base64.urlsafe_b64encode(json.dumps([value, key_value]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        value, key_value = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeError, TypeError, ValueError):
+        raise ListingError("invalid after cursor")
+
+    return value, key_value
+
+
+def is_int(value):
+    # JSON true and false decode to bool, which is an int subclass.
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_object(post_data):
+    # A JSON body can be any value; the write routes need an object (or a
+    # submitted form).
+    return isinstance(post_data, Mapping)
+
+
+def cursor_value(kind, value):
+    # The sort value half of an after cursor, checked against (and, for
+    # decimals, converted to) the sort column's type. None stands for a
+    # NULL sort value.
+    if value is None or (kind == "int" and is_int(value)) or (kind == "str" and isinstance(value, str)):
+        return value
+
+    if kind == "decimal" and (isinstance(value, str) or is_int(value)):
+        try:
+            return Decimal(value)
+        except InvalidOperation:
+            pass
+
+    raise ListingError("invalid after cursor")
+
+
+def next_after(rows, listing, limit):
+    # Sorted by key, the cursor is just the last key, as it always was;
+    # any other sort needs the last (sort value, key) pair, sent as an
+    # opaque token.
+    if limit is None or len(rows) < limit:
+        return None
+
+    schema = listing.schema
+    last = rows[-1]
+
+    if listing.sort == schema.key:
+        return last[schema.key_index]
+
+    return encode_cursor(last[schema.column_names.index(listing.sort)], last[schema.key_index])
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+
+    if value.lower() in ("true", "1"):
+        return True
+
+    if value.lower() in ("false", "0"):
+        return False
+
+    raise ValueError(value)
+
+
+def parse_int_list(value):
+    if isinstance(value, int):
+        return [value]
+
+    return [int(item) for item in str(value).split(",")]
+
+
+filter_parsers = {
+    "bool": parse_bool,
+    "int_list": parse_int_list,
+    "decimal": Decimal,
+}
+
+
+def parse_listing(schema, args, defaults=None):
+    # Turns list query parameters (?price_min=&company_id=&sort=-price&
+    # fields=product_name,price&after=...) into a queries.Listing, allowing
+    # only the fields whitelisted in queries. defaults are filters the route
+    # implies, e.g. active=True for /products/active; the same field in the
+    # query string is ANDed with them, never replaces them.
+    defaults = defaults or {}
+    filters = []
+
+    for name, (condition, kind) in queries.filterable_fields.get(schema.name, {}).items():
+        for value in (defaults.get(name), args.get(name)):
+            if value is None or value == "":
+                continue
+
+            try:
+                filters.append((condition, filter_parsers[kind](value)))
+            except (ValueError, InvalidOperation):
+                raise ListingError(f"invalid value for {name}")
+
+    sort = args.get("sort") or schema.key
+    descending = sort.startswith("-")
+    sort = sort.lstrip("-")
+
+    if sort not in queries.sortable_fields.get(schema.name, {schema.key: False}):
+        raise ListingError(f"cannot sort by {sort}")
+
+    includes = parse_includes(schema, args.get("include"))
+    projection = schema
+
+    if args.get("fields"):
+        fields = args.get("fields").split(",")
+        unknown = [field for field in fields if field not in schema.column_names]
+
+        if unknown:
+            raise ListingError(f"unknown fields: {', '.join(unknown)}")
+
+        # The key and sort column always come back, since the cursor is
+        # built from them, as do the columns any include joins on.
+        fields += [schema.key, sort] + [relations[schema.name][include][0] for include in includes]
+        projection = schema.project(fields)
+
+    after = args.get("after")
+
+    if after is None or after == "":
+        after = None
+
+    elif sort == schema.key:
+        try:
+            after = int(after)
+        except ValueError:
+            raise ListingError("invalid after cursor")
+
+    else:
+        value, key_value = decode_cursor(after)
+
+        if not is_int(key_value):
+            raise ListingError("invalid after cursor")
+
+        after = (cursor_value(schema.columns[schema.column_names.index(sort)].kind, value), key_value)
+
+    return queries.Listing(projection, schema, filters, sort, descending, after, includes)
+
+
+# Related rows a read can embed with ?include=, as (the column of the
+# parent record the relation hangs off, tables whose versions the
+# response then depends on).
+relations = {
+    products.name: {
+        "company": ("company_id", ["companies"]),
+        "categories": ("product_id", ["categories", "productscategoriesxref"]),
+        "warranties": ("product_id", ["warranties"]),
+    },
+}
+
+
+def parse_includes(schema, value):
+    if not value:
+        return []
+
+    includes = value.split(",")
+    unknown = [include for include in includes if include not in relations.get(schema.name, {})]
+
+    if unknown:
+        raise ListingError(f"cannot include: {', '.join(unknown)}")
+
+    return includes
+
+
+# Tables other than its own that a listing filter reads.
+filter_tables = {
+    products.name: {
+        "category_id": ["productscategoriesxref"],
+    },
+}
+
+
+def listing_tables(schema, args):
+    # For conditional GETs: the tables, besides the schema's own, whose
+    # versions a listing depends on, through its ?include= relations and
+    # its filters. Unknown includes are left for the route to reject.
+    tables = [
+        table
+        for include in (args.get("include") or "").split(",")
+        for table in relations.get(schema.name, {}).get(include, ("", []))[1]
+    ]
+
+    for name, filtered in filter_tables.get(schema.name, {}).items():
+        if args.get(name) not in (None, ""):
+            tables += [table for table in filtered if table not in tables]
+
+    return tables
+
+
+def embed_related(records, includes):
+    # One batched = ANY query per relation for the whole page of product
+    # records, never one per record. The records are updated in place.
+    product_ids = [record["product_id"] for record in records]
+
+    if "company" in includes:
+        company_ids = sorted({record["company_id"] for record in records if record["company_id"] is not None})
+        result = (yield queries.companies_by_ids(company_ids)) if company_ids else []
+        by_id = {row[0]: companies.to_record(row) for row in result}
+
+        for record in records:
+            record["company"] = by_id.get(record["company_id"])
+
+    if "categories" in includes:
+        result = yield queries.categories_by_products(product_ids)
+        by_product = {product_id: [] for product_id in product_ids}
+
+        for row in result:
+            by_product[row[0]].append(categories.to_record(row[1:]))
+
+        for record in records:
+            record["categories"] = by_product[record["product_id"]]
+
+    if "warranties" in includes:
+        result = yield queries.warranties_by_products(product_ids)
+        by_product = {product_id: [] for product_id in product_ids}
+
+        for row in result:
+            by_product[row[warranties.column_names.index("product_id")]].append(warranties.to_record(row))
+
+        for record in records:
+            record["warranties"] = by_product[record["product_id"]]
+
+    return records
+
+
+# CREATE
+
+def add_company(post_data, upsert=False):
+    if not is_object(post_data):
+        return Reply({"message": "request body must be a JSON object"}, 400)
+
+    company_name = post_data.get('company_name')
+
+    if not company_name:
+        return Reply({"message": "company_name is a required field"}, 400)
+
+    try:
+        result = yield queries.insert_company(company_name, upsert)
+
+    except QueryError as e:
+        return Reply({"message": "Company could not be added", "Error": str(e)}, 400)
+
+    if result == None:
+        return Reply({"message": "Company already exists"}, 400)
+
+    if not result[1]:
+        return Reply({"message": f"Company {company_name} already in DB", "company_id": result[0]}, 200)
+
+    return Reply({"message": f"Company {company_name} added to DB", "company_id": result[0]}, 201)
+
+
+def add_category(post_data, upsert=False):
+    if not is_object(post_data):
+        return Reply({"message": "request body must be a JSON object"}, 400)
+
+    category_name = post_data.get('category_name')
+
+    if not category_name:
+        return Reply({"message": "category_name is a required field"}, 400)
+
+    try:
+        result = yield queries.insert_category(category_name, upsert)
+
+    except QueryError as e:
+        return Reply({"message": "Category could not be added", "Error": str(e)}, 400)
+
+    if result == None:
+        return Reply({"message": "Category already exists"}, 400)
+
+    if not result[1]:
+        return Reply({"message": f"Category {category_name} already in DB", "category_id": result[0]}, 200)
+
+    return Reply({"message": f"Category {category_name} added to DB", "category_id": result[0]}, 201)
+
+
+def add_product(post_data, upsert=False):
+    if not is_object(post_data):
+        return Reply({"message": "request body must be a JSON object"}, 400)
+
+    product_name = post_data.get('product_name')
+    company_id = post_data.get('company_id')
+    description = post_data.get('description')
+    price = post_data.get('price')
+
+    if not product_name:
+        return Reply({"message": "product_name is a required field"}, 400)
+
+    if not company_id:
+        return Reply({"message": "company_id is a required field"}, 400)
+
+    try:
+        result = yield queries.insert_product(product_name, company_id, description, price, upsert)
+
+    except QueryError as e:
+        return Reply({"message": "Product could not be added", "Error": str(e)}, 400)
+
+    if result == None:
+        return Reply({"message": "Product already exists"}, 400)
+
+    if not result[1]:
+        return Reply({"message": f"Product {product_name} updated", "product_id": result[0]}, 200, invalidate=[(products.name, [result[0]])])
+
+    return Reply({"message": f"Product {product_name} added to DB", "product_id": result[0]}, 201)
+
+
+def add_warranty(post_data):
+    if not is_object(post_data):
+        return Reply({"message": "request body must be a JSON object"}, 400)
+
+    warranty_months = post_data.get('warranty_months')
+    product_id = post_data.get('product_id')
+
+    if not warranty_months:
+        return Reply({"message": "warranty_months is a required field"}, 400)
+
+    if not product_id:
+        return Reply({"message": "product_id is a required field"}, 400)
+
+    try:
+        result = yield queries.insert_warranty(product_id, warranty_months)
+
+    except QueryError as e:
+        return Reply({"message": "Warranty could not be added", "Error": str(e)}, 400)
+
+    if result == None:
+        return Reply({"message": "Warranty already exists"}, 400)
+
+    return Reply({"message": "Warranty added to DB", "warranty_id": result[0]}, 201)
+
+
+def create_xref(post_data):
+    if not is_object(post_data):
+        return Reply({"message": "request body must be a JSON object"}, 400)
+
+    category_id = post_data.get('category_id')
+    product_id = post_data.get('product_id')
+
+    if not category_id:
+        return Reply({"message": "category_id is a required field"}, 400)
+
+    if not product_id:
+        return Reply({"message": "product_id is a required field"}, 400)
+
+    try:
+        result = yield queries.insert_xref(product_id, category_id)
+
+    except QueryError as e:
+        return Reply({"message": "Product-Category association could not be added", "Error": str(e)}, 400)
+
+    if result == None:
+        return Reply({"message": "Product-Category association already exists"}, 400)
+
+    return Reply({"message": "Product-Category association added to DB", "product_id": result[0], "category_id": result[1]}, 201)
+
+
+# READ
+
+def load_by_id(schema, record_id):
+    result = yield queries.by_id(schema, record_id)
+
+    return None if result == None else schema.to_record(result)
+
+
+def by_id_reply(record, name):
+    if record == None:
+        return Reply({"message": f"{name} not found"}, 404)
+
+    return Reply({"message": f"{name} found", "result": record}, 200)
+
+
+def embed_reply(record, name, includes):
+    # The by-id record may be a shared cache entry, so includes go on a copy.
+    if record == None or not includes:
+        return by_id_reply(record, name)
+
+    records = yield from embed_related([dict(record)], includes)
+
+    return by_id_reply(records[0], name)
+
+
+def get_by_id(schema, record_id, name, includes=()):
+    record = yield from load_by_id(schema, record_id)
+
+    return (yield from embed_reply(record, name, includes))
+
+
+def list_page(listing, name, limit):
+    result = yield queries.page(listing, limit)
+
+    if result == []:
+        return Reply({"message": f"{name} not found"}, 404)
+
+    after = next_after(result, listing, limit)
+
+    if listing.includes:
+        # Nested results go through the regular JSON encoder instead of
+        # the compiled row renderer.
+        records = yield from embed_related([listing.schema.to_record(row) for row in result], listing.includes)
+
+        return Reply({"message": f"{name} found", "results": records, "next_after": after})
+
+    return Reply({"message": f"{name} found", "next_after": after}, schema=listing.schema, rows=result)
+
+
+def search_products(args, limit):
+    # /products/search?q=...: ranked full-text search, or name typeahead
+    # with match=name. fields= and active= work as on the product listing.
+    terms = (args.get("q") or "").strip()
+
+    if not terms:
+        return Reply({"message": "q is a required parameter"}, 400)
+
+    try:
+        listing = parse_listing(products, {"fields": args.get("fields")})
+        active = parse_bool(args.get("active")) if args.get("active") else None
+        after = decode_cursor(args.get("after")) if args.get("after") else None
+
+    except ListingError as e:
+        return Reply({"message": str(e)}, 400)
+
+    except ValueError:
+        return Reply({"message": "invalid value for active"}, 400)
+
+    schema = listing.schema
+
+    try:
+        if args.get("match") == "name":
+            result = yield queries.typeahead_products(schema, terms, limit, active)
+        else:
+            result = yield queries.search_products(schema, terms, limit, after, active)
+
+    except QueryError as e:
+        return Reply({"message": "Products could not be searched", "Error": str(e)}, 400)
+
+    if result == []:
+        return Reply({"message": "products not found"}, 404)
+
+    if args.get("match") == "name":
+        return Reply({"message": "products found"}, schema=schema, rows=result)
+
+    # The rank is the trailing column of each search row.
+    last = result[-1]
+    cursor = encode_cursor(last[-1], last[schema.key_index]) if len(result) == limit else None
+
+    return Reply({"message": "products found", "next_after": cursor}, schema=schema, rows=result)
+
+
+def get_product_categories(product_id):
+    result = yield queries.categories_by_products([product_id])
+
+    if result == []:
+        product = yield queries.by_id(products, product_id)
+
+        if product == None:
+            return Reply({"message": "product not found"}, 404)
+
+    return Reply({"message": "categories found", "results": [categories.to_record(row[1:]) for row in result]}, 200)
+
+
+# STATS
+
+stats_views = [catalog_stats, company_stats, category_stats]
+
+
+def get_stats():
+    return get_by_id(catalog_stats, 1, "stats")
+
+
+def refresh_stats():
+    # Rebuilds the stats views in one transaction and bumps their version,
+    # so conditional GETs see the new figures. Returns False without doing
+    # anything if another refresh holds the lock.
+    locked = yield queries.try_stats_refresh_lock()
+
+    if not locked[0]:
+        return False
+
+    for schema in stats_views:
+        yield queries.refresh_view(schema)
+
+    yield queries.bump_table_version("catalogstats")
+
+    return True
+
+
+# CHANGES
+
+change_tables = ["companies", "products", "categories", "productscategoriesxref", "warranties"]
+
+
+def parse_changes(args, last_event_id=None):
+    # (after cursor, tables) for /changes. An SSE client resuming with
+    # Last-Event-ID sends back the id of the last event it got, which is
+    # the same opaque cursor.
+    after = args.get("after") or last_event_id or None
+
+    if after is not None:
+        txid, change_id = decode_cursor(after)
+
+        if not is_int(txid) or not is_int(change_id):
+            raise ListingError("invalid after cursor")
+
+        after = (txid, change_id)
+
+    table_names = [table for table in (args.get("tables") or "").split(",") if table]
+    unknown = [table for table in table_names if table not in change_tables]
+
+    if unknown:
+        raise ListingError(f"unknown tables: {', '.join(unknown)}")
+
+    return after, table_names
+
+
+def change_cursor(row):
+    return encode_cursor(row[change_log.column_names.index("txid")], row[change_log.key_index])
+
+
+def list_changes(after, table_names, limit):
+    # An empty page is not an error here: next_after stays where it was and
+    # the consumer asks again later.
+    if after is not None:
+        exists = yield queries.change_exists(after[1])
+
+        # The cursor's own change was delivered, so if it is gone it has
+        # been pruned, possibly with changes after it the consumer missed.
+        if not exists[0]:
+            return Reply({"message": "after cursor has expired, resync from the tables"}, 410)
+
+    result = yield queries.changes_after(change_log, after, table_names, limit)
+
+    if result:
+        next_after = change_cursor(result[-1])
+    else:
+        next_after = encode_cursor(*after) if after is not None else None
+
+    return Reply({"message": f"{len(result)} changes found", "next_after": next_after}, schema=change_log, rows=result)
+
+
+def prune_changes_chunk(retention_days, chunk_size):
+    result = yield queries.prune_changes_chunk(retention_days, chunk_size)
+
+    return result[0]
+
+
+def prune_table_writes(retention_days):
+    result = yield queries.prune_table_writes(retention_days)
+
+    return result[0]
+
+
+# IDEMPOTENCY
+
+def claim_idempotency_key(key, request_hash, ttl, pending_timeout):
+    # None if the key is now this request's to answer, otherwise the entry
+    # holding it, as (request_hash, status, content_type, body); status is
+    # None while that request is still running.
+    claimed = yield queries.claim_idempotency_key(key, request_hash, ttl, pending_timeout)
+
+    if claimed is not None:
+        return None
+
+    existing = yield queries.idempotency_key(key)
+
+    # Released by its request between the two statements; report it as
+    # running, the client's next retry can claim it.
+    return existing or (request_hash, None, None, None)
+
+
+def store_idempotent_response(key, status, content_type, body):
+    yield queries.store_idempotent_response(key, status, content_type, body)
+
+
+def release_idempotency_key(key):
+    yield queries.release_idempotency_key(key)
+
+
+def prune_idempotency_keys(ttl):
+    result = yield queries.prune_idempotency_keys(ttl)
+
+    return result[0]
+
+
+# JOBS
+
+job_fields = ("job_id", "name", "params", "status", "progress", "result", "error", "started_at", "finished_at")
+
+
+def to_jsonb(value):
+    return None if value is None else json.dumps(value, default=str)
+
+
+def save_job(job, keep_finished):
+    # job is a jobs.Job's to_dict(); once it has finished, the oldest
+    # finished jobs beyond keep_finished are dropped.
+    yield queries.save_job(
+        job["job_id"], job["name"], to_jsonb(job["params"]), job["status"], to_jsonb(job["progress"]),
+        to_jsonb(job["result"]), job["error"], job["started_at"], job["finished_at"],
+    )
+
+    if job["finished_at"] is not None:
+        yield queries.forget_finished_jobs(keep_finished)
+
+
+def get_job(job_id):
+    result = yield queries.job_by_id(job_id)
+
+    if result == None:
+        return Reply({"message": "job not found"}, 404)
+
+    return Reply({"message": "job found", "result": dict(zip(job_fields, result))}, 200)
+
+
+# BATCH
+
+# Operations a /batch request can run, each taking the operation's data
+# object. Updates and deletes find the record through data["id"].
+batch_operations = {
+    "add_company": lambda data: add_company(data, data.get("on_conflict") == "update"),
+    "add_category": lambda data: add_category(data, data.get("on_conflict") == "update"),
+    "add_product": lambda data: add_product(data, data.get("on_conflict") == "update"),
+    "add_warranty": add_warranty,
+    "create_xref": create_xref,
+    "update_company": lambda data: update_by_id(companies, data.get("id"), data, "company"),
+    "update_category": lambda data: update_by_id(categories, data.get("id"), data, "category"),
+    "update_product": lambda data: update_by_id(products, data.get("id"), data, "product"),
+    "update_warranty": lambda data: update_by_id(warranties, data.get("id"), data, "warranty"),
+    "delete_company": lambda data: delete_company_by_id(data.get("id"), data.get("hard") is True),
+    "delete_product": lambda data: delete_product_by_id(data.get("id"), data.get("hard") is True),
+    "delete_category": lambda data: delete_category_by_id(data.get("id")),
+    "delete_warranty": lambda data: delete_warranty_by_id(data.get("id")),
+}
+
+
+class BatchError(ValueError):
+    pass
+
+
+def resolve_refs(value, results):
+    # {"$ref": "0.product_id"} stands for the product_id in the response
+    # body of operation 0; a longer path walks into nested objects, e.g.
+    # "2.result.price".
+    if isinstance(value, dict) and set(value) == {"$ref"}:
+        index, *path = str(value["$ref"]).split(".")
+
+        try:
+            target = results[int(index)]["body"]
+
+            for name in path:
+                target = target[name]
+
+        except (IndexError, KeyError, TypeError, ValueError):
+            raise BatchError(f"cannot resolve reference {value['$ref']}")
+
+        return target
+
+    if isinstance(value, dict):
+        return {name: resolve_refs(item, results) for name, item in value.items()}
+
+    if isinstance(value, list):
+        return [resolve_refs(item, results) for item in value]
+
+    return value
+
+
+def run_batch(post_data, max_operations):
+    # Runs the operations in order inside the caller's one transaction. The
+    # first operation that fails stops the batch and rolls everything back;
+    # otherwise all of it is committed together.
+    operations = post_data.get("operations") if isinstance(post_data, dict) else None
+
+    if not isinstance(operations, list) or operations == []:
+        return Reply({"message": "operations must be a non-empty list"}, 400)
+
+    if len(operations) > max_operations:
+        return Reply({"message": f"a batch can have at most {max_operations} operations"}, 400)
+
+    results = []
+    invalidate = []
+    invalidate_tables = []
+
+    for index, operation in enumerate(operations):
+        name = operation.get("op") if isinstance(operation, dict) else None
+
+        if name not in batch_operations:
+            return Reply({"message": f"unknown op at operation {index}: {name}", "failed": index, "results": results}, 400, rollback=True)
+
+        try:
+            data = resolve_refs(operation.get("data") or {}, results)
+        except BatchError as e:
+            return Reply({"message": f"{e} at operation {index}", "failed": index, "results": results}, 400, rollback=True)
+
+        # data may be a bare $ref, or not an object to begin with.
+        if not isinstance(data, dict):
+            return Reply({"message": f"data must be an object at operation {index}", "failed": index, "results": results}, 400, rollback=True)
+
+        reply = yield from batch_operations[name](data)
+        results.append({"op": name, "status": reply.status, "body": reply.body})
+
+        if reply.status >= 400:
+            return Reply({"message": f"operation {index} failed, batch rolled back", "failed": index, "results": results}, reply.status, rollback=True)
+
+        invalidate += reply.invalidate
+        invalidate_tables += reply.invalidate_tables
+
+    return Reply(
+        {"message": f"{len(results)} operations completed", "results": results}, 200,
+        invalidate=invalidate,
+        invalidate_tables=invalidate_tables,
+    )
+
+
+# UPDATE
+
+def update_by_id(schema, record_id, post_data, name):
+    if not is_object(post_data):
+        return Reply({"message": "request body must be a JSON object"}, 400)
+
+    set_str, set_value_tuple = queries.set_clause(post_data, queries.updatable_fields[schema.name])
+
+    if set_str == '':
+        return Reply({"message": "nothing to update"}, 400)
+
+    # RETURNING both tells us whether the row existed and hands back the
+    # updated record, so there is no existence check or re-read.
+    try:
+        result = yield queries.update_by_id(schema, set_str, set_value_tuple, record_id)
+
+    except QueryError as e:
+        return Reply({"message": f"{name.capitalize()} could not be updated", "Error": str(e)}, 400)
+
+    if result == None:
+        return Reply({"message": f"{name} not found"}, 404)
+
+    return Reply({"message": f"{name} updated", "result": schema.to_record(result)}, 200, invalidate=[(schema.name, [record_id])])
+
+
+def update_by_ids(schema, post_data, name):
+    if not is_object(post_data):
+        return Reply({"message": "request body must be a JSON object"}, 400)
+
+    ids = post_data.get('ids')
+
+    if not isinstance(ids, list) or ids == []:
+        return Reply({"message": "ids must be a non-empty list"}, 400)
+
+    set_str, set_value_tuple = queries.set_clause(post_data, queries.updatable_fields[schema.name])
+
+    if set_str == '':
+        return Reply({"message": "nothing to update"}, 400)
+
+    try:
+        result = yield queries.update_by_ids(schema, set_str, set_value_tuple, ids)
+
+    except QueryError as e:
+        return Reply({"message": f"{name.capitalize()} could not be updated", "Error": str(e)}, 400)
+
+    record_list = [schema.to_record(record) for record in result]
+    updated_ids = [record[schema.key] for record in record_list]
+
+    found = {str(record_id) for record_id in updated_ids}
+    not_found = [record_id for record_id in ids if str(record_id) not in found]
+
+    if record_list == []:
+        return Reply({"message": f"{name} not found", "not_found": not_found}, 404)
+
+    return Reply({"message": f"{name} updated", "results": record_list, "not_found": not_found}, 200, invalidate=[(schema.name, updated_ids)])
+
+
+# DELETE
+
+# Dependent tables whose rows a delete removes through ON DELETE CASCADE,
+# or an archive flips to inactive, so their cached entries have to go as
+# well.
+cascades = {
+    companies.name: [products.name, warranties.name],
+    products.name: [warranties.name],
+}
+
+archive_cascades = {
+    companies.name: [products.name],
+}
+
+
+def delete_by_id(schema, record_id, name):
+    try:
+        result = yield queries.delete_by_id(schema, record_id)
+
+    except QueryError as e:
+        return Reply({"message": f"{name.capitalize()} could not be deleted", "Error": str(e)}, 400)
+
+    if result == None:
+        return Reply({"message": f"{name} does not exist"}, 404)
+
+    return Reply(
+        {"message": f"{name.capitalize()} deleted successfully"}, 200,
+        invalidate=[(schema.name, [record_id])],
+        invalidate_tables=cascades.get(schema.name, []),
+    )
+
+
+def delete_by_ids(schema, post_data, name):
+    if not is_object(post_data):
+        return Reply({"message": "request body must be a JSON object"}, 400)
+
+    ids = post_data.get('ids')
+
+    if not isinstance(ids, list) or ids == []:
+        return Reply({"message": "ids must be a non-empty list"}, 400)
+
+    try:
+        result = yield queries.delete_by_ids(schema, ids)
+
+    except QueryError as e:
+        return Reply({"message": f"{name.capitalize()} could not be deleted", "Error": str(e)}, 400)
+
+    deleted_ids = [row[0] for row in result]
+
+    found = {str(record_id) for record_id in deleted_ids}
+    not_found = [record_id for record_id in ids if str(record_id) not in found]
+
+    if deleted_ids == []:
+        return Reply({"message": f"{name} not found", "not_found": not_found}, 404)
+
+    return Reply(
+        {"message": f"{name} deleted", "deleted": deleted_ids, "not_found": not_found}, 200,
+        invalidate=[(schema.name, deleted_ids)],
+        invalidate_tables=cascades.get(schema.name, []),
+    )
+
+
+def archive_by_id(schema, record_id, name):
+    # Soft delete: one UPDATE flips active, and the purge job removes the
+    # row (and its dependents) later, off the request path.
+    try:
+        result = yield queries.archive_by_id(schema, record_id)
+
+    except QueryError as e:
+        return Reply({"message": f"{name.capitalize()} could not be archived", "Error": str(e)}, 400)
+
+    if result == None:
+        return Reply({"message": f"{name} does not exist"}, 404)
+
+    return Reply(
+        {"message": f"{name.capitalize()} archived successfully"}, 200,
+        invalidate=[(schema.name, [record_id])],
+        invalidate_tables=archive_cascades.get(schema.name, []),
+    )
+
+
+def archive_by_ids(schema, post_data, name):
+    if not is_object(post_data):
+        return Reply({"message": "request body must be a JSON object"}, 400)
+
+    ids = post_data.get('ids')
+
+    if not isinstance(ids, list) or ids == []:
+        return Reply({"message": "ids must be a non-empty list"}, 400)
+
+    try:
+        result = yield queries.archive_by_ids(schema, ids)
+
+    except QueryError as e:
+        return Reply({"message": f"{name.capitalize()} could not be archived", "Error": str(e)}, 400)
+
+    archived_ids = [row[0] for row in result]
+
+    found = {str(record_id) for record_id in archived_ids}
+    not_found = [record_id for record_id in ids if str(record_id) not in found]
+
+    if archived_ids == []:
+        return Reply({"message": f"{name} not found", "not_found": not_found}, 404)
+
+    return Reply(
+        {"message": f"{name} archived", "archived": archived_ids, "not_found": not_found}, 200,
+        invalidate=[(schema.name, archived_ids)],
+        invalidate_tables=archive_cascades.get(schema.name, []),
+    )
+
+
+def remove_by_ids(schema, post_data, name, hard=False):
+    # Tables with an active column are archived unless a hard delete is
+    # asked for; the rest can only be deleted.
+    if queries.archivable(schema) and not hard:
+        return archive_by_ids(schema, post_data, name)
+
+    return delete_by_ids(schema, post_data, name)
+
+
+def delete_company_products_chunk(company_id, chunk_size):
+    result = yield queries.delete_company_products_chunk(company_id, chunk_size)
+
+    return result[0]
+
+
+def purge_archived_chunk(schema, chunk_size):
+    result = yield queries.purge_archived_chunk(schema, chunk_size)
+
+    return result[0]
+
+
+def delete_company_by_id(company_id, hard=False):
+    if hard:
+        return delete_by_id(companies, company_id, "company")
+
+    return archive_by_id(companies, company_id, "company")
+
+
+def delete_product_by_id(product_id, hard=False):
+    if hard:
+        return delete_by_id(products, product_id, "product")
+
+    return archive_by_id(products, product_id, "product")
+
+
+def delete_category_by_id(category_id):
+    return delete_by_id(categories, category_id, "category")
+
+
+def delete_warranty_by_id(warranty_id):
+    return delete_by_id(warranties, warranty_id, "warranty")
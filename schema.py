@@ -0,0 +1,175 @@
+from json.encoder import encode_basestring_ascii
+
+
+def encode_int(value):
+    return 'null' if value is None else str(value)
+
+
+def encode_str(value):
+    return 'null' if value is None else encode_basestring_ascii(value)
+
+
+def encode_bool(value):
+    return 'null' if value is None else ('true' if value else 'false')
+
+
+def encode_decimal(value):
+    # Prices go out as strings, the same way jsonify renders a Decimal, so
+    # no precision is lost and clients see the format they always have.
+    # Selecting price::text skips building the Decimal in the first place.
+    return 'null' if value is None else encode_basestring_ascii(str(value))
+
+
+def encode_float(value):
+    return 'null' if value is None else repr(float(value))
+
+
+def encode_json(value):
+    # Selected as ::text, so the value already is JSON.
+    return 'null' if value is None else value
+
+
+encoders = {
+    "int": encode_int,
+    "float": encode_float,
+    "str": encode_str,
+    "bool": encode_bool,
+    "decimal": encode_decimal,
+    "json": encode_json,
+}
+
+
+class Column:
+    def __init__(self, name, kind, sql=None):
+        self.name = name
+        self.kind = kind
+        self.sql = sql or name
+
+
+class TableSchema:
+    def __init__(self, name, key, columns):
+        self.name = name
+        self.key = key
+        self.columns = columns
+        self.column_names = [column.name for column in columns]
+        self.key_index = self.column_names.index(key) if key else None
+
+        # Selecting (and RETURNING) an explicit column list pins the tuple
+        # positions the converters below are compiled against.
+        self.select_list = ", ".join(
+            column.name if column.sql == column.name else f"{column.sql} AS {column.name}"
+            for column in columns
+        )
+
+        self.to_record = self._compile_record()
+        self.to_json = self._compile_json()
+        self._projections = {}
+
+    def project(self, names):
+        # A narrower schema over the same table for ?fields= listings, with
+        # its own select list and compiled converters. Compiled once per
+        # distinct field set and kept, since the set of field combinations
+        # clients actually use is small.
+        names = tuple(name for name in self.column_names if name in names)
+
+        if names == tuple(self.column_names):
+            return self
+
+        projection = self._projections.get(names)
+
+        if projection is None:
+            projection = TableSchema(self.name, self.key, [column for column in self.columns if column.name in names])
+            self._projections[names] = projection
+
+        return projection
+
+    def _compile_record(self):
+        items = ", ".join(f"{name!r}: row[{index}]" for index, name in enumerate(self.column_names))
+
+        return eval(f"lambda row: {{{items}}}")
+
+    def _compile_json(self):
+        # Renders a row straight to a JSON object string, without building
+        # an intermediate dict.
+        template = "{" + ",".join(f'"{name}":%s' for name in self.column_names) + "}"
+        values = ", ".join(f"encode_{index}(row[{index}])" for index in range(len(self.columns)))
+        namespace = {f"encode_{index}": encoders[column.kind] for index, column in enumerate(self.columns)}
+
+        return eval(f"lambda row: {template!r} % ({values},)", namespace)
+
+
+companies = TableSchema("Companies", "company_id", [
+    Column("company_id", "int"),
+    Column("company_name", "str"),
+    Column("active", "bool"),
+])
+
+categories = TableSchema("Categories", "category_id", [
+    Column("category_id", "int"),
+    Column("category_name", "str"),
+])
+
+products = TableSchema("Products", "product_id", [
+    Column("product_id", "int"),
+    Column("product_name", "str"),
+    Column("company_id", "int"),
+    Column("description", "str"),
+    Column("price", "decimal", "price::text"),
+    Column("active", "bool"),
+])
+
+warranties = TableSchema("Warranties", "warranty_id", [
+    Column("warranty_id", "int"),
+    Column("warranty_months", "int"),
+    Column("product_id", "int"),
+])
+
+products_categories = TableSchema("ProductsCategoriesXref", None, [
+    Column("product_id", "int"),
+    Column("category_id", "int"),
+])
+
+# Catalog statistics, read from the materialized views of migration 0009.
+# refreshed_at is rendered by Postgres as an ISO 8601 string.
+
+def stats_columns():
+    return [
+        Column("product_count", "int"),
+        Column("active_product_count", "int"),
+        Column("avg_price", "decimal", "avg_price::text"),
+        Column("min_price", "decimal", "min_price::text"),
+        Column("max_price", "decimal", "max_price::text"),
+        Column("warranted_product_count", "int"),
+        Column("warranty_coverage", "float"),
+        Column("refreshed_at", "str", "to_json(refreshed_at) #>> '{}'"),
+    ]
+
+company_stats = TableSchema("CompanyStats", "company_id", [
+    Column("company_id", "int"),
+    Column("company_name", "str"),
+] + stats_columns())
+
+category_stats = TableSchema("CategoryStats", "category_id", [
+    Column("category_id", "int"),
+    Column("category_name", "str"),
+] + stats_columns())
+
+catalog_stats = TableSchema("CatalogStats", "stats_id", [
+    Column("stats_id", "int"),
+    Column("company_count", "int"),
+    Column("category_count", "int"),
+    Column("warranty_count", "int"),
+] + stats_columns())
+
+# The /changes feed, from the outbox of migration 0010.
+change_log = TableSchema("ChangeLog", "change_id", [
+    Column("change_id", "int"),
+    Column("txid", "int"),
+    Column("table_name", "str"),
+    Column("operation", "str"),
+    Column("record_key", "json", "record_key::text"),
+    Column("data", "json", "data::text"),
+    Column("changed_at", "str", "to_json(changed_at) #>> '{}'"),
+])
+
+tables = {schema.name: schema for schema in [companies, categories, products, warranties, products_categories]}
@@ -0,0 +1,143 @@
+import fcntl
+import os
+import tempfile
+import time
+
+import db
+import jobs
+import metrics
+import prepared
+import queries
+from app import create_all
+from cache import cache, cache_backend, record_key
+from schema import categories, companies, products, warranties
+
+# Server hooks for running the Flask app under gunicorn (gunicorn.conf.py
+# wires them up):
+#
+#     gunicorn -c gunicorn.conf.py
+#
+# The app is preloaded in the arbiter, which applies migrations and closes
+# its connections before forking. Each worker then opens its own database
+# pool, warms it (and the read cache) and only then starts accepting. On
+# SIGTERM, workers stop accepting and in-flight requests get up to
+# WEB_DRAIN_TIMEOUT seconds to finish.
+#
+# Each worker has its own pool of up to DB_POOL_MAX connections, so size
+# max_connections for workers * DB_POOL_MAX. The memory cache is per
+# worker, which is why more than one worker needs CACHE_BACKEND=redis (or
+# none). Jobs are kept in the database, so /jobs/<job_id> answers from any
+# worker, and /metrics adds up every worker's counts (see
+# metrics.share_across_processes). The purge scheduler and stats refresher
+# run in one worker at a time.
+
+# Newest rows per table loaded into the by-id read cache at warmup.
+cache_warm_size = int(os.environ.get("CACHE_WARM_SIZE", 1000))
+scheduler_lock_path = os.path.join(tempfile.gettempdir(), f"psy_crud-scheduler-{os.environ.get('APP_PORT', 8086)}.lock")
+metrics_dir = os.environ.get("METRICS_DIR") or os.path.join(tempfile.gettempdir(), f"psy_crud-metrics-{os.environ.get('APP_PORT', 8086)}")
+
+cached_tables = [companies, categories, products, warranties]
+_scheduler_lock = None
+
+
+def warm_queries():
+    # The prepared statements nearly every request needs: the by-id reads
+    # and the conditional-GET version lookup.
+    return [queries.by_id(schema, 0) for schema in cached_tables] + [queries.table_versions([products.name.lower()])]
+
+
+def warm_pool():
+    # Checks out DB_POOL_MIN connections at once, so each is a separate
+    # session, and prepares the hot statements on every one of them.
+    db_pool = db.get_pool()
+    conns = [db_pool.getconn() for _ in range(db.pool_min)]
+
+    try:
+        for conn in conns:
+            cursor = conn.cursor()
+
+            for query in warm_queries():
+                prepared.execute(cursor, query)
+
+            conn.rollback()
+
+    finally:
+        for conn in conns:
+            db_pool.putconn(conn)
+
+    return len(conns)
+
+
+def warm_cache(size):
+    if size <= 0 or cache_backend == "none":
+        return 0
+
+    loaded = 0
+
+    with db.connection() as conn:
+        cursor = conn.cursor()
+
+        for schema in cached_tables:
+            def load():
+                query = queries.page(queries.Listing(schema, descending=True), size)
+                cursor.execute(query.sql, query.params)
+
+                return [(record_key(schema.name, row[schema.key_index]), schema.to_record(row)) for row in cursor.fetchall()]
+
+            loaded += cache.prime(schema.name, load)
+
+        conn.rollback()
+
+    return loaded
+
+
+def take_scheduler_lock():
+    # Held by the worker for as long as it lives; when it exits, the worker
+    # gunicorn starts in its place takes over.
+    global _scheduler_lock
+
+    lock = open(scheduler_lock_path, "w")
+
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return False
+
+    _scheduler_lock = lock
+
+    return True
+
+
+def on_starting(server):
+    # Each worker would have its own memory cache, and a write in one
+    # would leave the others serving the old record until CACHE_TTL.
+    if server.cfg.workers > 1 and cache_backend == "memory":
+        raise SystemExit("CACHE_BACKEND=memory cannot be shared by more than one worker; use redis or none, or WEB_WORKERS=1")
+
+    if server.cfg.workers > 1:
+        metrics.share_across_processes(metrics_dir)
+
+    create_all()
+    # Nothing opened before the fork may be shared with the workers.
+    db.close_pool()
+
+
+def post_fork(server, worker):
+    metrics.reset()
+    metrics.start_snapshots()
+    start = time.perf_counter()
+    db.get_replicas()
+    conns = warm_pool()
+    records = warm_cache(cache_warm_size)
+    server.log.info(f"worker {worker.pid} warmed {conns} connection(s) and {records} cached record(s) in {time.perf_counter() - start:.2f}s")
+
+    if take_scheduler_lock():
+        server.log.info(f"worker {worker.pid} runs the purge scheduler and stats refresher")
+        jobs.start_purge_scheduler()
+        jobs.start_stats_refresher()
+
+
+def worker_exit(server, worker):
+    metrics.write_snapshot()
+    db.close_pool()
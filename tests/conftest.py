@@ -0,0 +1,39 @@
+import pytest
+
+# Unit tests for the pure parts of the app (query building, cursors, route
+# generators, result mapping); none of them need a database. Route
+# operations are driven with canned results in place of db.run.
+
+
+def run_operation(operation, results=()):
+    # Runs a routes.* generator, sending it results in order; returns the
+    # queries it yielded and its Reply (or return value).
+    queries = []
+    results = iter(results)
+
+    try:
+        query = next(operation)
+
+        while True:
+            queries.append(query)
+            query = operation.send(next(results, None))
+
+    except StopIteration as stop:
+        return queries, stop.value
+
+
+@pytest.fixture
+def drive():
+    return run_operation
+
+
+@pytest.fixture
+def run_with():
+    # A stand-in for db.run that answers every query from results.
+    def make(*results):
+        def run(operation, conn=None):
+            return run_operation(operation, results)[1]
+
+        return run
+
+    return make
@@ -0,0 +1,73 @@
+import pytest
+
+import routes
+
+
+def test_resolve_refs():
+    results = [{"op": "add_product", "status": 201, "body": {"product_id": 4, "result": {"price": "1.00"}}}]
+
+    assert routes.resolve_refs({"$ref": "0.product_id"}, results) == 4
+    assert routes.resolve_refs({"$ref": "0.result.price"}, results) == "1.00"
+    assert routes.resolve_refs(
+        {"warranty_months": 12, "product_id": {"$ref": "0.product_id"}, "ids": [{"$ref": "0.product_id"}, 5]}, results
+    ) == {"warranty_months": 12, "product_id": 4, "ids": [4, 5]}
+
+
+def test_resolve_refs_leaves_other_objects():
+    # Only an object whose one key is $ref is a reference.
+    value = {"$ref": "0.product_id", "other": 1}
+
+    assert routes.resolve_refs(value, []) == value
+
+
+@pytest.mark.parametrize("ref", ["1.product_id", "0.missing", "x.product_id", "0.product_id.deeper"])
+def test_resolve_refs_rejects_unresolvable(ref):
+    results = [{"body": {"product_id": 4}}]
+
+    with pytest.raises(routes.BatchError):
+        routes.resolve_refs({"$ref": ref}, results)
+
+
+def batch(*operations):
+    return routes.run_batch({"operations": list(operations)}, 10)
+
+
+def test_batch_runs_in_order_and_resolves_refs(drive):
+    queries, reply = drive(batch(
+        {"op": "add_company", "data": {"company_name": "a"}},
+        {"op": "add_product", "data": {"product_name": "p", "company_id": {"$ref": "0.company_id"}}},
+    ), [(7, True), (9, True)])
+
+    assert reply.status == 200
+    assert not reply.rollback
+    assert queries[1].params[1] == 7
+    assert [result["status"] for result in reply.body["results"]] == [201, 201]
+
+
+@pytest.mark.parametrize("data", [["a"], "a", 5, {"$ref": "0.company_id"}])
+def test_batch_rejects_data_that_is_not_an_object(drive, data):
+    queries, reply = drive(batch(
+        {"op": "add_company", "data": {"company_name": "a"}},
+        {"op": "update_company", "data": data},
+    ), [(7, True)])
+
+    assert reply.status == 400
+    assert reply.rollback
+    assert reply.body["failed"] == 1
+    assert len(queries) == 1
+
+
+@pytest.mark.parametrize("post_data", [None, {}, {"operations": []}, {"operations": {"op": "add_company"}}])
+def test_batch_needs_operations(drive, post_data):
+    queries, reply = drive(routes.run_batch(post_data, 10))
+
+    assert reply.status == 400
+    assert queries == []
+
+
+def test_batch_stops_at_unknown_op(drive):
+    queries, reply = drive(batch({"op": "drop_table"}))
+
+    assert reply.status == 400
+    assert reply.rollback
+    assert reply.body["failed"] == 0
@@ -0,0 +1,54 @@
+import bulk
+
+
+def test_validate_applies_defaults_and_flags_invalid():
+    rows, results = bulk._validate(bulk.company_spec, [{"company_name": "a"}, {"company_name": " "}, "nope"])
+
+    assert rows == [(0, ("a", True))]
+    assert results[0] is None
+    assert results[1] == {"index": 1, "status": "invalid", "message": "company_name is a required field"}
+    assert results[2]["status"] == "invalid"
+
+
+def test_results_map_by_bulk_index(monkeypatch):
+    # Inserted rows come back as (bulk_index, id); every other valid row
+    # lost to a conflict, whatever its input looked like.
+    monkeypatch.setattr(bulk, "_insert_values", lambda cursor, spec, rows: [(0, 11), (3, 12)])
+
+    records = [{"product_name": "p", "company_id": "05"}, {"product_name": "p", "company_id": 5.0}, {"company_id": 1}, {"product_name": "q", "company_id": " 5"}]
+    summary, results = bulk.bulk_insert(None, bulk.product_spec, records)
+
+    assert summary == {"created": 2, "conflict": 1, "invalid": 1}
+    assert results[0] == {"index": 0, "status": "created", "product_id": 11}
+    assert results[1] == {"index": 1, "status": "conflict"}
+    assert results[2]["status"] == "invalid"
+    assert results[3] == {"index": 3, "status": "created", "product_id": 12}
+
+
+def test_duplicate_warranties_conflict(monkeypatch):
+    monkeypatch.setattr(bulk, "_insert_values", lambda cursor, spec, rows: [(0, 7)])
+
+    summary, results = bulk.bulk_insert(None, bulk.warranty_spec, [{"warranty_months": 12, "product_id": 1}, {"warranty_months": "12", "product_id": 1}])
+
+    assert summary == {"created": 1, "conflict": 1, "invalid": 0}
+    assert results == [{"index": 0, "status": "created", "warranty_id": 7}, {"index": 1, "status": "conflict"}]
+
+
+def test_large_batches_use_copy(monkeypatch):
+    used = []
+    monkeypatch.setattr(bulk, "bulk_copy_threshold", 2)
+    monkeypatch.setattr(bulk, "_insert_copy", lambda cursor, spec, rows: used.append("copy") or [])
+    monkeypatch.setattr(bulk, "_insert_values", lambda cursor, spec, rows: used.append("values") or [])
+
+    bulk.bulk_insert(None, bulk.category_spec, [{"category_name": "a"}])
+    bulk.bulk_insert(None, bulk.category_spec, [{"category_name": "a"}, {"category_name": "b"}])
+
+    assert used == ["values", "copy"]
+
+
+def test_insert_sql_joins_on_unique_key():
+    sql = " ".join(bulk._insert_sql(bulk.xref_spec, "input").split())
+
+    assert "ON CONFLICT (product_id, category_id) DO NOTHING" in sql
+    assert "JOIN input AS source USING (product_id, category_id)" in sql
+    assert "SELECT min(source.bulk_index), NULL" in sql
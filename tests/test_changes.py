@@ -0,0 +1,33 @@
+import pytest
+
+import routes
+
+
+def test_parse_changes():
+    after, table_names = routes.parse_changes({"after": routes.encode_cursor(120, 4), "tables": "products,warranties"})
+
+    assert after == (120, 4)
+    assert table_names == ["products", "warranties"]
+
+
+def test_parse_changes_falls_back_to_last_event_id():
+    assert routes.parse_changes({}, routes.encode_cursor(5, 6)) == ((5, 6), [])
+    assert routes.parse_changes({}) == (None, [])
+
+
+@pytest.mark.parametrize("txid, change_id", [(True, 1), (1, False), ("1", 1), (1.0, 1), (None, 1)])
+def test_parse_changes_rejects_bad_cursor(txid, change_id):
+    with pytest.raises(routes.ListingError):
+        routes.parse_changes({"after": routes.encode_cursor(txid, change_id)})
+
+
+def test_parse_changes_rejects_unknown_tables():
+    with pytest.raises(routes.ListingError):
+        routes.parse_changes({"tables": "products,IdempotencyKeys"})
+
+
+def test_expired_cursor_is_gone(drive):
+    queries, reply = drive(routes.list_changes((120, 4), [], 10), [(False,)])
+
+    assert reply.status == 410
+    assert len(queries) == 1
@@ -0,0 +1,134 @@
+import pytest
+from flask import Flask, g
+
+import idempotency
+import routes
+
+
+def test_claim_returns_none_when_claimed(drive):
+    queries, result = drive(routes.claim_idempotency_key("k", "h", 60, 10), [("k",)])
+
+    assert result is None
+    assert len(queries) == 1
+    assert queries[0].params == ("k", "h", 60, 10)
+
+
+def test_claim_returns_the_holding_entry(drive):
+    entry = ("h", 201, "application/json", b"{}")
+    queries, result = drive(routes.claim_idempotency_key("k", "h", 60, 10), [None, entry])
+
+    assert result == entry
+    assert len(queries) == 2
+
+
+def test_claim_released_in_between_reports_running(drive):
+    queries, result = drive(routes.claim_idempotency_key("k", "h", 60, 10), [None, None])
+
+    assert result == ("h", None, None, None)
+
+
+@pytest.fixture
+def app():
+    return Flask(__name__)
+
+
+def post(app, body=b'{"a": 1}', key="k"):
+    return app.test_request_context("/company", method="POST", data=body, headers={idempotency.header: key} if key else {})
+
+
+def test_first_request_claims(app, monkeypatch, run_with):
+    monkeypatch.setattr(idempotency.db, "run", run_with(("k",)))
+
+    with post(app):
+        assert idempotency.before_request() is None
+        assert g.idempotency_key == "k"
+
+
+def test_retry_is_replayed(app, monkeypatch, run_with):
+    with post(app):
+        fingerprint = idempotency.request_hash()
+
+    monkeypatch.setattr(idempotency.db, "run", run_with(None, (fingerprint, 201, "application/json", b'{"company_id": 1}')))
+
+    with post(app):
+        response = idempotency.before_request()
+
+    assert response.status_code == 201
+    assert response.get_data() == b'{"company_id": 1}'
+    assert response.headers["Idempotent-Replayed"] == "true"
+
+
+def test_retry_while_running_conflicts(app, monkeypatch, run_with):
+    with post(app):
+        fingerprint = idempotency.request_hash()
+
+    monkeypatch.setattr(idempotency.db, "run", run_with(None, (fingerprint, None, None, None)))
+
+    with post(app):
+        response, status = idempotency.before_request()
+
+    assert status == 409
+
+
+def test_key_reused_for_another_request(app, monkeypatch, run_with):
+    monkeypatch.setattr(idempotency.db, "run", run_with(None, ("other", 201, "application/json", b"{}")))
+
+    with post(app):
+        response, status = idempotency.before_request()
+
+    assert status == 422
+
+
+def test_requests_without_key_or_for_reads_pass(app, monkeypatch):
+    monkeypatch.setattr(idempotency.db, "run", lambda *args: pytest.fail("should not touch the database"))
+
+    with post(app, key=None):
+        assert idempotency.before_request() is None
+
+    with app.test_request_context("/company/1", headers={idempotency.header: "k"}):
+        assert idempotency.before_request() is None
+
+
+def test_overlong_key(app):
+    with post(app, key="k" * (idempotency.max_key_length + 1)):
+        response, status = idempotency.before_request()
+
+    assert status == 400
+
+
+def test_request_hash_covers_body_and_path(app):
+    with post(app):
+        first = idempotency.request_hash()
+
+    with post(app, body=b'{"a": 2}'):
+        assert idempotency.request_hash() != first
+
+    with app.test_request_context("/category", method="POST", data=b'{"a": 1}'):
+        assert idempotency.request_hash() != first
+
+
+class FakeConnection:
+    closed = False
+
+
+def test_release_uses_the_request_connection(app, monkeypatch):
+    released = []
+    conn = FakeConnection()
+    monkeypatch.setattr(idempotency.db, "connection", lambda: pytest.fail("should not check out a second connection"))
+    monkeypatch.setattr(idempotency.db, "run", lambda operation, conn=None: released.append(conn))
+
+    with post(app):
+        g.db_conn = conn
+        g.idempotency_key = "k"
+        idempotency.teardown_request()
+
+    assert released == [conn]
+
+
+def test_stored_response_is_not_released(app, monkeypatch):
+    monkeypatch.setattr(idempotency.db, "run", lambda *args: pytest.fail("should not touch the database"))
+
+    with post(app):
+        g.idempotency_key = "k"
+        g.idempotency_stored = True
+        idempotency.teardown_request()
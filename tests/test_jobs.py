@@ -0,0 +1,46 @@
+import json
+
+import jobs
+import routes
+
+
+def test_save_job_stores_json_and_forgets_old_finished_jobs(drive):
+    job = jobs.Job("purge_archived", {"batch_size": 10})
+    job.progress["Products"] = 3
+
+    queries, result = drive(routes.save_job(job.to_dict(), 100))
+
+    assert len(queries) == 1
+    params = queries[0].params
+    assert params[0] == job.job_id
+    assert json.loads(params[2]) == {"batch_size": 10}
+    assert json.loads(params[4]) == {"Products": 3}
+    assert params[5] is None
+
+    job.finished_at = 1.0
+    queries, result = drive(routes.save_job(job.to_dict(), 100))
+
+    assert len(queries) == 2
+    assert queries[1].params == (100,)
+
+
+def test_get_job(drive):
+    row = ("abc", "refresh_stats", {}, "done", {"refreshed": True}, {"refreshed": True}, None, 1.0, 2.0)
+
+    queries, reply = drive(routes.get_job("abc"), [row])
+    assert reply.status == 200
+    assert reply.body["result"]["status"] == "done"
+    assert reply.body["result"]["finished_at"] == 2.0
+
+    queries, reply = drive(routes.get_job("missing"), [None])
+    assert reply.status == 404
+
+
+def test_submit_saves_before_returning(monkeypatch):
+    saved = []
+    monkeypatch.setattr(jobs.Job, "save", lambda job: saved.append(job.status))
+
+    job = jobs.submit("noop", lambda job: None)
+
+    assert saved[0] == "pending"
+    assert job.job_id
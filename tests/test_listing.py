@@ -0,0 +1,150 @@
+from decimal import Decimal
+
+import pytest
+
+import queries
+import routes
+from schema import companies, products
+
+
+def listing(schema, sort=None, descending=False, after=None):
+    return queries.Listing(schema, sort=sort, descending=descending, after=after)
+
+
+def test_keyset_by_key():
+    assert queries.keyset_str(listing(products, after=10)) == ("product_id > %s", (10,))
+    assert queries.keyset_str(listing(products, descending=True, after=10)) == ("product_id < %s", (10,))
+
+
+def test_keyset_by_non_nullable_sort():
+    condition, params = queries.keyset_str(listing(products, "product_name", after=("b", 3)))
+
+    assert condition == "(product_name, product_id) > (%s, %s)"
+    assert params == ("b", 3)
+
+
+def test_keyset_by_nullable_sort():
+    # price sorts NULLs last ascending and first descending.
+    ascending = listing(products, "price", after=(Decimal("2.50"), 3))
+    assert queries.keyset_str(ascending) == ("(price > %s OR (price = %s AND product_id > %s) OR price IS NULL)", (Decimal("2.50"), Decimal("2.50"), 3))
+
+    descending = listing(products, "price", descending=True, after=(Decimal("2.50"), 3))
+    assert queries.keyset_str(descending) == ("(price <= %s AND (price < %s OR product_id < %s))", (Decimal("2.50"), Decimal("2.50"), 3))
+
+    assert queries.keyset_str(listing(products, "price", after=(None, 3))) == ("(price IS NULL AND product_id > %s)", (3,))
+    assert queries.keyset_str(listing(products, "price", descending=True, after=(None, 3))) == ("((price IS NULL AND product_id < %s) OR price IS NOT NULL)", (3,))
+
+
+def test_page_puts_keyset_params_before_limit():
+    query = queries.page(listing(products, "product_name", after=("b", 3)), 20)
+
+    assert query.params == ("b", 3, 20)
+    assert "ORDER BY Products.product_name, Products.product_id" in query.sql
+
+
+def test_cursor_round_trip():
+    cursor = routes.encode_cursor("2.50", 7)
+
+    assert routes.decode_cursor(cursor) == ("2.50", 7)
+
+
+@pytest.mark.parametrize("cursor", ["not base64!", routes.encode_cursor("a", 1)[:-2], "WzFd"])
+def test_decode_cursor_rejects_garbage(cursor):
+    with pytest.raises(routes.ListingError):
+        routes.decode_cursor(cursor)
+
+
+def test_next_after():
+    rows = [(1, "a", True), (2, "b", True)]
+
+    assert routes.next_after(rows, listing(companies), 3) is None
+    assert routes.next_after(rows, listing(companies), 2) == 2
+    assert routes.decode_cursor(routes.next_after(rows, listing(companies, "company_name"), 2)) == ("b", 2)
+
+
+def test_parse_listing_decodes_sort_cursor():
+    parsed = routes.parse_listing(products, {"sort": "-price", "after": routes.encode_cursor("2.50", 7)})
+
+    assert parsed.after == (Decimal("2.50"), 7)
+    assert parsed.descending
+
+
+def test_parse_listing_key_cursor():
+    assert routes.parse_listing(products, {"after": "12"}).after == 12
+
+    with pytest.raises(routes.ListingError):
+        routes.parse_listing(products, {"after": "x"})
+
+
+@pytest.mark.parametrize("sort, value, key_value", [
+    ("price", "10.00", "x"),
+    ("price", "10.00", True),
+    ("price", "10.00", 1.5),
+    ("price", "ten", 1),
+    ("price", [1], 1),
+    ("product_name", 1, 2),
+    ("product_name", "b", None),
+])
+def test_parse_listing_rejects_bad_sort_cursor(sort, value, key_value):
+    with pytest.raises(routes.ListingError):
+        routes.parse_listing(products, {"sort": sort, "after": routes.encode_cursor(value, key_value)})
+
+
+def test_route_filters_are_anded_with_the_query_string():
+    company_filter = queries.filterable_fields[products.name]["company_id"][0]
+
+    parsed = routes.parse_listing(products, {"company_id": "5"}, {"company_id": "3"})
+    assert parsed.filters == [(company_filter, [3]), (company_filter, [5])]
+
+    active_filter = queries.filterable_fields[products.name]["active"][0]
+
+    parsed = routes.parse_listing(products, {"active": "false"}, {"active": True})
+    assert parsed.filters == [(active_filter, True), (active_filter, False)]
+
+    assert routes.parse_listing(products, {}, {"company_id": "3"}).filters == [(company_filter, [3])]
+
+
+def test_parse_listing_rejects_unknown_sort_and_fields():
+    with pytest.raises(routes.ListingError):
+        routes.parse_listing(products, {"sort": "description"})
+
+    with pytest.raises(routes.ListingError):
+        routes.parse_listing(products, {"fields": "product_name,secret"})
+
+
+def test_listing_tables_follow_includes_and_filters():
+    assert routes.listing_tables(products, {}) == []
+    assert routes.listing_tables(products, {"company_id": "3"}) == []
+    assert routes.listing_tables(products, {"category_id": ""}) == []
+    assert routes.listing_tables(products, {"category_id": "3"}) == ["productscategoriesxref"]
+    assert routes.listing_tables(products, {"include": "company,categories", "category_id": "3"}) == [
+        "companies", "categories", "productscategoriesxref"
+    ]
+
+
+def test_product_listing_validators_depend_on_category_filter(monkeypatch):
+    import app
+    import conditional
+
+    seen = []
+    monkeypatch.setattr(conditional, "get_table_versions", lambda tables: seen.append(tables) or [])
+    monkeypatch.setattr(app, "list_table", lambda schema, name, **defaults: ("", 200))
+
+    with app.app.test_client() as client:
+        client.get("/products?category_id=3")
+        client.get("/products")
+
+    assert seen == [["products", "productscategoriesxref"], ["products"]]
+
+
+def test_stream_rejects_include(monkeypatch):
+    import app
+    import conditional
+
+    monkeypatch.setattr(conditional, "get_table_versions", lambda tables: [])
+    monkeypatch.setattr(app, "stream_table", lambda *args: pytest.fail("should not stream"))
+
+    with app.app.test_client() as client:
+        response = client.get("/products?stream=ndjson&include=company")
+
+    assert response.status_code == 400
@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    counter = metrics.Counter("test_requests_total", "Requests.", ("route",))
+    histogram = metrics.Histogram("test_seconds", "Latency.", buckets=(0.1, 1.0))
+    monkeypatch.setattr(metrics, "registry", [counter, histogram])
+
+    return counter, histogram
+
+
+def test_shared_metrics_add_up_other_workers(registry, monkeypatch, tmp_path):
+    counter, histogram = registry
+    (tmp_path / "stale.json").write_text("{}")
+    metrics.share_across_processes(str(tmp_path))
+    monkeypatch.setattr(metrics, "shared_dir", str(tmp_path))
+
+    assert list(tmp_path.iterdir()) == []
+
+    counter.inc("/a")
+    histogram.observe(0.05)
+    (tmp_path / "1.json").write_text(json.dumps({
+        "test_requests_total": [[["/a"], 2], [["/b"], 1]],
+        "test_seconds": [[[], [[0, 1], 0.5, 1]]],
+    }))
+    (tmp_path / "2.json").write_text("not json")
+
+    states = metrics.collect()
+
+    assert states["test_requests_total"] == {("/a",): 3, ("/b",): 1}
+    assert states["test_seconds"] == {(): [[1, 1], 0.55, 2]}
+    # The worker's own counts are left alone.
+    assert counter.state() == {("/a",): 1}
+
+
+def test_snapshot_round_trip(registry, monkeypatch, tmp_path):
+    counter, histogram = registry
+    monkeypatch.setattr(metrics, "shared_dir", str(tmp_path))
+    counter.inc("/a", amount=4)
+    histogram.observe(2.0)
+
+    metrics.write_snapshot()
+    dumped = json.loads(next(tmp_path.glob("*.json")).read_text())
+
+    state = {}
+    counter.merge(state, dumped["test_requests_total"])
+    assert state == {("/a",): 4}
+
+    metrics.reset()
+    assert counter.state() == {} and histogram.state() == {}
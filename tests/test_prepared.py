@@ -0,0 +1,52 @@
+import prepared
+import queries
+
+
+def test_placeholders_become_positional():
+    statement = prepared.Statement("SELECT * FROM Products WHERE product_id = %s AND company_id = %s;")
+
+    assert statement.prepare_sql == f"PREPARE {statement.name} AS SELECT * FROM Products WHERE product_id = $1 AND company_id = $2;"
+    assert statement.execute_sql == f"EXECUTE {statement.name} (%s, %s)"
+
+
+def test_casts_are_repeated_on_execute():
+    statement = prepared.Statement("SELECT * FROM Products WHERE product_id = ANY(%s::INTEGER[]);")
+
+    assert statement.prepare_sql.endswith("product_id = ANY($1::INTEGER[]);")
+    assert statement.execute_sql == f"EXECUTE {statement.name} (%s::INTEGER[])"
+
+
+def test_literal_percent_is_unescaped():
+    statement = prepared.Statement("SELECT 'a%%' LIKE %s;")
+
+    assert statement.prepare_sql.endswith("SELECT 'a%' LIKE $1;")
+
+
+def test_statement_without_parameters():
+    statement = prepared.Statement("SELECT 1;")
+
+    assert statement.execute_sql == f"EXECUTE {statement.name}"
+
+
+def test_names_are_stable_and_cached():
+    sql = "SELECT %s;"
+
+    assert prepared.Statement(sql).name == prepared.Statement(sql).name
+    assert prepared.get_statement(sql) is prepared.get_statement(sql)
+    assert prepared.Statement("SELECT 2;").name != prepared.Statement(sql).name
+
+
+class FakeCursor:
+    def __init__(self):
+        self.connection = None
+        self.executed = []
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+
+
+def test_plain_connections_run_sql_as_is():
+    cursor = FakeCursor()
+    prepared.execute(cursor, queries.Query("SELECT %s;", (1,), "one", prepare=True))
+
+    assert cursor.executed == [("SELECT %s;", (1,))]
@@ -0,0 +1,32 @@
+import pytest
+
+import routes
+from schema import companies, products, warranties
+
+
+@pytest.mark.parametrize("post_data", [[1, 2], "ids", None, 3])
+@pytest.mark.parametrize("operation", [
+    lambda post_data: routes.add_company(post_data),
+    lambda post_data: routes.add_warranty(post_data),
+    lambda post_data: routes.update_by_id(companies, 1, post_data, "company"),
+    lambda post_data: routes.update_by_ids(warranties, post_data, "warranties"),
+    lambda post_data: routes.delete_by_ids(warranties, post_data, "warranties"),
+    lambda post_data: routes.remove_by_ids(products, post_data, "products"),
+])
+def test_non_object_bodies_are_rejected(drive, operation, post_data):
+    queries, reply = drive(operation(post_data))
+
+    assert queries == []
+    assert reply.status == 400
+
+
+def test_malformed_json_on_asgi_is_a_400():
+    starlette = pytest.importorskip("starlette.testclient")
+    import asgi_app
+
+    # Without the lifespan the pool is never opened; a bad body is rejected
+    # before a connection is needed.
+    client = starlette.TestClient(asgi_app.app)
+    response = client.patch("/companies", content=b"{not json", headers={"content-type": "application/json"})
+
+    assert response.status_code == 400